@@ -0,0 +1,102 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy
+import pandas
+
+from data_shared import update_datastore, push_csv_to_s3, push_partitions_to_s3, read_csv_with_schema, get_schema
+from local_shared import LocalS3
+
+def make_history(days, rows, end):
+    dates = pandas.date_range(end=end, periods=days, freq='D')
+    return pandas.DataFrame({
+        'Date': numpy.repeat(dates, rows),
+        'Band': numpy.tile(numpy.arange(rows), days),
+        'Cases': numpy.random.randint(0, 1000, days * rows),
+    })
+
+def make_typed_history(name, days, rows, end):
+    # Text columns repeat a small set of values, as the age bands and postcode districts do
+    schema = get_schema(name)
+    df = pandas.DataFrame({'Date': numpy.repeat(pandas.date_range(end=end, periods=days, freq='D'), rows)})
+    for column, dtype in schema['columns'].items():
+        if dtype == 'category':
+            df[column] = numpy.tile(['%s %d' %(column, i) for i in range(rows)], days)
+        elif dtype == 'int64':
+            df[column] = numpy.random.randint(0, 100000, days * rows)
+        else:
+            df[column] = numpy.random.rand(days * rows)
+    return df
+
+def measure_load(raw, parse):
+    start = time.perf_counter()
+    df = parse(io.BytesIO(raw))
+    return {
+        'seconds': round(time.perf_counter() - start, 4),
+        'memory_bytes': int(df.memory_usage(deep=True).sum()),
+    }
+
+def untyped(stream):
+    # As the datastores were loaded before the schemas, parsing the dates once to filter and again after appending
+    df = pandas.read_csv(stream)
+    df = df[pandas.to_datetime(df['Date']).dt.date != datetime.date(2000, 1, 1)]
+    df['Date'] = pandas.to_datetime(df['Date'])
+    return df
+
+def measure(s3, keyname, last_updated, df, history):
+    read, written = s3.bytes_read, s3.bytes_written
+    start = time.perf_counter()
+    datastore = update_datastore(s3, 'bucket', keyname, last_updated, df, True, 'Date', history)
+    return {
+        'seconds': round(time.perf_counter() - start, 4),
+        'bytes_read': s3.bytes_read - read,
+        'bytes_written': s3.bytes_written - written,
+        'rows_returned': len(datastore),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of one datastore update as the stored history grows, CSV against date partitions')
+    parser.add_argument('--days', type=int, nargs='+', default=[30, 180, 365, 730])
+    parser.add_argument('--rows', type=int, default=20, help='rows per report date')
+    parser.add_argument('--schemas', nargs='*', help='instead, compare loading these stores with and without their schema')
+    args = parser.parse_args()
+
+    if args.schemas is not None:
+        for name in args.schemas or ['doh-dd-agebands', 'vaccine-postcodes']:
+            for days in args.days:
+                stream = io.BytesIO()
+                make_typed_history(name, days, args.rows, datetime.datetime(2022, 6, 1)).to_csv(stream, index=False)
+                print(json.dumps({
+                    'schema': name,
+                    'days': days,
+                    'rows': days * args.rows,
+                    'untyped': measure_load(stream.getvalue(), untyped),
+                    'typed': measure_load(stream.getvalue(), lambda f: read_csv_with_schema(f, get_schema(name))),
+                }))
+        return
+
+    last_updated = datetime.datetime(2022, 6, 1)
+    for days in args.days:
+        history = make_history(days, args.rows, last_updated - datetime.timedelta(days=1))
+        update = make_history(1, args.rows, last_updated).drop(columns='Date')
+        with tempfile.TemporaryDirectory() as root:
+            s3 = LocalS3(root)
+            push_csv_to_s3(history, s3, 'bucket', 'store.csv')
+            push_partitions_to_s3(history, s3, 'bucket', 'store', 'Date')
+            result = {'days': days, 'rows': days * args.rows}
+            result['csv'] = measure(s3, 'store.csv', last_updated, update, None)
+            result['partitioned_write_only'] = measure(s3, 'store', last_updated, update, 0)
+            result['partitioned_last_42_days'] = measure(s3, 'store', last_updated, update, 42)
+            result['partitioned_all'] = measure(s3, 'store', last_updated, update, None)
+            print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
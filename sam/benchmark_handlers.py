@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import shared
+import local_shared
+from local_shared import LocalClients, LocalTwitter, load_handler, FUNCTION_ENV
+
+def run_invocation(root, secret, name, payload, results):
+    # Runs in a forked child, so the peak RSS is that of this handler alone
+    clients = LocalClients(root, secret)
+    shared.client_factory = clients
+    try:
+        import twitter_shared
+        twitter_shared.TwitterAPI = LocalTwitter
+    except ImportError:
+        pass
+    result = {'handler': name}
+    start = time.perf_counter()
+    try:
+        resp = load_handler(name)(payload, None)
+        result['status'] = resp.get('statusCode')
+    except Exception as e:
+        result['error'] = repr(e)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    result['s3_bytes_read'] = clients.clients['s3'].bytes_read
+    result['s3_bytes_written'] = clients.clients['s3'].bytes_written
+    result['posts'] = len(LocalTwitter.posts)
+    result['launches'] = [(i['FunctionName'], i['Payload']) for i in clients.clients['lambda'].queue]
+    results.put(result)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a chain of handlers offline, reporting wall time, peak RSS and S3 bytes moved by each')
+    parser.add_argument('--handler', default='NICOVIDScraper', choices=sorted(local_shared.HANDLERS), help='the first handler in the chain')
+    parser.add_argument('--fixtures', required=True, help='directory holding the recorded HTTP responses')
+    parser.add_argument('--data', help='directory to seed the local S3 from, one subdirectory per bucket')
+    parser.add_argument('--secret', required=True, help='JSON file holding the secret')
+    parser.add_argument('--event', help='JSON file holding the event for the first handler')
+    parser.add_argument('--keep', help='directory to leave the local S3 in after the run')
+    args = parser.parse_args()
+
+    os.environ['SCRAPER_FIXTURES'] = args.fixtures
+    os.environ['SCRAPER_FIXTURE_MODE'] = 'replay'
+    for env, name in FUNCTION_ENV.items():
+        os.environ[env] = name
+    with open(args.secret) as f:
+        secret = json.load(f)
+    event = {}
+    if args.event is not None:
+        with open(args.event) as f:
+            event = json.load(f)
+
+    root = tempfile.mkdtemp() if args.keep is None else args.keep
+    if args.data is not None:
+        shutil.copytree(args.data, root, dirs_exist_ok=True)
+    context = multiprocessing.get_context('fork')
+    queue = [(args.handler, event)]
+    try:
+        while len(queue) > 0:
+            name, payload = queue.pop(0)
+            results = context.Queue()
+            child = context.Process(target=run_invocation, args=(root, secret, name, payload, results))
+            child.start()
+            result = results.get()
+            child.join()
+            # Launches are run after the handler that made them, as Lambda would
+            queue.extend((n, p) for n, p in result['launches'] if n in local_shared.HANDLERS)
+            result['launches'] = [n for n, p in result['launches']]
+            print(json.dumps(result))
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import threading
+import email.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import requests
+
+from shared import new_session
+from scraper.app import extract_doh_file_list, SOURCES
+
+def old_extract_doh_file_list(text,number,regex,datesub=[],datefmt='%d%m%y',element="div",htmlclass="nigovfile",matchgroup=1):
+    # The original, probing each link in turn without a session
+    from bs4 import BeautifulSoup
+    html = BeautifulSoup(text,features="html.parser")
+    files = []
+    regex = re.compile(regex, flags=re.IGNORECASE)
+    for nigovfile in html.find_all(element, {"class": htmlclass}):
+        for a in nigovfile.find_all('a', href=True):
+            m = regex.search(a['href'])
+            if m:
+                if len(datesub) == 2:
+                    datestr = re.sub(datesub[0],datesub[1],m.group(matchgroup))
+                else:
+                    datestr = m.group(matchgroup)
+                datestr = datestr.replace('%20','-')
+                resp = requests.head(a['href'])
+                resp.raise_for_status()
+                filedate = datetime.datetime.strptime(datestr,datefmt)
+                if 'Last-Modified' in resp.headers:
+                    modified = datetime.datetime.strptime(resp.headers['Last-Modified'],'%a, %d %b %Y %H:%M:%S %Z') # e.g Mon, 08 Mar 2021 06:12:35 GMT
+                    if 'Content-Length' in resp.headers:
+                        files.append({'url': a['href'],'modified': modified.isoformat(),'length': int(resp.headers['Content-Length']), 'filedate': filedate.date().isoformat()})
+                    else:
+                        files.append({'url': a['href'],'modified': modified.isoformat(),'filedate': filedate.date().isoformat()})
+                else:
+                    files.append({'url': a['href'],'filedate': filedate.date().isoformat()})
+                if len(files)>=number:
+                    break
+        if (number > 0) and (len(files)>=number):
+            break
+    return files
+
+class DoHHandler(BaseHTTPRequestHandler):
+    # Stands in for the DoH site: /links/<n> is a listing page of n daily files, each of which
+    # answers HEAD after self.server.latency seconds
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        links = int(self.path.rsplit('/', 1)[1])
+        start = datetime.date(2021, 3, 1)
+        body = ['<html><body>']
+        for i in range(links):
+            date = start + datetime.timedelta(days=i)
+            body.append('<div class="nigovfile"><a href="http://%s:%d/files/doh-dd-%s.xlsx">Daily dashboard %s</a> <a href="/other">Other</a></div>' %(self.server.server_address[0], self.server.server_address[1], date.strftime('%d%m%y'), date.isoformat()))
+        body.append('</body></html>')
+        data = '\n'.join(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        self.send_header('Content-Length', str(100000 + len(self.path)))
+        self.send_header('Last-Modified', email.utils.format_datetime(datetime.datetime(2021, 3, 8, 6, 12, 35, tzinfo=datetime.timezone.utc), usegmt=True))
+        self.end_headers()
+
+def best_of(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, round(min(timings), 4)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time probing the links on a DoH listing page, one at a time and with a pool of workers, against a local stand-in server')
+    parser.add_argument('--links', type=int, nargs='+', default=[30, 90, 365])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds each HEAD request takes to answer')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    try:
+        import bs4
+    except ImportError:
+        bs4 = None
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DoHHandler)
+    server.daemon_threads = True
+    server.latency = args.latency
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    regex = SOURCES['dd']['regex']
+    try:
+        with tempfile.TemporaryDirectory() as fixtures:
+            for links in args.links:
+                url = 'http://127.0.0.1:%d/links/%d' %(server.server_address[1], links)
+                os.environ.pop('SCRAPER_FIXTURES', None)
+                text = new_session().get(url).text
+                result = {'links': links, 'latency': args.latency}
+                expected = None
+                if bs4 is not None:
+                    expected, result['serial_seconds'] = best_of(lambda: old_extract_doh_file_list(text, 0, regex), args.repeat)
+                for workers in args.workers:
+                    files, result['workers_%d_seconds' %workers] = best_of(lambda: extract_doh_file_list(text, 0, regex, workers=workers), args.repeat)
+                    assert (expected is None) or (files == expected), workers
+                    expected = files
+                assert len(expected) == links
+                # Record the probes through the fixture adapter, then replay them without the server
+                os.environ['SCRAPER_FIXTURES'] = fixtures
+                os.environ['SCRAPER_FIXTURE_MODE'] = 'record'
+                files = extract_doh_file_list(text, 0, regex, workers=max(args.workers))
+                assert files == expected
+                os.environ['SCRAPER_FIXTURE_MODE'] = 'replay'
+                files, result['replay_seconds'] = best_of(lambda: extract_doh_file_list(text, 0, regex, workers=max(args.workers)), args.repeat)
+                assert files == expected
+                print(json.dumps(result))
+    finally:
+        os.environ.pop('SCRAPER_FIXTURES', None)
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
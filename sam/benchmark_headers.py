@@ -0,0 +1,77 @@
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas
+
+from data_shared import Workbook, SNAPSHOT_SHEETS, match_header
+
+def retry_loop(raw, sheet_name, signature, first, last):
+    # As the ONS tweeter did, a full read_excel for each candidate header row until the columns match
+    stream = io.BytesIO(raw)
+    for header in range(first, last):
+        df = pandas.read_excel(stream, engine='openpyxl', sheet_name=sheet_name, header=header)
+        if match_header(df.columns, signature):
+            return header, df
+    raise ValueError('No header row naming %s in rows %d to %d of %s' %(signature, first, last - 1, sheet_name))
+
+def sniffed(raw, sheet_name, signature):
+    workbook = Workbook(raw)
+    header = workbook.find_header(sheet_name, signature)
+    df = workbook.sheet(sheet_name, header=signature)
+    workbook.close()
+    return header, df
+
+def measure(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': round(min(timings), 3), 'peak_bytes': peak}
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare finding header rows by re-reading a sheet for each candidate with sniffing them from the top rows')
+    parser.add_argument('workbooks', nargs='+', help='xlsx files, e.g. ONS infection survey or NISRA deaths files from the archive bucket')
+    parser.add_argument('--sheet', nargs='+', action='append', metavar=('NAME', 'COLUMN'), help='a sheet and the columns naming its header row, by default those in SNAPSHOT_SHEETS')
+    parser.add_argument('--first', type=int, default=3, help='first header row the retry loop tries')
+    parser.add_argument('--last', type=int, default=20, help='header row the retry loop stops before')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sheets = args.sheet
+    if sheets is None:
+        sheets = [[name] + header for source in SNAPSHOT_SHEETS.values() for name, header in source if not isinstance(header, int)]
+    for path in args.workbooks:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        workbook = Workbook(raw)
+        names = workbook.sheetnames
+        workbook.close()
+        for sheet in sheets:
+            name, signature = sheet[0], sheet[1:]
+            if name not in names:
+                continue
+            header, expected = retry_loop(raw, name, signature, args.first, args.last)
+            found, df = sniffed(raw, name, signature)
+            pandas.testing.assert_frame_equal(expected, df)
+            print(json.dumps({
+                'workbook': path,
+                'sheet': name,
+                'header': found,
+                'retry_loop': measure(lambda: retry_loop(raw, name, signature, args.first, args.last), args.repeat),
+                'sniffed': measure(lambda: sniffed(raw, name, signature), args.repeat),
+            }))
+
+if __name__ == '__main__':
+    main()
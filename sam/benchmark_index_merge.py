@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scraper.app import check_file_list_against_previous
+
+def old_check_file_list_against_previous(current, previous):
+    # The original merge, scanning the index for every listed file
+    changes = []
+    maxdate = '1970-01-01'
+    for i in range(len(previous)):
+        if previous[i]['filedate'] > maxdate:
+            maxdate = previous[i]['filedate']
+    for e in reversed(current):
+        match = next((p for p in previous if p["filedate"] == e["filedate"]), None)
+        if match is None and (e['filedate'] > maxdate):
+            # If a new, later date
+            for i in range(len(changes)):
+                changes[i]['index'] = changes[i]['index']+1
+            changes.append({'index': 0, 'change': 'added'})
+            previous.insert(0, e)
+        elif match is None:
+            # If a new, older date
+            changes.append({'index': len(previous), 'change': 'added'})
+            previous.append(e)
+        elif 'modified' in match:
+            if 'length' in match:
+                if ((match['modified'] != e['modified']) or (match['length'] != e['length'])):
+                    changes.append({'index': previous.index(match), 'change': 'modified'})
+                    previous[changes[-1]['index']] = e
+            else:
+                if match['modified'] != e['modified']:
+                    changes.append({'index': previous.index(match), 'change': 'modified'})
+                    previous[changes[-1]['index']] = e
+    return previous, changes
+
+def make_entry(rng, date, serial, fields):
+    # Every entry has its own URL, as the scraped ones do
+    e = {'url': 'https://example.com/%d' %serial, 'filedate': date.isoformat()}
+    if 'modified' in fields:
+        e['modified'] = '%sT%02d:00:00' %(date.isoformat(), rng.randrange(24))
+    if 'length' in fields:
+        e['length'] = str(rng.randrange(1, 4))
+    return e
+
+def make_lists(rng, size, listed, span=None):
+    # An index of size entries, newest first, with some dates repeated, and a listing of the site
+    # re-listing some of them as they are or with a new modified time or length, adding files
+    # both after and before the index, and in its gaps. Each source's entries have the same fields
+    fields = rng.choice([('modified', 'length'), ('modified',), ()])
+    if span is None:
+        span = 2 * size + 10
+    start = datetime.date(2020, 3, 1)
+    serial = 0
+    previous = []
+    for i in range(size):
+        previous.append(make_entry(rng, start + datetime.timedelta(days=span + rng.randrange(span)), serial, fields))
+        serial += 1
+    previous.sort(key=lambda e: e['filedate'], reverse=True)
+    current = []
+    for i in range(listed):
+        kind = rng.random()
+        if (kind < 0.5) and (len(previous) > 0):
+            e = dict(rng.choice(previous))
+            if rng.random() < 0.3:
+                if 'modified' in e:
+                    e['modified'] = e['modified'][:11] + '23:59:59'
+                if ('length' in e) and (rng.random() < 0.5):
+                    e['length'] = str(int(e['length']) + 1)
+        else:
+            e = make_entry(rng, start + datetime.timedelta(days=rng.randrange(3 * span)), serial, fields)
+            serial += 1
+        current.append(e)
+    if rng.random() < 0.7:
+        current.sort(key=lambda e: e['filedate'], reverse=True)
+    return current, previous
+
+def check_same(current, previous):
+    expected, expected_changes = old_check_file_list_against_previous(deepcopy(current), deepcopy(previous))
+    merged, changes = check_file_list_against_previous(deepcopy(current), deepcopy(previous))
+    assert merged == expected
+    # Modified entries also carry the entry they replaced, which the old merge didn't keep
+    assert [{k: v for k, v in c.items() if k != 'previous'} for c in changes] == expected_changes
+    return len(changes)
+
+def best_of(func, current, previous, repeat):
+    timings = []
+    for i in range(repeat):
+        c = deepcopy(current)
+        p = deepcopy(previous)
+        start = time.perf_counter()
+        func(c, p)
+        timings.append(time.perf_counter() - start)
+    return round(min(timings), 4)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the scraper index merge against the original one on random lists, then time both')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='index sizes to time')
+    parser.add_argument('--listed', type=float, default=1.0, help='files listed on the site, as a fraction of the index size')
+    parser.add_argument('--old-max', type=int, default=10000, help='largest index size to time the original merge at')
+    parser.add_argument('--trials', type=int, default=2000, help='random small lists to check the merges agree on')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    changes = 0
+    for trial in range(args.trials):
+        # Small lists over a few dates, so repeated and colliding dates are common
+        size = rng.randrange(0, 30)
+        current, previous = make_lists(rng, size, rng.randrange(0, 30), span=rng.randrange(1, 20))
+        changes += check_same(current, previous)
+    print(json.dumps({'trials': args.trials, 'changes': changes, 'match': True}))
+
+    for size in args.sizes:
+        current, previous = make_lists(rng, size, int(size * args.listed))
+        result = {'index': size, 'listed': len(current)}
+        if size <= args.old_max:
+            result['changes'] = check_same(current, previous)
+            result['old_seconds'] = best_of(old_check_file_list_against_previous, current, previous, args.repeat)
+        result['new_seconds'] = best_of(check_file_list_against_previous, current, previous, args.repeat)
+        print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
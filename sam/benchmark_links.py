@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from shared import extract_links
+
+def load_page(path):
+    # Either a saved HTML page or a fixture recorded by replay_scraper.py
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.json'):
+        fixture = json.loads(data)
+        if 'html' not in fixture['headers'].get('Content-Type', ''):
+            return None
+        data = base64.b64decode(fixture['body'])
+    return data.decode('utf-8', errors='replace')
+
+def measure(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return sorted(timings)[len(timings)//2], peak
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare link extraction against a full BeautifulSoup parse on archived pages')
+    parser.add_argument('pages', nargs='+', help='HTML files, or JSON fixtures recorded by replay_scraper.py')
+    parser.add_argument('--element', default='div')
+    parser.add_argument('--htmlclass', default='nigovfile')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        BeautifulSoup = None
+
+    for path in args.pages:
+        text = load_page(path)
+        if text is None:
+            continue
+        result = {'page': path, 'bytes': len(text)}
+        def fast():
+            return extract_links(text, args.element, args.htmlclass)
+        result['links'] = len(fast())
+        result['extract_links_seconds'], result['extract_links_peak_bytes'] = measure(fast, args.repeat)
+        if BeautifulSoup is not None:
+            def full():
+                html = BeautifulSoup(text, features='html.parser')
+                return [a['href'] for d in html.find_all(args.element, {'class': args.htmlclass}) for a in d.find_all('a', href=True)]
+            result['bs4_seconds'], result['bs4_peak_bytes'] = measure(full, args.repeat)
+        print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas
+import requests
+
+from data_shared import parse_ons_pop_pyramid, POPULATION_SOURCES
+
+def parse_ons_pop_pyramid_melt(data):
+    # The original melt-based parser, kept to check the output of the new one
+    series = pandas.Series(data['series'], name='Gender')
+    value = pandas.DataFrame(data['value'])
+    time = pandas.DataFrame(data['time'])
+    dimension = pandas.DataFrame(data['dimension'])
+    value.columns = dimension['index']
+    value = value.merge(series, left_index=True, right_index=True)
+    value = value.melt(var_name='Age Band', id_vars='Gender')
+    value.set_index(['Gender','Age Band'],inplace=True)
+    df = pandas.DataFrame(value['value'].tolist(), index=value.index)
+    df.columns = time['index'].values
+    df = df.reset_index().melt(id_vars=['Gender','Age Band'], var_name='Year')
+    df.set_index(['Gender','Age Band','Year'],inplace=True)
+    df = pandas.DataFrame(df['value'].tolist(), index=df.index)
+    df.columns = ['Population','% of population']
+    df.reset_index(inplace=True)
+    df['Year'] = df['Year'].astype(int)
+    df['Age Band'] = df['Age Band'].astype(int)
+    return df
+
+def best_of(func, data, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time the ONS population pyramid parser against the original')
+    parser.add_argument('payloads', nargs='*', help='saved ONS JSON payloads, fetched from ONS if not given')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    payloads = {}
+    for path in args.payloads:
+        with open(path) as f:
+            payloads[path] = json.load(f)['ons']
+    if len(payloads) == 0:
+        for region, url in POPULATION_SOURCES.items():
+            resp = requests.get(url)
+            resp.raise_for_status()
+            payloads[region] = resp.json()['ons']
+
+    for name, data in payloads.items():
+        pandas.testing.assert_frame_equal(parse_ons_pop_pyramid(data), parse_ons_pop_pyramid_melt(data))
+        print(json.dumps({
+            'payload': name,
+            'rows': len(parse_ons_pop_pyramid(data)),
+            'melt_seconds': round(best_of(parse_ons_pop_pyramid_melt, data, args.repeat), 5),
+            'reshape_seconds': round(best_of(parse_ons_pop_pyramid, data, args.repeat), 5),
+        }))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from shared import new_session, get_url, upload_url_to_s3
+from local_shared import LocalS3
+from scraper.app import upload_changes_to_s3
+
+MB = 1024*1024
+
+def file_block(n):
+    # The n-th 64KB block of every served file, so a file can be streamed without being held
+    return hashlib.sha256(b'%d' %n).digest() * 2048
+
+class FileHandler(BaseHTTPRequestHandler):
+    # /files/<bytes>/<name> streams a file of that many bytes, 64KB at a time
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        size = int(self.path.split('/')[2])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        sent = 0
+        n = 0
+        while sent < size:
+            block = file_block(n)[:size - sent]
+            self.wfile.write(block)
+            sent += len(block)
+            n += 1
+
+def file_sha256(size):
+    sha256 = hashlib.sha256()
+    sent = 0
+    n = 0
+    while sent < size:
+        block = file_block(n)[:size - sent]
+        sha256.update(block)
+        sent += len(block)
+        n += 1
+    return sha256.hexdigest()
+
+def measure(func):
+    # Wall time and peak of memory allocated by Python while running func
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, round(elapsed, 3), peak
+
+def stored_sha256(s3, key):
+    sha256 = hashlib.sha256()
+    with open(s3.path('bucket', key), 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser(description='Report peak memory streaming files of growing size through a local S3 stand-in, against the chunk size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 256], help='file sizes in MB')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[5, 8, 16], help='multipart chunk sizes in MB')
+    parser.add_argument('--files', type=int, default=8, help='files uploaded together by upload_changes_to_s3')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    baseurl = 'http://127.0.0.1:%d/files' %server.server_address[1]
+    session = new_session()
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            s3 = LocalS3(root)
+            for size in args.sizes:
+                url = '%s/%d/file.xlsx' %(baseurl, size*MB)
+                expected = file_sha256(size*MB)
+                # The original path, reading the whole file before putting it
+                _, seconds, peak = measure(lambda: s3.put_object(Bucket='bucket', Key='buffered', Body=get_url(session, url, 'content')))
+                assert stored_sha256(s3, 'buffered') == expected
+                print(json.dumps({'size_mb': size, 'mode': 'buffered', 'seconds': seconds, 'peak_bytes': peak}))
+                for chunk in args.chunks:
+                    sha256, seconds, peak = measure(lambda: upload_url_to_s3(session, url, s3, 'bucket', 'streamed', chunksize=chunk*MB))
+                    assert sha256 == expected
+                    assert stored_sha256(s3, 'streamed') == expected
+                    print(json.dumps({'size_mb': size, 'mode': 'streamed', 'chunk_mb': chunk, 'seconds': seconds, 'peak_bytes': peak, 'peak_chunks': round(peak / (chunk*MB), 2)}))
+            # Several changed files at once, at the default chunk size
+            size = args.sizes[-1]
+            index = [{'url': '%s/%d/file-%d.xlsx' %(baseurl, size*MB, i), 'filedate': '2021-03-%02d' %(i + 1)} for i in range(args.files)]
+            expected = file_sha256(size*MB)
+            for workers in args.workers:
+                changes = [{'index': i, 'change': 'added'} for i in range(args.files)]
+                result, seconds, peak = measure(lambda: upload_changes_to_s3(s3, 'bucket', 'changes-%d' %workers, [dict(e) for e in index], changes, 'xlsx', workers))
+                for e in result:
+                    assert e['sha256'] == expected
+                    assert stored_sha256(s3, e['keyname']) == expected
+                print(json.dumps({'size_mb': size, 'mode': 'upload_changes_to_s3', 'files': args.files, 'workers': workers, 'seconds': seconds, 'peak_bytes': peak}))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
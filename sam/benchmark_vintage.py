@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy
+import pandas
+
+from data_shared import VintagePanel
+
+VALUES = ['Total Lab Tests', 'Individ with Lab Test', 'Individ with Positive Lab Test']
+
+def make_panel(reports, days):
+    # Each daily report gives every specimen date in the last days before it, with counts filling in over the following week
+    frames = []
+    counts = numpy.random.randint(1000, 5000, (reports + days, len(VALUES)))
+    for i, report in enumerate(pandas.date_range('2021-01-01', periods=reports, freq='D')):
+        dates = pandas.date_range(end=report - pandas.Timedelta(days=1), periods=days, freq='D')
+        lag = (report - dates).days.to_numpy()
+        values = (counts[i:i + days] * (1 - numpy.exp(-lag / 3.0))[:, None]).astype(int)
+        frame = pandas.DataFrame(values, columns=VALUES)
+        frame.insert(0, 'Reported_Date', report)
+        frame.insert(0, 'Date of Specimen', dates)
+        frames.append(frame)
+    return pandas.concat(frames, ignore_index=True)
+
+# The recipes in notebooks/tests_cases.py, and the panel queries giving the same results
+RECIPES = {
+    'relative': (
+        lambda df: df.sort_values('Reported_Date').groupby('Date of Specimen')['Individ with Lab Test'].apply(lambda x: x.div(x.iloc[0])),
+        lambda panel: panel.relative('Individ with Lab Test'),
+    ),
+    'new_per_report': (
+        lambda df: df.groupby(['Reported_Date'])[VALUES].sum().sort_index().diff(),
+        lambda panel: panel.new_per_report(),
+    ),
+    'last_24_hours': (
+        lambda df: df.sort_values('Date of Specimen').groupby(['Reported_Date']).last()[VALUES],
+        lambda panel: panel.last_24_hours(),
+    ),
+    'by_days_since_test': (
+        lambda df: df.assign(**{'Days since test': (df['Reported_Date'] - df['Date of Specimen']).dt.days}).pivot_table(index='Date of Specimen', columns='Days since test', values='Individ with Lab Test', aggfunc='sum'),
+        lambda panel: panel.revisions('Individ with Lab Test', relative=False),
+    ),
+}
+
+def check_relative(expected, ratios, df, panel):
+    # The groupby-apply gives a ratio per row of df, which is looked up in the panel by its report and date
+    if expected.index.nlevels > 1:
+        expected = expected.droplevel(0)
+    expected = expected.reindex(df.index)
+    rows = numpy.searchsorted(panel.reports, df['Reported_Date'].to_numpy().astype('datetime64[D]'))
+    cols = (df['Date of Specimen'].to_numpy().astype('datetime64[D]') - panel.dates[0]).astype(int)
+    numpy.testing.assert_allclose(ratios[rows, cols], expected.to_numpy())
+
+def best_of(func, arg, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    return round(min(timings), 4)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the reporting delay recipes from the tests notebook against the VintagePanel queries')
+    parser.add_argument('--csv', help='an all_tests CSV, made up if not given')
+    parser.add_argument('--reports', type=int, nargs='+', default=[100, 300, 600])
+    parser.add_argument('--days', type=int, default=365, help='specimen dates in each made up report')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    numpy.random.seed(1)
+    if args.csv is not None:
+        df = pandas.read_csv(args.csv, parse_dates=['Date of Specimen', 'Reported_Date'])
+        datasets = [(args.csv, df)]
+    else:
+        datasets = [(reports, make_panel(reports, args.days)) for reports in args.reports]
+
+    for name, df in datasets:
+        result = {'dataset': name, 'rows': len(df), 'build_seconds': best_of(lambda d: VintagePanel(d, VALUES), df, args.repeat)}
+        panel = VintagePanel(df, VALUES)
+        for recipe, (old, new) in RECIPES.items():
+            if recipe == 'relative':
+                check_relative(old(df), new(panel), df, panel)
+            elif recipe in ('new_per_report', 'last_24_hours'):
+                numpy.testing.assert_allclose(new(panel).to_numpy(), old(df).to_numpy().astype(float))
+            elif recipe == 'by_days_since_test':
+                expected = old(df)
+                numpy.testing.assert_allclose(new(panel).loc[expected.index, expected.columns].to_numpy(), expected.to_numpy().astype(float))
+            result[recipe] = {'pandas_seconds': best_of(old, df, args.repeat), 'panel_seconds': best_of(new, panel, args.repeat)}
+        print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
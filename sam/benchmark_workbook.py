@@ -0,0 +1,69 @@
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas
+
+from data_shared import Workbook
+
+# The sheets the cases tweeter reads from each DoH workbook, with the columns it uses (None for all)
+DOH_SHEETS = [
+    ('Tests', ['Sample_Date', 'Total Tests', 'Total Cases']),
+    ('Summary Tests', None),
+    ('Deaths', ['Date of Death', 'Number of Deaths']),
+    ('Admissions', ['Admission Date', 'Number of Admissions']),
+    ('Discharges', ['Discharge Date', 'Number of Discharges']),
+    ('Inpatients', ['Inpatients at Midnight', 'Number of Confirmed COVID Inpatients', 'Sex']),
+    ('ICU', ['Date', 'Confirmed COVID Occupied']),
+    ('Individuals 7 Days - 5yr Age', ['Age_Band_5yr', 'Total_Cases', 'Total_Tests']),
+]
+
+def read_excel_each(raw):
+    # As the tweeter did, a full read_excel of the same stream for every sheet
+    stream = io.BytesIO(raw)
+    return [pandas.read_excel(stream, engine='openpyxl', sheet_name=name) for name, usecols in DOH_SHEETS]
+
+def workbook_once(raw):
+    workbook = Workbook(raw)
+    frames = [workbook.sheet(name, usecols=usecols) for name, usecols in DOH_SHEETS]
+    workbook.close()
+    return frames
+
+def measure(func, raw, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(raw)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': round(min(timings), 3), 'peak_bytes': peak}
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare one read_excel per sheet with a single Workbook on DoH daily workbooks')
+    parser.add_argument('workbooks', nargs='+', help='DoH daily xlsx files, e.g. downloaded from the archive bucket')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for path in args.workbooks:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        for (name, usecols), a, b in zip(DOH_SHEETS, read_excel_each(raw), workbook_once(raw)):
+            pandas.testing.assert_frame_equal(a if usecols is None else a[usecols], b)
+        print(json.dumps({
+            'workbook': path,
+            'bytes': len(raw),
+            'read_excel': measure(read_excel_each, raw, args.repeat),
+            'workbook_once': measure(workbook_once, raw, args.repeat),
+        }))
+
+if __name__ == '__main__':
+    main()
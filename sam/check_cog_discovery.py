@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+import email.utils
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_shared import LocalS3
+from scraper.app import check_for_cog_files
+
+class BucketHandler(BaseHTTPRequestHandler):
+    # Serves a public bucket's HEAD and ListObjectsV2 requests from self.server.objects, a dict of
+    # key -> (modified, length), a page of self.server.page keys at a time
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        key = urllib.parse.urlparse(self.path).path.lstrip('/')
+        if key not in self.server.objects:
+            self.send_response(403)
+            self.send_header('Content-Type', 'application/xml')
+            self.end_headers()
+            return
+        modified, length = self.server.objects[key]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/gzip')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Last-Modified', email.utils.format_datetime(modified, usegmt=True))
+        self.end_headers()
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter')
+        after = params.get('continuation-token', params.get('start-after', ''))
+        # Each entry is a key or, if a delimiter is given, the common prefix it rolls up into
+        entries = []
+        for key in sorted(self.server.objects):
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if (delimiter is not None) and (delimiter in rest):
+                entry = (prefix + rest[:rest.index(delimiter) + 1], None)
+            else:
+                entry = (key, self.server.objects[key])
+            if (entry[0] > after) and ((len(entries) == 0) or (entries[-1][0] != entry[0])):
+                entries.append(entry)
+        page = entries[:self.server.page]
+        body = ['<?xml version="1.0" encoding="UTF-8"?>', '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">']
+        for name, obj in page:
+            if obj is None:
+                body.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' %escape(name))
+            else:
+                body.append('<Contents><Key>%s</Key><LastModified>%s.000Z</LastModified><Size>%d</Size></Contents>' %(escape(name), obj[0].strftime('%Y-%m-%dT%H:%M:%S'), obj[1]))
+        if len(entries) > len(page):
+            body.append('<IsTruncated>true</IsTruncated><NextContinuationToken>%s</NextContinuationToken>' %escape(page[-1][0]))
+        else:
+            body.append('<IsTruncated>false</IsTruncated>')
+        body.append('</ListBucketResult>')
+        data = '\n'.join(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def make_bucket(today, last, days, rng):
+    # Metadata files on a random subset of the days up to and past today, plus a non-metadata file
+    # in each directory and a directory before the last indexed file
+    objects = {}
+    for i in range(-3, days + 5):
+        date = today - datetime.timedelta(days=i)
+        if rng.random() < 0.7:
+            modified = datetime.datetime.combine(date, datetime.time(6, rng.randrange(60), rng.randrange(60)), datetime.timezone.utc)
+            objects['phylogenetics/%s/cog_metadata.csv.gz' %date.isoformat()] = (modified, rng.randrange(10**6, 10**8))
+            objects['phylogenetics/%s/cog_global_tree.newick' %date.isoformat()] = (modified, rng.randrange(10**6))
+    lastkey = 'phylogenetics/%s/cog_metadata.csv.gz' %last.isoformat()
+    objects[lastkey] = (datetime.datetime.combine(last, datetime.time(6), datetime.timezone.utc), 12345)
+    return objects
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the probe and list modes of COG discovery find the same files, against a local stand-in bucket')
+    parser.add_argument('--days', type=int, nargs='+', default=[0, 1, 7, 30], help='days between the last indexed file and today')
+    parser.add_argument('--page', type=int, default=4, help='keys per ListObjectsV2 page')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BucketHandler)
+    server.page = args.page
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    baseurl = 'http://127.0.0.1:%d' %server.server_address[1]
+    today = datetime.datetime.today().date()
+    try:
+        for days in args.days:
+            last = today - datetime.timedelta(days=days)
+            server.objects = make_bucket(today, last, days, rng)
+            previous = [{
+                'url': '%s/phylogenetics/%s/cog_metadata.csv.gz' %(baseurl, last.isoformat()),
+                'modified': '%sT06:00:00' %last.isoformat(),
+                'length': 12345,
+                'filedate': last.isoformat(),
+            }]
+            # Every metadata file from today back to the last indexed one, bar that one, newest first
+            expected = []
+            for key, (modified, length) in sorted(server.objects.items(), reverse=True):
+                date = datetime.datetime.strptime(key.split('/')[1], '%Y-%m-%d').date()
+                if key.endswith('cog_metadata.csv.gz') and (last < date <= today):
+                    expected.append(date.isoformat())
+            found = {}
+            for mode in ['probe', 'list']:
+                with tempfile.TemporaryDirectory() as root:
+                    s3 = LocalS3(root)
+                    s3.put_object(Bucket='bucket', Key='cog-index.json', Body=json.dumps(previous).encode('utf-8'))
+                    latest = check_for_cog_files(s3, 'bucket', 'cog-index.json', mode, baseurl=baseurl)
+                    index = json.loads(s3.get_object(Bucket='bucket', Key='cog-index.json')['Body'].read())
+                found[mode] = index
+                assert [e['filedate'] for e in index[:len(expected)]] == expected, (mode, days)
+                assert index[len(expected):] == previous, (mode, days)
+                assert latest == (index[0] if len(expected) > 0 else None), (mode, days)
+            assert found['probe'] == found['list'], days
+            print(json.dumps({'days': days, 'objects': len(server.objects), 'found': len(expected), 'match': True}))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -1,67 +1,1059 @@
 import io
+import os
+import re
+import json
+import uuid
+import pickle
+import hashlib
+import datetime
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor
 
+import botocore.exceptions
+import numpy
 import pandas
+import openpyxl
 import requests
+from pandas.io.parsers import TextParser
+
+from shared import S3_scraper_index, is_missing_key
+
+def parse_ons_pop_pyramid(data):
+    # data['value'] is a (gender, age, year, measure) cube of nested lists, which is flattened
+    # into rows ordered by year, then age, then gender. It is kept as objects until each measure
+    # is split out, so the measures get the same dtypes as pandas would infer from the lists
+    rows = [list(row.values()) if isinstance(row, dict) else row for row in data['value']]
+    cube = numpy.array(rows, dtype=object)
+    genders = numpy.array(data['series'], dtype=object)[:cube.shape[0]]
+    cube = cube[:len(genders)]
+    ages = numpy.array([d['index'] for d in data['dimension']]).astype(int)
+    years = numpy.array([t['index'] for t in data['time']]).astype(int)
+    cube = cube.transpose(2, 1, 0, 3).reshape(-1, cube.shape[3])
+    return pandas.DataFrame({
+        'Gender': numpy.tile(genders, len(years) * len(ages)),
+        'Age Band': numpy.tile(numpy.repeat(ages, len(genders)), len(years)),
+        'Year': numpy.repeat(years, len(ages) * len(genders)),
+        'Population': pandas.Series(cube[:, 0]).infer_objects(),
+        '% of population': pandas.Series(cube[:, 1]).infer_objects(),
+    })
 
 def get_ons_pop_pyramid(url):
     resp = requests.get(url)
     resp.raise_for_status()
-    data = resp.json()['ons']
-    series = pandas.Series(data['series'], name='Gender')
-    value = pandas.DataFrame(data['value'])
-    time = pandas.DataFrame(data['time'])
-    dimension = pandas.DataFrame(data['dimension'])
-    value.columns = dimension['index']
-    value = value.merge(series, left_index=True, right_index=True)
-    value = value.melt(var_name='Age Band', id_vars='Gender')
-    value.set_index(['Gender','Age Band'],inplace=True)
-    df = pandas.DataFrame(value['value'].tolist(), index=value.index)
-    df.columns = time['index'].values
-    df = df.reset_index().melt(id_vars=['Gender','Age Band'], var_name='Year')
-    df.set_index(['Gender','Age Band','Year'],inplace=True)
-    df = pandas.DataFrame(df['value'].tolist(), index=df.index)
-    df.columns = ['Population','% of population']
-    df.reset_index(inplace=True)
-    df['Year'] = df['Year'].astype(int)
-    df['Age Band'] = df['Age Band'].astype(int)
-    return df
+    return parse_ons_pop_pyramid(resp.json()['ons'])
+
+POPULATION_SOURCES = {
+    'uk': 'https://www.ons.gov.uk/visualisations/dvc671/pyramids2/pyramids/data/unitedkingdom.json',
+    'eng': 'https://www.ons.gov.uk/visualisations/dvc1430/pyramids/pyramids/data/E92000001.json',
+    'ni': 'https://www.ons.gov.uk/visualisations/dvc1430/pyramids/pyramids/data/N92000002.json',
+}
+
+class S3_population_store:
+    # ONS population pyramids, fetched once and then snapshotted to S3 under a version which
+    # should be bumped to pick up new ONS data, and memoized for the life of the container
+    def __init__(self, version='v1', prefix='population'):
+        self.version = version
+        self.prefix = prefix
+        self.s3 = None
+        self.bucketname = None
+        self.pyramids = {}
+        self.ages = {}
+        self.fetches = 0
+
+    def configure(self, s3, bucketname):
+        self.s3 = s3
+        self.bucketname = bucketname
+
+    def keyname(self, region):
+        return '%s/%s-%s.parquet' %(self.prefix, region, self.version)
+
+    def pyramid(self, region):
+        if region not in self.pyramids:
+            df = None
+            if self.s3 is not None:
+                try:
+                    obj = self.s3.get_object(Bucket=self.bucketname,Key=self.keyname(region))['Body']
+                    df = pandas.read_parquet(io.BytesIO(obj.read()))
+                except botocore.exceptions.ClientError as err:
+                    if not is_missing_key(err):
+                        raise
+                    print("The object %s does not exist in bucket %s." %(self.keyname(region), self.bucketname))
+            if df is None:
+                df = get_ons_pop_pyramid(POPULATION_SOURCES[region])
+                self.fetches += 1
+                if self.s3 is not None:
+                    stream = io.BytesIO()
+                    df.to_parquet(stream, index=False)
+                    self.s3.put_object(Bucket=self.bucketname, Key=self.keyname(region), Body=stream.getvalue())
+            self.pyramids[region] = df
+        return self.pyramids[region]
+
+    def by_age(self, region, year):
+        # Population by single year of age (90 meaning 90 and over), both genders combined
+        if (region, year) not in self.ages:
+            df = self.pyramid(region)
+            self.ages[(region, year)] = df[df['Year']==year].groupby('Age Band')['Population'].sum()
+        return self.ages[(region, year)].copy()
+
+    def by_band(self, region, year, bands):
+        # Population of each band, given as a mapping of band name to the ages it covers
+        ages = self.by_age(region, year)
+        return pandas.Series(
+            {band: ages.reindex(list(members)).sum() for band, members in bands.items()},
+            name='Population'
+        )
+
+population_store = S3_population_store()
 
 def get_uk_pop_pyramid():
-    return get_ons_pop_pyramid('https://www.ons.gov.uk/visualisations/dvc671/pyramids2/pyramids/data/unitedkingdom.json')
+    return population_store.pyramid('uk').copy()
 
 def get_eng_pop_pyramid():
-    return get_ons_pop_pyramid('https://www.ons.gov.uk/visualisations/dvc1430/pyramids/pyramids/data/E92000001.json')
+    return population_store.pyramid('eng').copy()
 
 def get_ni_pop_pyramid():
-    return get_ons_pop_pyramid('https://www.ons.gov.uk/visualisations/dvc1430/pyramids/pyramids/data/N92000002.json')
+    return population_store.pyramid('ni').copy()
+
+class S3_frame_cache:
+    # Copies of S3 objects in /tmp, kept between warm invocations, with the dataframe parsed
+    # from each pickled alongside it. Entries are revalidated against S3 with a conditional
+    # GET on their ETag, and the least recently used are evicted to stay under maxbytes
+    def __init__(self, dirname, maxbytes):
+        self.dirname = dirname
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Counts are per invocation, the cached files are not touched
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def path(self, bucketname, keyname, ext):
+        name = hashlib.sha1(('%s/%s' %(bucketname, keyname)).encode()).hexdigest()
+        return os.path.join(self.dirname, '%s.%s' %(name, ext))
+
+    def write(self, path, data):
+        os.makedirs(self.dirname, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def lookup(self, bucketname, keyname):
+        try:
+            with open(self.path(bucketname, keyname, 'json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, bucketname, keyname, etag, raw, df=None):
+        # The metadata goes last, so a partly written entry is never used
+        if etag is None:
+            return
+        self.write(self.path(bucketname, keyname, 'raw'), raw)
+        if df is not None:
+            self.write(self.path(bucketname, keyname, 'pkl'), pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+        else:
+            self.remove(self.path(bucketname, keyname, 'pkl'))
+        self.write(self.path(bucketname, keyname, 'json'), json.dumps({'etag': etag, 'size': len(raw)}).encode())
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        # Whole entries go, oldest used first
+        with self.lock:
+            entries = {}
+            for name in os.listdir(self.dirname):
+                path = os.path.join(self.dirname, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entry = entries.setdefault(name.split('.')[0], {'mtime': 0, 'size': 0, 'paths': []})
+                entry['mtime'] = max(entry['mtime'], stat.st_mtime)
+                entry['size'] += stat.st_size
+                entry['paths'].append(path)
+            total = sum(e['size'] for e in entries.values())
+            for entry in sorted(entries.values(), key=lambda e: e['mtime']):
+                if total <= self.maxbytes:
+                    break
+                for path in entry['paths']:
+                    self.remove(path)
+                total -= entry['size']
+
+    def get_frame(self, s3, bucketname, keyname, parse):
+        # The parsed object, from the cache if S3 still holds the same version
+        entry = self.lookup(bucketname, keyname)
+        kwargs = {}
+        if entry is not None:
+            kwargs['IfNoneMatch'] = entry['etag']
+        try:
+            obj = s3.get_object(Bucket=bucketname,Key=keyname,**kwargs)
+        except botocore.exceptions.ClientError as err:
+            if (entry is None) or (err.response.get('Error', {}).get('Code') not in ('304', 'NotModified')):
+                raise
+            df = self.read_entry(bucketname, keyname, parse)
+            if df is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.bytes_saved += entry['size']
+                return df
+            obj = s3.get_object(Bucket=bucketname,Key=keyname)
+        raw = obj['Body'].read()
+        df = parse(io.BytesIO(raw))
+        with self.lock:
+            self.misses += 1
+        try:
+            self.store(bucketname, keyname, obj.get('ETag'), raw, df)
+        except OSError:
+            pass
+        return df
+
+    def read_entry(self, bucketname, keyname, parse):
+        try:
+            with open(self.path(bucketname, keyname, 'pkl'), 'rb') as f:
+                df = pickle.load(f)
+        except FileNotFoundError:
+            # Written through from a push, so only the raw bytes are held
+            try:
+                with open(self.path(bucketname, keyname, 'raw'), 'rb') as f:
+                    raw = f.read()
+            except FileNotFoundError:
+                return None
+            df = parse(io.BytesIO(raw))
+            self.write(self.path(bucketname, keyname, 'pkl'), pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+            self.evict()
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        for ext in ('json', 'raw', 'pkl'):
+            try:
+                os.utime(self.path(bucketname, keyname, ext))
+            except FileNotFoundError:
+                pass
+        return df
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes_saved': self.bytes_saved}
 
-def get_s3_csv_or_empty_df(s3, bucketname, keyname, columns):
+frame_cache = S3_frame_cache(os.getenv('S3_FRAME_CACHE_DIR', '/tmp/s3-frame-cache'), int(os.getenv('S3_FRAME_CACHE_BYTES', 200*1024*1024)))
+
+# Error values openpyxl returns as text, which pandas.read_excel reads as missing
+EXCEL_ERRORS = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+
+# How far down a sheet to look for its header row, the ONS and NISRA sheets having up to a dozen rows of titles and notes
+HEADER_SNIFF_ROWS = 20
+
+def normalise_name(name):
+    return ' '.join(str(name).split())
+
+def match_header(row, signature):
+    # Whether a row names every column in signature, either as the whole cell or the start of it,
+    # so footnote markers and units after a name don't stop it matching. Spacing is ignored
+    names = [normalise_name(v) for v in row]
+    return all(any(n.startswith(normalise_name(s)) for n in names) for s in signature)
+
+def find_header_row(rows, signature, description='the sheet'):
+    # The index of the first of rows matching signature
+    for i, row in enumerate(rows):
+        if match_header(row, signature):
+            return i
+    raise ValueError('No header row naming %s in the first %d rows of %s' %(signature, len(rows), description))
+
+class Workbook:
+    # An xlsx file opened once in openpyxl's read-only mode, with each sheet parsed the first time
+    # it is asked for. Parsed columns are kept, so later callers wanting the same ones skip the XML.
+    # Opened from S3, a sheet is read from its snapshot if the converter has written one, and the
+    # xlsx is only fetched for sheets which have none
+    def __init__(self, data=None):
+        if hasattr(data, 'getvalue'):
+            data = data.getvalue()
+        elif hasattr(data, 'read'):
+            data = data.read()
+        self.data = data
+        self.book = None
+        self.frames = {}
+        self.heads = {}
+        self.s3 = None
+        self.bucketname = None
+        self.keyname = None
+        self.snapshots = 0
+
+    @classmethod
+    def from_s3(cls, s3, bucketname, keyname):
+        workbook = cls()
+        workbook.s3 = s3
+        workbook.bucketname = bucketname
+        workbook.keyname = keyname
+        return workbook
+
+    def open(self):
+        if self.book is None:
+            if self.data is None:
+                self.data = self.s3.get_object(Bucket=self.bucketname,Key=self.keyname)['Body'].read()
+            self.book = openpyxl.load_workbook(io.BytesIO(self.data), read_only=True, data_only=True, keep_links=False)
+        return self.book
+
+    def close(self):
+        if self.book is not None:
+            self.book.close()
+            self.book = None
+
+    @property
+    def sheetnames(self):
+        return self.open().sheetnames
+
+    def cells(self, sheet_name, nrows=None, keep=None):
+        # Cell values converted as pandas.read_excel does, with trailing empty cells and rows dropped,
+        # and only the columns at the indexes in keep, if given
+        sheet = self.open()[sheet_name]
+        sheet.reset_dimensions()
+        data = []
+        last = -1
+        for row in sheet.iter_rows(values_only=True):
+            values = [self.convert(v) for v in row]
+            while (len(values) > 0) and (values[-1] == ''):
+                values.pop()
+            if len(values) > 0:
+                last = len(data)
+                if keep is not None:
+                    kept = [values[i] if i < len(values) else '' for i in keep]
+                    # A row with values only in other columns is still a row to read_excel
+                    if (len(kept) > 0) and all(v == '' for v in kept):
+                        kept[0] = numpy.nan
+                    values = kept
+            data.append(values)
+            if (nrows is not None) and (len(data) >= nrows):
+                break
+        data = data[:last + 1]
+        if len(data) > 0:
+            width = max(len(r) for r in data)
+            data = [r + [''] * (width - len(r)) for r in data]
+        return data
+
+    @staticmethod
+    def convert(value):
+        if value is None:
+            return ''
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str) and (value in EXCEL_ERRORS):
+            return numpy.nan
+        return value
+
+    def head(self, sheet_name, nrows):
+        # The top rows of a sheet, read once for however many callers look at them
+        cached = self.heads.get(sheet_name)
+        if (cached is None) or (cached[0] < nrows):
+            cached = (nrows, self.cells(sheet_name, nrows=nrows))
+            self.heads[sheet_name] = cached
+        return cached[1][:nrows]
+
+    def find_header(self, sheet_name, signature, nrows=HEADER_SNIFF_ROWS):
+        # The index of the header row, found by its column names rather than assumed
+        return find_header_row(self.head(sheet_name, nrows), signature, sheet_name)
+
+    def snapshot(self, sheet_name, header):
+        # The whole sheet as written by convert_workbook, kept as if parsed here, or None if there
+        # is no snapshot of it
+        if self.s3 is None:
+            return None
+        try:
+            df = frame_cache.get_frame(self.s3, self.bucketname, snapshot_keyname(self.keyname, sheet_name, header), pandas.read_parquet)
+        except Exception as err:
+            # Anything stopping the snapshot being read, such as no Parquet engine, leaves the sheet
+            # to be parsed from the workbook
+            if not is_missing_key(err):
+                print('Not reading the snapshot of sheet %s of %s: %s' %(sheet_name, self.keyname, repr(err)))
+            return None
+        self.snapshots += 1
+        self.frames[(sheet_name, header_token(header))] = (None, df)
+        return df
+
+    def sheet(self, sheet_name, header=0, usecols=None):
+        # A copy of the sheet, or of just the columns in usecols. The header is either the index of
+        # the header row, or a signature (a list of column names) to find it among the top rows by
+        key = (sheet_name, header_token(header))
+        cached = self.frames.get(key)
+        if (cached is not None) and ((usecols is None and cached[0] is None) or (usecols is not None and set(usecols) <= set(cached[1].columns))):
+            df = cached[1]
+        elif (cached is None) and (self.snapshot(sheet_name, header) is not None):
+            df = self.frames[key][1]
+        else:
+            if not isinstance(header, int):
+                header = self.find_header(sheet_name, header)
+            columns = None
+            if (usecols is not None) and ((cached is None) or (cached[0] is not None)):
+                columns = list(usecols) + [c for c in ([] if cached is None else cached[1].columns) if c not in usecols]
+            keep = None
+            if columns is not None:
+                # Only the wanted columns are kept while walking the sheet, if the header names them plainly
+                names = [str(v) for v in self.head(sheet_name, header + 1)[header]]
+                keep = [i for i, name in enumerate(names) if name in columns]
+                if (len(set(names[i] for i in keep)) != len(keep)) or (set(names[i] for i in keep) != set(columns)):
+                    keep = None
+            df = TextParser(self.cells(sheet_name, keep=keep), header=header, usecols=columns if keep is None else None).read()
+            self.frames[key] = (columns, df)
+        if usecols is not None:
+            return df[list(usecols)].copy()
+        return df.copy()
+
+def header_token(header):
+    # Header rows given by index appear as the index, those found by column names by a digest of them
+    if isinstance(header, int):
+        return '%d' %header
+    return 'h%s' %hashlib.sha1('\n'.join(header).encode()).hexdigest()[:12]
+
+def snapshot_keyname(keyname, sheet_name, header=0):
+    return '%s.sheets/%s.%s.parquet' %(keyname, sheet_name, header_token(header))
+
+# Sheets to snapshot from the files landed by each scraper source, with the header each consumer reads them by
+SNAPSHOT_SHEETS = {
+    'dd': [
+        ('Tests', 0),
+        ('Summary Tests', 0),
+        ('Deaths', 0),
+        ('Admissions', 0),
+        ('Discharges', 0),
+        ('Inpatients', 0),
+        ('ICU', 0),
+        ('Individuals 7 Days - 5yr Age', 0),
+    ],
+    'hospital': [
+        ('Admissions', 0),
+        ('Discharges', 0),
+        ('Inpatients', 0),
+    ],
+    'nisra': [
+        ('Table 7', ['Week Ending', 'Total']),
+    ],
+    'ons': [
+        ('1h', ['95% Lower confidence/credible interval for percentage']),
+        ('1i', ['95% Lower credible interval for percentage']),
+    ],
+}
+
+def convert_workbook(s3, bucketname, keyname, sheets):
+    # Writes a Parquet snapshot of each sheet next to the workbook, returning the keys written.
+    # Sheets which are missing, or hold values Parquet can't type, are left to be read from the xlsx
+    workbook = Workbook(s3.get_object(Bucket=bucketname,Key=keyname)['Body'].read())
+    written = []
     try:
-        obj = s3.get_object(Bucket=bucketname,Key=keyname)['Body']
+        for sheet_name, header in sheets:
+            try:
+                df = workbook.sheet(sheet_name, header=header)
+                stream = io.BytesIO()
+                df.to_parquet(stream, index=False, compression='zstd')
+            except (KeyError, ValueError, TypeError) as e:
+                print('Not converting sheet %s of %s: %s' %(sheet_name, keyname, repr(e)))
+                continue
+            s3.put_object(Bucket=bucketname, Key=snapshot_keyname(keyname, sheet_name, header), Body=stream.getvalue())
+            written.append(snapshot_keyname(keyname, sheet_name, header))
+    finally:
+        workbook.close()
+    return written
+
+def _report_worker(conn, parse):
+    # Parses the items sent down the pipe until told to stop, answering each with (ok, result)
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        try:
+            conn.send((True, parse(item)))
+        except Exception as e:
+            conn.send((False, '%s\n%s' %(repr(e), traceback.format_exc())))
+    conn.close()
+
+def parse_reports(items, parse, workers=None):
+    # parse(item) for each item, spread over forked worker processes, each fed one item at a time
+    # down its own pipe. Pools and queues need semaphores, which Lambda has no /dev/shm for, but
+    # plain processes and pipes work there. The parse function is inherited, not pickled
+    workers = min(os.cpu_count() if workers is None else workers, len(items))
+    if workers <= 1:
+        return [parse(item) for item in items]
+    context = multiprocessing.get_context('fork')
+    pool = []
+    for i in range(workers):
+        ours, theirs = context.Pipe()
+        process = context.Process(target=_report_worker, args=(theirs, parse), daemon=True)
+        process.start()
+        theirs.close()
+        pool.append((process, ours))
+    results = [None] * len(items)
+    pending = {}
+    queue = list(enumerate(items))
+    try:
+        # Each worker is sent its next item as soon as it answers the last
+        for process, conn in pool:
+            if len(queue) > 0:
+                pending[conn] = queue.pop(0)
+                conn.send(pending[conn][1])
+        while len(pending) > 0:
+            for conn in multiprocessing.connection.wait(list(pending)):
+                i, item = pending.pop(conn)
+                ok, result = conn.recv()
+                if not ok:
+                    raise ValueError('Failed to parse %s: %s' %(item, result))
+                results[i] = result
+                if len(queue) > 0:
+                    pending[conn] = queue.pop(0)
+                    conn.send(pending[conn][1])
+    finally:
+        for process, conn in pool:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for process, conn in pool:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+    return results
+
+# Column types of each datastore. Counts which older reports can leave blank are floats
+DATASTORE_SCHEMAS = {
+    'doh-dd-tests': {
+        'dates': ['Sample_Date', 'Reported_Date'],
+        'columns': {
+            'Total Tests': 'int64',
+            'Total Cases': 'int64',
+        },
+    },
+    'doh-dd-agebands': {
+        'dates': ['Date'],
+        'columns': {
+            'Age_Band_5yr': 'category',
+            'Total_Cases': 'int64',
+            'Total_Tests': 'int64',
+            'Positivity_Rate': 'float64',
+            'Band Start': 'float64',
+            'Band End': 'float64',
+            'Positive_Tests': 'int64',
+        },
+    },
+    'vaccine-doses': {
+        'dates': ['Date'],
+        'columns': {
+            'Dose': 'category',
+            'Total': 'int64',
+        },
+        'categories': {
+            'Dose': ['Dose 1', 'Dose 2', 'Dose 3', 'Booster', 'Spring 2023 Booster'],
+        },
+    },
+    'vaccine-agebands': {
+        'dates': ['Date'],
+        'columns': {
+            'Band': 'category',
+            'Order': 'int64',
+            'First Doses': 'float64',
+            'Second Doses': 'float64',
+            'Third Doses': 'float64',
+            'Booster Doses': 'float64',
+            'Population': 'int64',
+            '% of total population': 'float64',
+        },
+    },
+    'vaccine-postcodes': {
+        'dates': ['Date'],
+        'columns': {
+            'Postcode District': 'category',
+            'Vaccinations': 'int64',
+            'Population': 'float64',
+            'Population over 20': 'float64',
+            'Council Area': 'category',
+            'Vaccinations per Person': 'float64',
+            'Vaccinations per Person over 20': 'float64',
+            'Potential vaccinations': 'float64',
+        },
+    },
+}
+
+def get_schema(schema):
+    # Schemas are passed by name, or as a dict laid out as in DATASTORE_SCHEMAS
+    if isinstance(schema, str):
+        return DATASTORE_SCHEMAS[schema]
+    return schema
+
+def schema_dtype(schema, column):
+    if column in schema.get('categories', {}):
+        return pandas.CategoricalDtype(schema['categories'][column])
+    return schema['columns'][column]
+
+def apply_schema(df, schema, strict=True):
+    # Cast to the schema, only touching columns that differ. Data being written must match it
+    # exactly (strict), data being read keeps whatever a column held before the schema
+    if strict is True:
+        missing = [c for c in schema['dates'] + list(schema['columns']) if c not in df.columns]
+        extra = [c for c in df.columns if (c not in schema['dates']) and (c not in schema['columns'])]
+        if (len(missing) > 0) or (len(extra) > 0):
+            raise ValueError('Datastore columns do not match schema, missing %s, unexpected %s' %(missing, extra))
+    for column in schema['dates']:
+        if (column in df.columns) and (not pandas.api.types.is_datetime64_any_dtype(df[column])):
+            df[column] = pandas.to_datetime(df[column])
+    for column in schema['columns']:
+        if column not in df.columns:
+            continue
+        dtype = schema_dtype(schema, column)
+        if isinstance(dtype, pandas.CategoricalDtype):
+            unknown = sorted(set(df[column].dropna()) - set(dtype.categories))
+            if len(unknown) > 0:
+                if strict is True:
+                    raise ValueError('Datastore column %s has unknown values %s' %(column, unknown))
+                dtype = pandas.CategoricalDtype(list(dtype.categories) + unknown)
+            if df[column].dtype != dtype:
+                df[column] = df[column].astype(dtype)
+        elif (dtype == 'category') and isinstance(df[column].dtype, pandas.CategoricalDtype):
+            continue
+        elif df[column].dtype != dtype:
+            try:
+                df[column] = df[column].astype(dtype)
+            except (ValueError, TypeError) as err:
+                if strict is True:
+                    raise ValueError('Datastore column %s cannot be stored as %s: %s' %(column, dtype, err))
+    return df
+
+def concat_frames(frames, schema=None, **kwargs):
+    # Categoricals only stay categorical through a concat if every frame has the same levels
+    if schema is not None:
+        for column in schema['columns']:
+            if schema['columns'][column] != 'category':
+                continue
+            levels = set()
+            for f in frames:
+                if column in f.columns:
+                    values = f[column].cat.categories if isinstance(f[column].dtype, pandas.CategoricalDtype) else f[column].dropna().unique()
+                    levels.update(values)
+            dtype = pandas.CategoricalDtype(sorted(levels))
+            if column in schema.get('categories', {}):
+                dtype = pandas.CategoricalDtype(schema['categories'][column] + sorted(levels - set(schema['categories'][column])))
+            frames = [
+                f.assign(**{column: f[column].astype(dtype)}) if (column in f.columns) and (f[column].dtype != dtype) else f
+                for f in frames
+            ]
+    return pandas.concat(frames, **kwargs)
+
+def read_csv_with_schema(stream, schema):
+    # Dates are parsed and every other column read straight into its type, rather than inferred
+    dtypes = dict((c, schema_dtype(schema, c)) for c in schema['columns'])
+    header = pandas.read_csv(stream, nrows=0).columns
+    stream.seek(0)
+    try:
+        df = pandas.read_csv(stream, dtype=dict((c, d) for c, d in dtypes.items() if c in header), parse_dates=[c for c in schema['dates'] if c in header])
+    except ValueError:
+        # An integer column with blanks in older rows, so those are left to be inferred
+        stream.seek(0)
+        df = pandas.read_csv(stream, dtype=dict((c, d) for c, d in dtypes.items() if (c in header) and (d != 'int64')), parse_dates=[c for c in schema['dates'] if c in header])
+    return apply_schema(df, schema, strict=False)
+
+def get_s3_csv_or_empty_df(s3, bucketname, keyname, columns, schema=None):
+    parse = pandas.read_csv if schema is None else (lambda stream: read_csv_with_schema(stream, schema))
+    try:
+        df = frame_cache.get_frame(s3, bucketname, keyname, parse)
     except s3.exceptions.NoSuchKey:
         print("The object %s does not exist in bucket %s." %(keyname, bucketname))
-        return pandas.DataFrame(columns=columns)
-    else:
-        stream = io.BytesIO(obj.read())
-        return pandas.read_csv(stream)
+        df = pandas.DataFrame(columns=columns)
+    if schema is not None:
+        # A cached frame may have been parsed before the schema changed
+        df = apply_schema(df, schema, strict=False)
+    return df
 
 def push_csv_to_s3(df, s3, bucketname, keyname):
-    # Push the data to s3
+    # Push the data to s3, keeping the bytes for the next read
     stream = io.BytesIO()
     df.to_csv(stream, index=False)
-    stream.seek(0)
-    s3.upload_fileobj(stream, bucketname, keyname)
+    resp = s3.put_object(Bucket=bucketname, Key=keyname, Body=stream.getvalue())
+    try:
+        frame_cache.store(bucketname, keyname, resp.get('ETag'), stream.getvalue())
+    except OSError:
+        pass
+
+def datastore_keyname(dirname, name, partitioned=False):
+    # Partitioned stores are a prefix, CSV stores a single file
+    if partitioned is True:
+        return '%s/%s' %(dirname, name)
+    return '%s/%s.csv' %(dirname, name)
+
+def partition_keyname(prefix, datecol, date, token=None):
+    # Partitions written by a commit carry its token, those written in bulk (by migration) don't
+    if token is None:
+        return '%s/%s=%s/part.parquet' %(prefix, datecol, date.isoformat())
+    return '%s/%s=%s/part-%s.parquet' %(prefix, datecol, date.isoformat(), token)
+
+def manifest_keyname(prefix):
+    # The partition to read for each date written by a commit, as {date: key}
+    return '%s/partitions.json' %prefix
+
+def segment_keyname(prefix, datecol, month, last, generation):
+    # Cold segments hold a month each, named for the last date they hold and a generation bumped by
+    # every rewrite, so a rewrite never overwrites the segment being read
+    return '%s/%s=%s/segment-%s-%d.parquet' %(prefix, datecol, month.strftime('%Y-%m'), last.isoformat(), generation)
+
+def segment_generation(key):
+    # Segments written before generations were added count as the first
+    m = re.search(r'/segment-\d{4}-\d{2}-\d{2}-(\d+)\.parquet$', key)
+    return 0 if m is None else int(m.group(1))
+
+def list_datastore(s3, bucketname, prefix, datecol, published=True):
+    # Daily partitions (date, key, size) and cold segments (month, last date, key, size), oldest
+    # first, with each month's segments in the order they were written. Unless asked for every
+    # partition, there is one per date: the one in the manifest, or else the one without a token
+    partpattern = re.compile(r'/%s=(\d{4}-\d{2}-\d{2})/part(?:-[0-9a-f]+)?\.parquet$' %re.escape(datecol))
+    segpattern = re.compile(r'/%s=(\d{4}-\d{2})/segment-(\d{4}-\d{2}-\d{2})(?:-\d+)?\.parquet$' %re.escape(datecol))
+    partitions = []
+    segments = []
+    kwargs = {'Bucket': bucketname, 'Prefix': '%s/%s=' %(prefix, datecol)}
+    while True:
+        resp = s3.list_objects_v2(**kwargs)
+        for obj in resp.get('Contents', []):
+            m = partpattern.search(obj['Key'])
+            if m is not None:
+                partitions.append((datetime.date.fromisoformat(m.group(1)), obj['Key'], obj.get('Size', 0)))
+                continue
+            m = segpattern.search(obj['Key'])
+            if m is not None:
+                segments.append((datetime.date.fromisoformat(m.group(1) + '-01'), datetime.date.fromisoformat(m.group(2)), obj['Key'], obj.get('Size', 0)))
+        if resp.get('IsTruncated') is not True:
+            break
+        kwargs['ContinuationToken'] = resp['NextContinuationToken']
+    if published is True:
+        manifest = S3_scraper_index(s3, bucketname, manifest_keyname(prefix), key='date').get_dict() or {}
+        listed = set(key for date, key, size in partitions)
+        partitions = [
+            (date, key, size) for date, key, size in partitions
+            if key == (manifest[date.isoformat()] if manifest.get(date.isoformat()) in listed else partition_keyname(prefix, datecol, date))
+        ]
+    return sorted(partitions), sorted(segments, key=lambda s: (s[0], segment_generation(s[2]), s[1]))
+
+def current_segments(segments):
+    # Only the latest segment for each month is read, any other is left over from a rewrite
+    latest = {}
+    for segment in segments:
+        latest[segment[0]] = segment
+    return [latest[month] for month in sorted(latest)]
 
-def update_datastore(s3, bucketname, keyname, last_updated, df, store, datecol='Date'):
-    # Pull current data from s3, or empty dataframe
+def read_partitions(s3, bucketname, keys, workers=8):
+    def read(key):
+        return frame_cache.get_frame(s3, bucketname, key, pandas.read_parquet)
+    if len(keys) <= 1:
+        return [read(key) for key in keys]
+    with ThreadPoolExecutor(max_workers=min(workers, len(keys))) as executor:
+        return list(executor.map(read, keys))
+
+def get_partitioned_datastore(s3, bucketname, prefix, datecol='Date', start=None, end=None, exclude=(), schema=None):
+    # Read only the partitions and segments with dates in [start, end]
+    partitions, segments = list_datastore(s3, bucketname, prefix, datecol)
+    keys = [
+        key for date, key, size in partitions
+        if ((start is None) or (date >= start)) and ((end is None) or (date <= end)) and (date not in exclude)
+    ]
+    segkeys = [
+        key for month, last, key, size in current_segments(segments)
+        if ((start is None) or (last >= start)) and ((end is None) or (month <= end))
+    ]
+    frames = read_partitions(s3, bucketname, keys + segkeys)
+    # A daily partition takes precedence over a segment holding the same date
+    daily = set(date for date, key, size in partitions)
+    for i in range(len(keys), len(frames)):
+        dates = pandas.to_datetime(frames[i][datecol]).dt.date
+        keep = ~dates.isin(daily | set(exclude))
+        if start is not None:
+            keep &= (dates >= start)
+        if end is not None:
+            keep &= (dates <= end)
+        frames[i] = frames[i][keep]
+    if len(frames) == 0:
+        frames = [pandas.DataFrame(columns=[datecol])]
+    if schema is not None:
+        frames = [apply_schema(f, schema, strict=False) for f in frames]
+    return concat_frames(frames, schema, ignore_index=True)
+
+def push_partitions_to_s3(df, s3, bucketname, prefix, datecol='Date', token=None):
+    # Write the partition for every date in the data, returning their keys by date
+    keys = {}
+    for date, part in df.groupby(df[datecol].dt.date):
+        stream = io.BytesIO()
+        part.to_parquet(stream, index=False)
+        keys[date] = partition_keyname(prefix, datecol, date, token)
+        s3.put_object(Bucket=bucketname, Key=keys[date], Body=stream.getvalue())
+    return keys
+
+def migrate_csv_datastore(s3, bucketname, keyname, prefix, datecol='Date'):
+    # Split an existing CSV store into one partition per date
     datastore = get_s3_csv_or_empty_df(s3, bucketname, keyname, [datecol])
-    # Clean out any data with matching dates
-    datastore = datastore[pandas.to_datetime(datastore[datecol]).dt.date != last_updated.date()]
-    # Append the new data
-    datastore = pandas.concat([datastore, df])
-    datastore[datecol] = datastore[datecol].fillna(last_updated)
     datastore[datecol] = pandas.to_datetime(datastore[datecol])
-    # Push the data to s3
-    if store is True:
-        push_csv_to_s3(datastore, s3, bucketname, keyname)
+    push_partitions_to_s3(datastore, s3, bucketname, prefix, datecol)
+    return datastore[datecol].dt.date.nunique()
+
+def compact_datastore(s3, bucketname, prefix, datecol='Date', hot_days=42, max_bytes=None, today=None):
+    # Fold daily partitions older than the hot window into monthly segments, then drop the oldest segments over the budget
+    if today is None:
+        today = datetime.date.today()
+    cutoff = today - datetime.timedelta(days=hot_days)
+    partitions, segments = list_datastore(s3, bucketname, prefix, datecol)
+    every = list_datastore(s3, bucketname, prefix, datecol, published=False)[0]
+    before = sum(p[2] for p in every) + sum(s[3] for s in segments)
+    current = dict((s[0], s) for s in current_segments(segments))
+    cold = {}
+    for date, key, size in partitions:
+        if date < cutoff:
+            cold.setdefault(date.replace(day=1), []).append((date, key))
+    for month in sorted(cold):
+        dates = set(date for date, key in cold[month])
+        frames = read_partitions(s3, bucketname, [key for date, key in cold[month]])
+        if month in current:
+            existing = read_partitions(s3, bucketname, [current[month][2]])[0]
+            frames.insert(0, existing[~pandas.to_datetime(existing[datecol]).dt.date.isin(dates)])
+        segment = pandas.concat(frames, ignore_index=True)
+        segment[datecol] = pandas.to_datetime(segment[datecol])
+        segment = segment.sort_values(datecol, kind='mergesort').reset_index(drop=True)
+        stream = io.BytesIO()
+        segment.to_parquet(stream, index=False, compression='zstd')
+        generation = (segment_generation(current[month][2]) + 1) if month in current else 0
+        keyname = segment_keyname(prefix, datecol, month, segment[datecol].max().date(), generation)
+        s3.put_object(Bucket=bucketname, Key=keyname, Body=stream.getvalue())
+        # The partitions go only once the segment holding them is written, along with any left
+        # over from commits which were superseded or never published
+        for date, key, size in every:
+            if date in dates:
+                s3.delete_object(Bucket=bucketname, Key=key)
+    # Clear out segments superseded by a rewrite, here or in an earlier run
+    partitions, segments = list_datastore(s3, bucketname, prefix, datecol)
+    latest = current_segments(segments)
+    for segment in segments:
+        if segment not in latest:
+            s3.delete_object(Bucket=bucketname, Key=segment[2])
+    # Oldest segments are dropped first, the hot window is always kept
+    total = sum(p[2] for p in partitions) + sum(s[3] for s in latest)
+    dropped = []
+    for month, last, key, size in latest:
+        if (max_bytes is None) or (total <= max_bytes):
+            break
+        s3.delete_object(Bucket=bucketname, Key=key)
+        total -= size
+        dropped.append(month.strftime('%Y-%m'))
+    return {
+        'prefix': prefix,
+        'partitions_compacted': sum(len(v) for v in cold.values()),
+        'segments_written': len(cold),
+        'segments_dropped': dropped,
+        'bytes_before': before,
+        'bytes_after': total,
+    }
+
+class S3_datastore:
+    # Reads a datastore once, applies any number of per-date replacements in memory and writes them back on commit
+    def __init__(self, s3, bucketname, keyname, datecol='Date', schema=None):
+        self.s3 = s3
+        self.bucketname = bucketname
+        self.keyname = keyname
+        self.datecol = datecol
+        self.schema = None if schema is None else get_schema(schema)
+        # Keys without a .csv extension are partitioned stores
+        self.partitioned = not keyname.endswith('.csv')
+        self.data = None
+        self.start = None
+        self.pending = {}
+        self.dirty = False
+
+    def load(self, start=None):
+        # The stored contents as they will be after commit, read back as far as start for partitioned stores
+        if not self.partitioned:
+            if self.data is None:
+                self.data = get_s3_csv_or_empty_df(self.s3, self.bucketname, self.keyname, [self.datecol], self.schema)
+            return self.data
+        if self.data is None:
+            frames = [get_partitioned_datastore(self.s3, self.bucketname, self.keyname, self.datecol, start, exclude=set(self.pending), schema=self.schema)]
+            self.data = concat_frames(frames + list(self.pending.values()), self.schema, ignore_index=True)
+            self.start = start
+        elif (self.start is not None) and ((start is None) or (start < self.start)):
+            # Only the partitions older than those already held are read
+            older = get_partitioned_datastore(self.s3, self.bucketname, self.keyname, self.datecol, start, self.start - datetime.timedelta(days=1), set(self.pending), self.schema)
+            self.data = concat_frames([older, self.data], self.schema, ignore_index=True)
+            self.start = start
+        self.data[self.datecol] = pandas.to_datetime(self.data[self.datecol])
+        return self.data
+
+    def prepare(self, last_updated, df):
+        # Date the new data, and check it against the schema before it goes anywhere near the store
+        df = df.copy()
+        df[self.datecol] = pandas.to_datetime(df[self.datecol].fillna(last_updated) if self.datecol in df.columns else last_updated)
+        if self.schema is not None:
+            df = apply_schema(df, self.schema)
+        return df
+
+    def update(self, last_updated, df, store, history=None):
+        # Replace the data for a date, returning the datastore as seen by the caller
+        if not self.partitioned:
+            datastore = self.load()
+            if self.schema is None:
+                # Clean out any data with matching dates
+                datastore = datastore[pandas.to_datetime(datastore[self.datecol]).dt.date != last_updated.date()]
+                # Append the new data
+                datastore = pandas.concat([datastore, df])
+                datastore[self.datecol] = datastore[self.datecol].fillna(last_updated)
+                datastore[self.datecol] = pandas.to_datetime(datastore[self.datecol])
+            else:
+                # The date column is already typed, so needs no parsing to compare
+                datastore = datastore[datastore[self.datecol].dt.normalize() != pandas.Timestamp(last_updated.date())]
+                datastore = concat_frames([datastore, self.prepare(last_updated, df)], self.schema)
+            if store is True:
+                self.data = datastore
+                self.dirty = True
+            return datastore
+        df = self.prepare(last_updated, df)
+        dates = set(df[self.datecol].dt.date)
+        if store is True:
+            if self.data is not None:
+                self.data = concat_frames([self.data[~self.data[self.datecol].dt.date.isin(dates)], df], self.schema, ignore_index=True)
+            for date, part in df.groupby(df[self.datecol].dt.date):
+                self.pending[date] = part
+        if history == 0:
+            return df
+        # Only the partitions still needed by the caller are read back
+        start = None if history is None else (last_updated - datetime.timedelta(days=history)).date()
+        datastore = self.load(start)
+        datastore = datastore[~datastore[self.datecol].dt.date.isin(dates)]
+        if start is not None:
+            datastore = datastore[datastore[self.datecol].dt.date >= start]
+        datastore = concat_frames([datastore, df], self.schema, ignore_index=True)
+        datastore[self.datecol] = pandas.to_datetime(datastore[self.datecol])
+        return datastore
+
+    def commit(self):
+        # Nothing is written until here, so a failure part way through a batch leaves the store untouched.
+        # Partitions are written under keys new to this commit, which readers ignore until the
+        # manifest pointing at them all is written by a single put
+        if self.partitioned:
+            if len(self.pending) == 0:
+                return 0
+            token = uuid.uuid4().hex[:16]
+            keys = {}
+            for date in sorted(self.pending):
+                keys.update(push_partitions_to_s3(self.pending[date], self.s3, self.bucketname, self.keyname, self.datecol, token))
+            manifest = S3_scraper_index(self.s3, self.bucketname, manifest_keyname(self.keyname), key='date')
+            entries = manifest.get_dict() or {}
+            entries.update((date.isoformat(), key) for date, key in keys.items())
+            manifest.put_dict(entries)
+            written = len(self.pending)
+            self.pending = {}
+            return written
+        if self.dirty is True:
+            push_csv_to_s3(self.data, self.s3, self.bucketname, self.keyname)
+            self.dirty = False
+            return 1
+        return 0
+
+def update_datastore(s3, bucketname, keyname, last_updated, df, store, datecol='Date', history=None, schema=None):
+    # A single update, committed straight away
+    transaction = S3_datastore(s3, bucketname, keyname, datecol, schema)
+    datastore = transaction.update(last_updated, df, store, history)
+    transaction.commit()
     return datastore
+
+class VintagePanel:
+    # The values of each specimen date as given by each report, held as a 2-D array per value with
+    # the reports as rows, oldest first, and every day from the first specimen date to the last as
+    # columns. Dates missing from a report are NaN, and the values are held as floats
+    def __init__(self, df, values=None, reportcol='Reported_Date', datecol='Date of Specimen'):
+        if len(df) == 0:
+            raise ValueError('No reports to build a panel from')
+        self.reportcol = reportcol
+        self.datecol = datecol
+        self.values = [c for c in df.columns if c not in (reportcol, datecol)] if values is None else list(values)
+        reports = pandas.to_datetime(df[reportcol]).to_numpy().astype('datetime64[D]')
+        dates = pandas.to_datetime(df[datecol]).to_numpy().astype('datetime64[D]')
+        self.reports, rows = numpy.unique(reports, return_inverse=True)
+        self.dates = numpy.arange(dates.min(), dates.max() + numpy.timedelta64(1, 'D'))
+        cols = (dates - self.dates[0]).astype(int)
+        self.present = numpy.zeros((len(self.reports), len(self.dates)), dtype=bool)
+        self.present[rows, cols] = True
+        self.arrays = {}
+        for value in self.values:
+            array = numpy.zeros(self.present.shape)
+            # A date given more than once by a report is summed, as grouping by report and date would
+            numpy.add.at(array, (rows, cols), pandas.to_numeric(df[value]).to_numpy(dtype=float))
+            array[~self.present] = numpy.nan
+            self.arrays[value] = array
+        # The first and last specimen dates of each report, and the first report of each date
+        self.first = numpy.argmax(self.present, axis=1)
+        self.last = self.present.shape[1] - 1 - numpy.argmax(self.present[:, ::-1], axis=1)
+        self.earliest = numpy.argmax(self.present, axis=0)
+
+    def report_index(self, report):
+        # The row of the latest report made on or before report
+        i = numpy.searchsorted(self.reports, numpy.datetime64(pandas.to_datetime(report).date(), 'D'), side='right') - 1
+        if i < 0:
+            raise ValueError('No report on or before %s' %report)
+        return i
+
+    def frame(self, index, data, name):
+        return pandas.DataFrame(data, index=pandas.DatetimeIndex(index.astype('datetime64[ns]'), name=name))
+
+    def as_reported(self, report=None):
+        # Each specimen date as the report on or before report gave it (the latest if not given),
+        # with days it left out as zero
+        i = len(self.reports) - 1 if report is None else self.report_index(report)
+        span = slice(self.first[i], self.last[i] + 1)
+        return self.frame(self.dates[span], {v: numpy.nan_to_num(self.arrays[v][i, span]) for v in self.values}, self.datecol)
+
+    def newly_reported(self, start, end):
+        # The change in each specimen date between the reports on or before start and end
+        i, j = self.report_index(start), self.report_index(end)
+        span = self.present[i] | self.present[j]
+        return self.frame(self.dates[span], {v: numpy.nan_to_num(self.arrays[v][j, span]) - numpy.nan_to_num(self.arrays[v][i, span]) for v in self.values}, self.datecol)
+
+    def totals(self):
+        # The sum over all specimen dates of each report
+        return self.frame(self.reports, {v: numpy.nansum(self.arrays[v], axis=1) for v in self.values}, self.reportcol)
+
+    def new_per_report(self):
+        # The change in the total since the previous report, as the dashboard's new individuals
+        return self.totals().diff()
+
+    def last_24_hours(self):
+        # Each report's latest specimen date, being those tested in the 24 hours before it
+        rows = numpy.arange(len(self.reports))
+        return self.frame(self.reports, {v: self.arrays[v][rows, self.last] for v in self.values}, self.reportcol)
+
+    def relative(self, value):
+        # Each report's value of each date, over the value first reported for that date
+        first = self.arrays[value][self.earliest, numpy.arange(len(self.dates))]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self.arrays[value] / first
+
+    def revisions(self, value, relative=True, max_days=None):
+        # Specimen dates as rows and days since the test as columns, holding the value (or the ratio
+        # to the first report of the date) in the report made that many days after it
+        source = self.relative(value) if relative else self.arrays[value]
+        lags = (self.reports[:, None] - self.dates[None, :]).astype(int)
+        keep = self.present & (lags >= 0)
+        if max_days is not None:
+            keep &= (lags <= max_days)
+        rows, cols = numpy.nonzero(keep)
+        grid = numpy.full((len(self.dates), (lags[rows, cols].max() + 1) if len(rows) > 0 else 0), numpy.nan)
+        grid[cols, lags[rows, cols]] = source[rows, cols]
+        df = self.frame(self.dates, grid, self.datecol)
+        df.columns.name = 'Days since test'
+        return df
+
+    def to_frame(self):
+        # Back to one row per report and specimen date, ordered by report then date
+        rows, cols = numpy.nonzero(self.present)
+        df = pandas.DataFrame({
+            self.datecol: self.dates[cols].astype('datetime64[ns]'),
+            self.reportcol: self.reports[rows].astype('datetime64[ns]'),
+        })
+        for value in self.values:
+            df[value] = self.arrays[value][rows, cols]
+        return df
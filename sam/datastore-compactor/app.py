@@ -0,0 +1,41 @@
+import json
+import logging
+
+from shared import get_client
+from data_shared import compact_datastore
+
+def lambda_handler(event, context):
+    # Get the secret
+    sm = get_client('secretsmanager')
+    secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
+    secret = json.loads(secretobj['SecretString'])
+
+    s3 = get_client('s3')
+    # Each store is a dict holding its keyname, and optionally datecol, hot_days and max_bytes
+    stores = event.get('stores', secret.get('datastore-compaction', []))
+    results = []
+    for store in stores:
+        if store['keyname'].endswith('.csv'):
+            # CSV stores need migrating to partitions with the tests-cleaner first
+            results.append({'prefix': store['keyname'], 'skipped': 'not partitioned'})
+        else:
+            try:
+                results.append(compact_datastore(
+                    s3,
+                    secret['bucketname'],
+                    store['keyname'],
+                    store.get('datecol', 'Date'),
+                    int(store.get('hot_days', 42)),
+                    None if store.get('max_bytes') is None else int(store['max_bytes'])
+                ))
+            except:
+                logging.exception('Error compacting %s' %store['keyname'])
+                results.append({'prefix': store['keyname'], 'error': True})
+        print(json.dumps(results[-1]))
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "stores": results,
+        }),
+    }
@@ -2,14 +2,12 @@ import json
 import io
 import datetime
 
-import boto3
-
-from shared import S3_scraper_index
+from shared import S3_scraper_index, get_client
 from twitter_shared import TwitterAPI
 
 def lambda_handler(event, context):
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
@@ -1,18 +1,16 @@
 import json
-import io
 import datetime
 import os
 import logging
 
-import boto3
 import pandas
 import numpy
 import altair
 
-from shared import S3_scraper_index
+from shared import S3_scraper_index, open_report_history, get_client
 from twitter_shared import TwitterAPI
 from plot_shared import get_chrome_driver, plot_key_ni_stats_date_range, plot_points_average_and_trend, output_plot, plot_heatmap
-from data_shared import get_ni_pop_pyramid, update_datastore
+from data_shared import get_ni_pop_pyramid, update_datastore, Workbook
 
 good_symb = '\u2193'
 bad_symb = '\u2191'
@@ -59,8 +57,8 @@ def create_model(df, to_model, datekey):
     df['%s model_weekly_change' %to_model] = (fit_exp(df['%s model0'%to_model], df['%s model1'%to_model], 8) - fit_exp(df['%s model0'%to_model], df['%s model1'%to_model], 1)) / fit_exp(df['%s model0'%to_model], df['%s model1'%to_model], 1)
     return(df)
 
-def load_ni_time_series(url, sheet_name, date_col, series_col, model=False, filter_col=None, filter=None):
-    df = pandas.read_excel(url, engine='openpyxl', sheet_name=sheet_name)
+def load_ni_time_series(workbook, sheet_name, date_col, series_col, model=False, filter_col=None, filter=None):
+    df = workbook.sheet(sheet_name, usecols=[date_col, series_col] + ([] if filter_col is None else [filter_col]))
     if filter_col is not None:
         df = df[df[filter_col] == filter]
     # Clean up mix of numeric values in date column
@@ -126,33 +124,33 @@ def lambda_handler(event, context):
     messages = ['Failure']
 
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
     try:
-        # Get the index
-        s3 = boto3.client('s3')
+        # Get the report history, which holds the totals from earlier reports
+        s3 = get_client('s3')
         status = S3_scraper_index(s3, secret['bucketname'], secret['doh-hospital-index'])
-        index = status.get_dict()
+        history = open_report_history(status, ['admissions', 'discharges'])
 
         tweets = []
-        # Download the most recently updated Excel file
+        # Read the most recently updated Excel file, from its sheet snapshots where there are any
         for change in event:
-            obj = s3.get_object(Bucket=secret['bucketname'],Key=change['keyname'])['Body']
-            stream = io.BytesIO(obj.read())
+            workbook = Workbook.from_s3(s3, secret['bucketname'], change['keyname'])
 
             # Summary stats to allow 'X registered in last 24 hours' info
-            admissions = load_ni_time_series(stream,'Admissions','Admission Day','Number of Admissions',True)
+            admissions = load_ni_time_series(workbook,'Admissions','Admission Day','Number of Admissions',True)
             admissions.rename(columns={
                 'Admission Day': 'Admission Date',
                 }, inplace=True)
-            discharges = load_ni_time_series(stream,'Discharges','Discharge Date','Number of Admissions')
+            discharges = load_ni_time_series(workbook,'Discharges','Discharge Date','Number of Admissions')
             discharges.rename(columns={
                 'Number of Admissions': 'Number of Discharges',
                 'Number of Admissions 7-day rolling mean': 'Number of Discharges 7-day rolling mean',
                 }, inplace=True)
-            inpatients = load_ni_time_series(stream,'Inpatients','Admission Day','Occupancy',False,'Sex','All')
+            inpatients = load_ni_time_series(workbook,'Inpatients','Admission Day','Occupancy',False,'Sex','All')
+            workbook.close()
             inpatients.rename(columns={'Admission Day': 'Date', 'Occupancy': 'Number of Confirmed COVID Inpatients'}, inplace=True)
             totals = {
                 'admissions': int(admissions['Number of Admissions'].sum()),
@@ -177,25 +175,21 @@ def lambda_handler(event, context):
 
             # Build the tweet text
             last_week = datetime.datetime.strptime(change['filedate'],'%Y-%m-%d').date() - datetime.timedelta(days=7)
-            lastweek = None
-            for report in index:
-                if (report['filedate'] == last_week.strftime('%Y-%m-%d')) and ('totals' in report):
-                    lastweek = report
-                    break
+            lastweek = history.get(last_week.strftime('%Y-%m-%d'))
             tweet= '''{inpatients} inpatient{ips} reported on {date}'''.format(
                     date=inpatients['Date'].max().strftime('%A %-d %B %Y'),
                     inpatients=totals['admissions'] - totals['discharges'],
                     ips='s' if ((totals['admissions'] - totals['discharges']) != 1) else ''
             )
             if lastweek is not None:
-                ip_change = (totals['admissions'] - totals['discharges']) - (lastweek['totals']['admissions'] - lastweek['totals']['discharges'])
+                ip_change = (totals['admissions'] - totals['discharges']) - (lastweek['admissions'] - lastweek['discharges'])
                 tweet += ''':
 {ip_bullet} {ip_change} {ip_text} than 7 days ago ({admissions} admitted, {discharges} discharged)'''.format(
                     ip_change=abs(ip_change),
                     ip_bullet=good_symb if ip_change < 0 else bad_symb,
                     ip_text='fewer' if ip_change < 0 else 'more',
-                    admissions=totals['admissions'] - lastweek['totals']['admissions'],
-                    discharges=totals['discharges'] - lastweek['totals']['discharges']
+                    admissions=totals['admissions'] - lastweek['admissions'],
+                    discharges=totals['discharges'] - lastweek['discharges']
                 )
 
             tweet += '''
@@ -246,15 +240,11 @@ def lambda_handler(event, context):
                             resp = api.tweet(t['text'] + t['url'])
                         messages.append('Tweeted ID %s, ' %resp.id)
 
-                        # Update the file index
-                        for i in range(len(index)):
-                            if index[i]['filedate'] == t['filedate']:
-                                index[i]['tweet'] = resp.id
-                                index[i]['totals'] = t['totals']
-                                break
-                        status.put_dict(index)
+                        # Update the report history
+                        history.put(t['filedate'], t['totals'], resp.id)
+                        history.save()
 
-                        messages[-1] += ('updated %s' %secret['doh-hospital-index'])
+                        messages[-1] += ('updated %s' %history.keyname)
                     else:
                         if len(upload_ids) > 0:
                             resp = api.dm(secret['twitter_dmaccount'], t['text'] + t['url'], upload_ids[0])
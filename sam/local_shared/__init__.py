@@ -0,0 +1,258 @@
+import io
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import datetime
+import importlib.util
+
+import botocore.exceptions
+
+class LocalS3:
+    # Stand-in for the boto3 S3 client, backed by a directory with one subdirectory per bucket
+    class exceptions:
+        ClientError = botocore.exceptions.ClientError
+        class NoSuchKey(botocore.exceptions.ClientError):
+            pass
+
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def path(self, Bucket, Key):
+        return os.path.join(self.root, Bucket, *Key.split('/'))
+
+    def error(self, code, operation, cls=None):
+        if cls is None:
+            cls = self.exceptions.ClientError
+        return cls({'Error': {'Code': code, 'Message': code}}, operation)
+
+    def etag(self, data):
+        return '"%s"' %hashlib.md5(data).hexdigest()
+
+    def get_object(self, Bucket, Key, **kwargs):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self.error('NoSuchKey', 'GetObject', self.exceptions.NoSuchKey)
+        with open(path, 'rb') as f:
+            data = f.read()
+        etag = self.etag(data)
+        if kwargs.get('IfNoneMatch') == etag:
+            raise self.error('304', 'GetObject')
+        self.bytes_read += len(data)
+        return {
+            'Body': io.BytesIO(data),
+            'ContentLength': len(data),
+            'ETag': etag,
+            'LastModified': datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc),
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        resp = self.get_object(Bucket=Bucket, Key=Key)
+        self.bytes_read -= resp['ContentLength']
+        del resp['Body']
+        return resp
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode()
+        path = self.path(Bucket, Key)
+        exists = os.path.isfile(path)
+        if ('IfNoneMatch' in kwargs) and exists:
+            raise self.error('PreconditionFailed', 'PutObject')
+        if 'IfMatch' in kwargs:
+            if (not exists) or (self.head_object(Bucket=Bucket, Key=Key)['ETag'] != kwargs['IfMatch']):
+                raise self.error('PreconditionFailed', 'PutObject')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        self.bytes_written += len(Body)
+        return {'ETag': self.etag(Body)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        Fileobj.write(self.get_object(Bucket=Bucket, Key=Key)['Body'].read())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        path = self.path(Bucket, Key)
+        if os.path.isfile(path):
+            os.remove(path)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        contents = []
+        top = os.path.join(self.root, Bucket)
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), top).replace(os.sep, '/')
+                if key.startswith(Prefix) and (key > kwargs.get('StartAfter', '')):
+                    contents.append({'Key': key, 'Size': os.path.getsize(os.path.join(dirpath, filename))})
+        contents = sorted(contents, key=lambda k: k['Key'])
+        resp = {'KeyCount': len(contents), 'IsTruncated': False}
+        if len(contents) > 0:
+            resp['Contents'] = contents
+        return resp
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        # Parts are kept on disk until the upload is completed, as S3 would keep them, so they don't add to the caller's memory
+        uploadid = uuid.uuid4().hex
+        self.uploads[uploadid] = os.path.join(self.root, '.uploads', uploadid)
+        os.makedirs(self.uploads[uploadid])
+        return {'UploadId': uploadid}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        with open(os.path.join(self.uploads[UploadId], str(PartNumber)), 'wb') as f:
+            f.write(Body)
+        return {'ETag': self.etag(Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        dirname = self.uploads.pop(UploadId)
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        md5 = hashlib.md5()
+        with open(path, 'wb') as f:
+            for p in MultipartUpload['Parts']:
+                with open(os.path.join(dirname, str(p['PartNumber'])), 'rb') as part:
+                    while True:
+                        block = part.read(1024*1024)
+                        if len(block) == 0:
+                            break
+                        md5.update(block)
+                        f.write(block)
+                        self.bytes_written += len(block)
+        shutil.rmtree(dirname)
+        return {'ETag': '"%s"' %md5.hexdigest()}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        dirname = self.uploads.pop(UploadId, None)
+        if dirname is not None:
+            shutil.rmtree(dirname)
+        return {}
+
+# Handlers by function name, using the logical names from template.yaml where there is one
+HANDLERS = {
+    'NICOVIDScraper': 'scraper/app.py',
+    'NICOVIDTweeter': 'tweeter/app.py',
+    'NICOVIDHospitalsTweeter': 'hospitals-tweeter/app.py',
+    'NICOVIDVaccinesTweeter': 'vaccines-tweeter/app.py',
+    'NICOVIDNISRADeathsTweeter': 'nisra-tweeter/app.py',
+    'NICOVIDONSTweeter': 'ons-tweeter/app.py',
+    'NICOVIDGenericTweeter': 'generic-tweeter/app.py',
+    'NICOVIDCOGVariantsTweeter': 'variant-tweeter/app.py',
+    'NICOVIDTestsCleaner': 'tests-cleaner/app.py',
+    'NICOVIDDatastoreCompactor': 'datastore-compactor/app.py',
+    'NICOVIDWorkbookConverter': 'workbook-converter/app.py',
+}
+
+# Environment variables the scraper reads the function names of the tweeters and converter from
+FUNCTION_ENV = {
+    'TWEETER_LAMBDA': 'NICOVIDTweeter',
+    'HOSPITAL_TWEETER_LAMBDA': 'NICOVIDHospitalsTweeter',
+    'VACCINE_TWEETER_LAMBDA': 'NICOVIDVaccinesTweeter',
+    'NISRA_TWEETER_LAMBDA': 'NICOVIDNISRADeathsTweeter',
+    'ONS_TWEETER_LAMBDA': 'NICOVIDONSTweeter',
+    'GENERIC_TWEETER_LAMBDA': 'NICOVIDGenericTweeter',
+    'COG_VARIANTS_TWEETER_LAMBDA': 'NICOVIDCOGVariantsTweeter',
+    'WORKBOOK_CONVERTER_LAMBDA': 'NICOVIDWorkbookConverter',
+}
+
+_handlers = {}
+
+def load_handler(name):
+    # Each app.py is loaded under its own module name, as they would otherwise all be 'app'
+    if name not in _handlers:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), HANDLERS[name])
+        spec = importlib.util.spec_from_file_location('handler_%s' %name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _handlers[name] = module.lambda_handler
+    return _handlers[name]
+
+class LocalLambda:
+    # Stand-in for the boto3 Lambda client, which records invocations and, if dispatching, runs known handlers in-process
+    def __init__(self, dispatch=False):
+        self.dispatch = dispatch
+        self.invocations = []
+        self.queue = []
+        self.results = []
+
+    def run(self, invocation):
+        if (self.dispatch is not True) or (invocation['FunctionName'] not in HANDLERS):
+            return None
+        resp = load_handler(invocation['FunctionName'])(invocation['Payload'], None)
+        self.results.append({'FunctionName': invocation['FunctionName'], 'Response': resp})
+        return resp
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload='{}', **kwargs):
+        invocation = {'FunctionName': FunctionName, 'InvocationType': InvocationType, 'Payload': json.loads(Payload)}
+        self.invocations.append(invocation)
+        # Asynchronous invocations wait for drain(), as the caller would not see them run
+        if InvocationType == 'Event':
+            self.queue.append(invocation)
+            return {'StatusCode': 202}
+        resp = self.run(invocation)
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(resp).encode())}
+
+    def drain(self):
+        # Run queued invocations in order, including any they queue in turn
+        while len(self.queue) > 0:
+            self.run(self.queue.pop(0))
+        return self.results
+
+class LocalSecrets:
+    # Stand-in for the boto3 Secrets Manager client, returning a fixed secret
+    def __init__(self, secret):
+        self.secret = secret
+
+    def get_secret_value(self, SecretId, **kwargs):
+        return {'Name': SecretId, 'SecretString': json.dumps(self.secret)}
+
+class LocalTweet:
+    def __init__(self, id):
+        self.id = id
+        self.media_id = id
+
+class LocalTwitter:
+    # Stand-in for twitter_shared.TwitterAPI, which records what would have been posted
+    posts = []
+
+    def __init__(self, apikey=None, apisecretkey=None, accesstoken=None, accesstokensecret=None):
+        pass
+
+    def post(self, kind, **fields):
+        fields['kind'] = kind
+        self.posts.append(fields)
+        return LocalTweet(len(self.posts))
+
+    def tweet(self, text, replyto=None, media_ids=[]):
+        return self.post('tweet', text=text, replyto=replyto, media=len(media_ids))
+
+    def dm(self, accountid, text, media_id=None):
+        return self.post('dm', text=text)
+
+    def upload(self, fp, name):
+        return self.post('upload', name=name)
+
+    def upload_multiple(self, configs):
+        return [self.upload(None, c['name']).media_id for c in configs]
+
+class LocalClients:
+    # Drop-in for shared.client_factory, handing out the same stand-in for each service
+    def __init__(self, root, secret, dispatch=False):
+        self.clients = {
+            's3': LocalS3(root),
+            'lambda': LocalLambda(dispatch),
+            'secretsmanager': LocalSecrets(secret),
+        }
+
+    def __call__(self, name, *args, **kwargs):
+        return self.clients[name]
@@ -3,11 +3,11 @@ import io
 import datetime
 import logging
 
-import boto3
 import pandas
 import altair
 
-from shared import S3_scraper_index
+from shared import S3_scraper_index, get_client
+from data_shared import Workbook
 from twitter_shared import TwitterAPI
 from plot_shared import get_chrome_driver
 
@@ -22,19 +22,19 @@ def colclean(old):
 
 def lambda_handler(event, context):
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
     tweets = []
-    # Download the most recently updated Excel file
-    s3 = boto3.client('s3')
+    # Read the most recently updated Excel file, from its sheet snapshot if there is one
+    s3 = get_client('s3')
     for change in event:
-        obj = s3.get_object(Bucket=secret['bucketname'],Key=change['keyname'])['Body']
-        stream = io.BytesIO(obj.read())
+        workbook = Workbook.from_s3(s3, secret['bucketname'], change['keyname'])
 
-        # Load test data and add extra fields
-        df = pandas.read_excel(stream,engine='openpyxl',sheet_name='Table 7', header=3)
+        # Load test data and add extra fields, the header row being the one naming the week and total
+        df = workbook.sheet('Table 7', header=['Week Ending', 'Total'])
+        workbook.close()
         df.dropna('columns',how='all',inplace=True)
         df.rename(columns=colclean,inplace=True)
         df.dropna('rows',subset=['Total'],inplace=True)
@@ -3,11 +3,11 @@ import io
 import datetime
 import logging
 
-import boto3
 import pandas
 import altair
 
-from shared import S3_scraper_index
+from shared import S3_scraper_index, get_client
+from data_shared import Workbook
 from twitter_shared import TwitterAPI
 from plot_shared import get_chrome_driver, plot_heatmap
 
@@ -16,30 +16,24 @@ bad_symb = '\u2191'
 
 def lambda_handler(event, context):
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
     # Get the history file
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     status = S3_scraper_index(s3, secret['bucketname'], secret['ons-infection-index'])
     index = status.get_dict()
 
     messages = []
     try:
-        # Download the most recently updated Excel file
+        # Read the most recently updated Excel file, from its sheet snapshots where there are any
         for change in event:
-            obj = s3.get_object(Bucket=secret['bucketname'],Key=change['keyname'])['Body']
-            stream = io.BytesIO(obj.read())
+            workbook = Workbook.from_s3(s3, secret['bucketname'], change['keyname'])
 
-            # Load test data and add extra fields
-            for header in range(3, 10):
-                df = pandas.read_excel(stream,engine='openpyxl',sheet_name='1h', header=header)
-                df.dropna('columns',how='all',inplace=True)
-                if '95% Lower confidence/credible interval for percentage' in df.columns:
-                    break
-            else:
-                print('Expected column not found')
+            # Load test data and add extra fields, the header row being the one naming the interval
+            df = workbook.sheet('1h', header=['95% Lower confidence/credible interval for percentage'])
+            df.dropna('columns',how='all',inplace=True)
             df.dropna('rows',subset=['95% Lower confidence/credible interval for percentage'],inplace=True)
             df['95% Lower confidence/credible interval'] = df['95% Lower confidence/credible interval for percentage']/100
             df['95% Upper confidence/credible interval'] = df['95% Upper confidence/credible interval for percentage']/100
@@ -50,13 +44,9 @@ def lambda_handler(event, context):
             latest = df.iloc[-1]
             prev = df.iloc[-2]
 
-            for header in range(3, 10):
-                df2 = pandas.read_excel(stream,engine='openpyxl',sheet_name='1i', header=header)
-                df2.dropna('columns',how='all',inplace=True)
-                if '95% Lower credible interval for percentage' in df2.columns:
-                    break
-            else:
-                print('Expected column not found')
+            df2 = workbook.sheet('1i', header=['95% Lower credible interval for percentage'])
+            df2.dropna('columns',how='all',inplace=True)
+            workbook.close()
             df2.dropna('rows',subset=['95% Lower credible interval for percentage'],inplace=True)
             df2['Date'] = pandas.to_datetime(df2['Date'], format='%d %B %Y')
             df2['95% Lower credible interval'] = df2['95% Lower credible interval for percentage']/100
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import shared
+from local_shared import LocalClients, LocalTwitter, FUNCTION_ENV
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the scraper lambda offline against recorded HTTP fixtures and a local S3 directory')
+    parser.add_argument('--fixtures', required=True, help='directory holding the recorded HTTP responses')
+    parser.add_argument('--record', action='store_true', help='fetch from the real sites and (re)write the fixtures')
+    parser.add_argument('--data', help='directory to seed the local S3 from, one subdirectory per bucket')
+    parser.add_argument('--secret', required=True, help='JSON file holding the secret')
+    parser.add_argument('--event', help='JSON file holding the lambda event')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs, each against a fresh copy of the data')
+    parser.add_argument('--chain', action='store_true', help='run the launched tweeters in-process after the scraper')
+    args = parser.parse_args()
+
+    os.environ['SCRAPER_FIXTURES'] = args.fixtures
+    os.environ['SCRAPER_FIXTURE_MODE'] = 'record' if args.record else 'replay'
+    with open(args.secret) as f:
+        secret = json.load(f)
+    event = {}
+    if args.event is not None:
+        with open(args.event) as f:
+            event = json.load(f)
+
+    if args.chain:
+        for env, name in FUNCTION_ENV.items():
+            os.environ[env] = name
+        try:
+            import twitter_shared
+            twitter_shared.TwitterAPI = LocalTwitter
+        except ImportError:
+            pass
+
+    from scraper.app import lambda_handler
+
+    for run in range(args.repeat):
+        with tempfile.TemporaryDirectory() as root:
+            if args.data is not None:
+                shutil.copytree(args.data, root, dirs_exist_ok=True)
+            clients = LocalClients(root, secret, args.chain)
+            shared.client_factory = clients
+            start = time.perf_counter()
+            resp = lambda_handler(event, None)
+            elapsed = time.perf_counter() - start
+            chained = clients.clients['lambda'].drain()
+            print(json.dumps({
+                'run': run,
+                'seconds': round(elapsed, 3),
+                'launches': [i['FunctionName'] for i in clients.clients['lambda'].invocations],
+                's3_bytes_read': clients.clients['s3'].bytes_read,
+                's3_bytes_written': clients.clients['s3'].bytes_written,
+                'body': json.loads(resp['body']),
+                'chained': [{'handler': r['FunctionName'], 'status': r['Response'].get('statusCode')} for r in chained],
+            }))
+
+if __name__ == '__main__':
+    main()
@@ -2,86 +2,125 @@ import json
 import datetime
 import re
 import os
+import time
 import logging
 from copy import deepcopy
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import requests
-from bs4 import BeautifulSoup
-import boto3
+import botocore.exceptions
 from user_agent import generate_user_agent
 
-from shared import S3_scraper_index, launch_lambda_async, get_url, get_and_sort_index
+from shared import S3_scraper_index, S3_validator_cache, validator_keyname, launch_lambda_async, get_url, get_and_sort_index, pooled_session, head_urls, upload_url_to_s3, metrics, timed, new_session, get_client, extract_links, find_link, SourceCheck, CheckCancelled, propagate_check, HTTP_TIMEOUT
 
-def extract_doh_file_list(text,number,regex,datesub=[],datefmt='%d%m%y',element="div",htmlclass="nigovfile",matchgroup=1):
-    html = BeautifulSoup(text,features="html.parser")
-    files = []
+@timed('extract_doh_file_list')
+def extract_doh_file_list(text,number,regex,datesub=[],datefmt='%d%m%y',element="div",htmlclass="nigovfile",matchgroup=1,session=None,workers=1):
+    links = []
     regex = re.compile(regex, flags=re.IGNORECASE)
-    for nigovfile in html.find_all(element, {"class": htmlclass}):
-        for a in nigovfile.find_all('a', href=True):
-            m = regex.search(a['href'])
-            if m:
-                if len(datesub) == 2:
-                    datestr = re.sub(datesub[0],datesub[1],m.group(matchgroup))
-                else:
-                    datestr = m.group(matchgroup)
-                datestr = datestr.replace('%20','-')
-                resp = requests.head(a['href'])
-                resp.raise_for_status()
-                filedate = datetime.datetime.strptime(datestr,datefmt)
-                if 'Last-Modified' in resp.headers:
-                    modified = datetime.datetime.strptime(resp.headers['Last-Modified'],'%a, %d %b %Y %H:%M:%S %Z') # e.g Mon, 08 Mar 2021 06:12:35 GMT
-                    if 'Content-Length' in resp.headers:
-                        files.append({'url': a['href'],'modified': modified.isoformat(),'length': int(resp.headers['Content-Length']), 'filedate': filedate.date().isoformat()})
-                    else:
-                        files.append({'url': a['href'],'modified': modified.isoformat(),'filedate': filedate.date().isoformat()})
-                else:
-                    files.append({'url': a['href'],'filedate': filedate.date().isoformat()})
-                if len(files)>=number:
-                    break
-        if (number > 0) and (len(files)>=number):
-            break
+    # With no limit, only the first matching link in each container is used
+    for href, _ in extract_links(text, element, htmlclass, lambda href, _: regex.search(href), number, first_per_container=(number <= 0)):
+        m = regex.search(href)
+        if len(datesub) == 2:
+            datestr = re.sub(datesub[0],datesub[1],m.group(matchgroup))
+        else:
+            datestr = m.group(matchgroup)
+        datestr = datestr.replace('%20','-')
+        links.append((href, datestr))
+    # Probe the matching links, in parallel if requested, keeping the page order
+    session = pooled_session(session, workers)
+    resps = head_urls(session, [href for href, _ in links], workers)
+    files = []
+    for (href, datestr), resp in zip(links, resps):
+        filedate = datetime.datetime.strptime(datestr,datefmt)
+        if 'Last-Modified' in resp.headers:
+            modified = datetime.datetime.strptime(resp.headers['Last-Modified'],'%a, %d %b %Y %H:%M:%S %Z') # e.g Mon, 08 Mar 2021 06:12:35 GMT
+            if 'Content-Length' in resp.headers:
+                files.append({'url': href,'modified': modified.isoformat(),'length': int(resp.headers['Content-Length']), 'filedate': filedate.date().isoformat()})
+            else:
+                files.append({'url': href,'modified': modified.isoformat(),'filedate': filedate.date().isoformat()})
+        else:
+            files.append({'url': href,'filedate': filedate.date().isoformat()})
     return files
 
 def check_file_list_against_previous(current, previous):
-    changes = []
+    # New later dates go on the front of the index and new older dates on the back,
+    # with each change's final position worked out once the merge is complete
+    front = []
+    back = []
     maxdate = '1970-01-01'
+    positions = {}
     for i in range(len(previous)):
         if previous[i]['filedate'] > maxdate:
             maxdate = previous[i]['filedate']
+        positions.setdefault(previous[i]['filedate'], ('previous', i))
+    merged = {'front': front, 'previous': previous, 'back': back}
+    changes = []
     for e in reversed(current):
-        match = next((p for p in previous if p["filedate"] == e["filedate"]), None)
-        if match is None and (e['filedate'] > maxdate):
+        position = positions.get(e['filedate'])
+        if position is None and (e['filedate'] > maxdate):
             # If a new, later date
-            for i in range(len(changes)):
-                changes[i]['index'] = changes[i]['index']+1
-            changes.append({'index': 0, 'change': 'added'})
-            previous.insert(0, e)
-        elif match is None:
+            position = ('front', len(front))
+            front.append(e)
+            positions[e['filedate']] = position
+            changes.append((position, 'added', None))
+        elif position is None:
             # If a new, older date
-            changes.append({'index': len(previous), 'change': 'added'})
-            previous.append(e)
-        elif 'modified' in match:
-            if 'length' in match:
-                if ((match['modified'] != e['modified']) or (match['length'] != e['length'])):
-                    changes.append({'index': previous.index(match), 'change': 'modified'})
-                    previous[changes[-1]['index']] = e
-            else:
-                if match['modified'] != e['modified']:
-                    changes.append({'index': previous.index(match), 'change': 'modified'})
-                    previous[changes[-1]['index']] = e
+            position = ('back', len(back))
+            back.append(e)
+            positions[e['filedate']] = position
+            changes.append((position, 'added', None))
+        else:
+            match = merged[position[0]][position[1]]
+            if 'modified' in match:
+                if 'length' in match:
+                    if ((match['modified'] != e['modified']) or (match['length'] != e['length'])):
+                        changes.append((position, 'modified', match))
+                        merged[position[0]][position[1]] = e
+                else:
+                    if match['modified'] != e['modified']:
+                        changes.append((position, 'modified', match))
+                        merged[position[0]][position[1]] = e
+    offsets = {'previous': len(front), 'back': len(front) + len(previous)}
+    final = []
+    for (region, i), change, old in changes:
+        final.append({'index': (len(front) - 1 - i) if (region == 'front') else (offsets[region] + i), 'change': change})
+        if old is not None:
+            # Keep the replaced entry, so re-publications of the same bytes can be spotted
+            final[-1]['previous'] = old
+    changes = final
+    previous[:] = list(reversed(front)) + previous + back
     return previous, changes
 
-def upload_changes_to_s3(s3client, bucket, dirname, index, changes, fileext):
-    session = requests.Session()
+@timed('upload_changes_to_s3')
+def upload_changes_to_s3(s3client, bucket, dirname, index, changes, fileext, workers=1):
+    session = pooled_session(None, workers)
+    uploads = []
     for change in changes:
         e = index[change['index']]
         keyname = "%s/%s/%s-%s.%s" %(dirname,e['filedate'],e.get('modified', '1').replace(':','_'),e.get('length','1'),fileext)
-        s3client.put_object(Bucket=bucket, Key=keyname, Body=get_url(session, e['url'],'content'))
-        index[change['index']]['keyname'] = keyname
+        uploads.append((change, e['url'], keyname))
+    def upload(item):
+        return upload_url_to_s3(session, item[1], s3client, bucket, item[2], skip_sha256=item[0].get('previous', {}).get('sha256'))
+    if (workers > 1) and (len(uploads) > 1):
+        with ThreadPoolExecutor(max_workers=min(workers, len(uploads))) as executor:
+            hashes = list(executor.map(propagate_check(upload), uploads))
+    else:
+        hashes = [upload(item) for item in uploads]
+    for (change, url, keyname), sha256 in zip(uploads, hashes):
+        e = index[change['index']]
+        e['sha256'] = sha256
+        if sha256 == change.get('previous', {}).get('sha256'):
+            # Same bytes re-published, so point at the copy we already hold
+            e['keyname'] = change['previous']['keyname']
+            change['change'] = 'republished'
+            metrics.count('republished')
+        else:
+            e['keyname'] = keyname
     return index
 
-def check_for_dd_files(s3client, bucket, previous, files_to_check, store=True):
-    session = requests.Session()
+def check_for_dd_files(s3client, bucket, previous, url, regex, files_to_check, store=True, workers=8, validators=None):
+    session = new_session()
     session.headers = {
         'Cache-Control': 'no-cache',
         'Pragma': 'no-cache',
@@ -90,11 +129,7 @@ def check_for_dd_files(s3client, bucket, previous, files_to_check, store=True):
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
         'Accept-Language': 'en-US,en;q=0.5',
     }
-    html = BeautifulSoup(get_url(session, 'https://www.health-ni.gov.uk/articles/covid-19-daily-dashboard-updates', 'text'),features="html.parser")
-    durl = None
-    for a in html.find_all('a', href=True):
-        if a.text.strip().lower().startswith('latest pdf version'):
-            durl = a['href']
+    durl = find_link(get_url(session, url, 'text'), lambda href, text: text.strip().lower().startswith('latest pdf version'), last=True)
     if durl is None:
         raise('Unable to find starting URL')
     url = 'https://www.health-ni.gov.uk/' + durl.lstrip('/')
@@ -104,16 +139,23 @@ def check_for_dd_files(s3client, bucket, previous, files_to_check, store=True):
     # Pull last month's as well, if we need to, to ensure we always have N days of data checked, or just get everything
     while (len(excels) < files_to_check) or ((files_to_check == 0)):
         try:
+            text = get_url(
+                session,
+                url,
+                'text',
+                validators=validators
+            )
+            if text is None:
+                # Listing unchanged since the last run, so don't look any further back
+                break
             excels.extend(
                 extract_doh_file_list(
-                    get_url(
-                        session,
-                        url,
-                        'text',
-                    ),
+                    text,
                     files_to_check-len(excels),
-                    r'-(\d{6}).*\.xlsx$',
-                    datefmt='%d%m%y'
+                    regex,
+                    datefmt='%d%m%y',
+                    session=session,
+                    workers=workers
                 )
             )
         except requests.exceptions.HTTPError as err:
@@ -127,14 +169,16 @@ def check_for_dd_files(s3client, bucket, previous, files_to_check, store=True):
                 raise err
         date_to_try = date_to_try.replace(day=1) - datetime.timedelta(days=1)
         url = 'https://www.health-ni.gov.uk/Daily%%20dashboard%%20updates%%20on%%20COVID-19%%20-%%20%s%%20%d' %(date_to_try.strftime("%B").lower(),date_to_try.year)
+    if len(excels) == 0:
+        return previous, []
     # Merge the new data into the previous list and detect changes
     index, changes = check_file_list_against_previous(excels, previous)
     # Upload the changed files to s3
-    index = upload_changes_to_s3(s3client, bucket, 'DoH-DD', index, changes, 'xlsx')
+    index = upload_changes_to_s3(s3client, bucket, 'DoH-DD', index, changes, 'xlsx', workers)
     return index, changes
 
-def check_for_hospital_files(s3client, bucket, previous, files_to_check=1, store=True):
-    session = requests.Session()
+def check_for_hospital_files(s3client, bucket, previous, url, regex, files_to_check=1, store=True, workers=1, validators=None):
+    session = new_session()
     session.headers = {
         'Cache-Control': 'no-cache',
         'Pragma': 'no-cache',
@@ -143,11 +187,7 @@ def check_for_hospital_files(s3client, bucket, previous, files_to_check=1, store
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
         'Accept-Language': 'en-US,en;q=0.5',
     }
-    html = BeautifulSoup(get_url(session, 'https://www.health-ni.gov.uk/articles/covid-19-dashboard-updates', 'text'),features="html.parser")
-    durl = None
-    for a in html.find_all('a', href=True):
-        if a.text.strip().lower().startswith('covid-19 hospitalisations'):
-            durl = a['href']
+    durl = find_link(get_url(session, url, 'text'), lambda href, text: text.strip().lower().startswith('covid-19 hospitalisations'), last=True)
     if durl is None:
         raise('Unable to find starting URL')
     url = 'https://www.health-ni.gov.uk/' + durl.lstrip('/')
@@ -155,38 +195,52 @@ def check_for_hospital_files(s3client, bucket, previous, files_to_check=1, store
     excels = []
     # Pull last month's as well, if we need to, to ensure we always have N days of data checked, or just get everything
     while (len(excels) < files_to_check) or ((files_to_check == 0)):
+        text = get_url(
+            session,
+            url,
+            'text',
+            validators=validators
+        )
+        if text is None:
+            # Listing unchanged since the last run, keeping anything already found in this one
+            if len(excels) == 0:
+                return previous, []
+            break
         excels.extend(
             extract_doh_file_list(
-                get_url(
-                    session,
-                    url,
-                    'text',
-                ),
+                text,
                 files_to_check-len(excels),
-                r'-(\d{6}).*\.xlsx$',
-                datefmt='%d%m%y'
+                regex,
+                datefmt='%d%m%y',
+                session=session,
+                workers=workers
             )
         )
     # Merge the new data into the previous list and detect changes
     index, changes = check_file_list_against_previous(excels, previous)
     # Upload the changed files to s3
-    index = upload_changes_to_s3(s3client, bucket, 'DoH-hospitalisations', index, changes, 'xlsx')
+    index = upload_changes_to_s3(s3client, bucket, 'DoH-hospitalisations', index, changes, 'xlsx', workers)
     return index, changes
 
-def check_for_r_files(s3client, bucket, previous):
-    session = requests.Session()
+def check_for_r_files(s3client, bucket, previous, url, regex, workers=1, validators=None):
+    session = new_session()
     # Attempt to pull the list of R number publications
-    url = 'https://www.health-ni.gov.uk/R-Number'
+    text = get_url(
+        session,
+        url,
+        'text',
+        useragent=generate_user_agent(),
+        referer='https://www.health-ni.gov.uk/',
+        validators=validators
+    )
+    if text is None:
+        return previous, []
     pdfs = extract_doh_file_list(
-        get_url(
-            session,
-            url,
-            'text',
-            useragent=generate_user_agent(),
-            referer='https://www.health-ni.gov.uk/'
-        ),
+        text,
         1,
-        r'-(\d{6}).*\.pdf$'
+        regex,
+        session=session,
+        workers=workers
     )
     # Merge the new data into the previous list and detect changes
     index, changes = check_file_list_against_previous(pdfs, previous)
@@ -194,45 +248,17 @@ def check_for_r_files(s3client, bucket, previous):
     index = upload_changes_to_s3(s3client, bucket, 'DoH-R', index, changes, 'pdf')
     return index, changes
 
-def check_doh(secret, s3, notweet, mode):
-    if mode=='dd':
-        indexkey = secret['doh-dd-index']
-        lambdaname = os.getenv('TWEETER_LAMBDA')
-    elif mode=='hospital':
-        indexkey = secret['doh-hospital-index']
-        lambdaname = os.getenv('HOSPITAL_TWEETER_LAMBDA')
-    else:
-        indexkey = secret['doh-r-index']
-        lambdaname = os.getenv('R_TWEETER_LAMBDA')
-
-    # Get the previous data file list from S3
-    status = S3_scraper_index(s3, secret['bucketname'], indexkey)
-    previous = status.get_dict()
-    previous = sorted(previous, key=lambda k: k['filedate'], reverse=True)
+def get_validators(secret, s3, indexkey):
+    # Conditional GETs of the listing pages are opt-in via the secret
+    if secret.get('scraper-validator-cache', False) is True:
+        return S3_validator_cache(s3, secret['bucketname'], validator_keyname(indexkey))
+    return None
 
-    # Check the DoH site for file changes
-    if mode=='dd':
-        current, changes = check_for_dd_files(s3, secret['bucketname'], previous, int(secret['doh-dd-files-to-check']), store=(not notweet))
-    elif mode=='hospital':
-        current, changes = check_for_hospital_files(s3, secret['bucketname'], previous, store=(not notweet))
-    else:
-        current, changes = check_for_r_files(s3, secret['bucketname'], previous)
-
-    # Write any changes back to S3
-    if len(changes) > 0:
-        status.put_dict(current)
-        message = 'Wrote %d items to %s, of which %d were changes' %(len(current), indexkey, len(changes))
-
-        # If the most recent file has changed then tweet
-        totweet = [c['index'] for c in changes if (c['change'] == 'added') or (c['index'] == 0)]
-        if not notweet and (0 in totweet):
-            print('Launching %s tweeter' %mode)
-            launch_lambda_async(lambdaname,[current[a] for a in totweet])
-            message += ', and launched %s tweet lambda' %mode
-    else:
-        message = 'Did nothing'
-
-    return message
+def store_validators(validators, summary):
+    if validators is not None:
+        validators.put_dict()
+        if summary is not None:
+            validators.summarise(summary)
 
 def check_symptoms():
     url = 'https://services-eu1.arcgis.com/CbFuxzn9jT2gu2G1/arcgis/rest/services/Prod_Symptoms_By_Hex_Tess_All_Public_View/FeatureServer/0/query'
@@ -248,8 +274,8 @@ def check_symptoms():
     }
     print('POST %s to %s' %(formdata,url))
 
-def check_for_nisra_files(s3client, bucket, previous):
-    session = requests.Session()
+def check_for_nisra_files(s3client, bucket, previous, url, regex, workers=1, validators=None):
+    session = new_session()
     session.headers = {
         'Cache-Control': 'no-cache',
         'Pragma': 'no-cache',
@@ -267,21 +293,12 @@ def check_for_nisra_files(s3client, bucket, previous):
         'Accept-Encoding': 'gzip, deflate, br',
         'TE': 'trailers'
     }
-    url = 'https://www.nisra.gov.uk/statistics/death-statistics/weekly-death-registrations-northern-ireland'
     resp = session.head(url)
     resp.raise_for_status()
     # Attempt to pull the link to this week's publications
-    url = 'https://www.nisra.gov.uk/statistics/death-statistics/weekly-death-registrations-northern-ireland'
     resp = session.get(url)
     resp.raise_for_status()
-    html = BeautifulSoup(
-        resp.text,
-        features="html.parser")
-    durl = None
-    for a in html.find_all('a', href=True):
-        if a.text.strip() == 'Latest Weekly Deaths':
-            durl = a['href']
-            break
+    durl = find_link(resp.text, lambda href, text: text.strip() == 'Latest Weekly Deaths')
     if durl is None:
         raise Exception('Failed to find link to deaths records at %s' %url)
     if durl.startswith('/'):
@@ -290,19 +307,25 @@ def check_for_nisra_files(s3client, bucket, previous):
     # e.g. https://www.nisra.gov.uk/system/files/statistics/Weekly-Deaths-we-17-September-2021.XLSX
     # e.g. https://www.nisra.gov.uk/system/files/statistics/Weekly_Deaths%20-%20w%20e%205th%20November%202021.XLSX
     print(durl)
+    text = get_url(
+        session,
+        durl,
+        'text',
+        useragent=generate_user_agent(),
+        referer=url,
+        validators=validators
+    )
+    if text is None:
+        return previous, []
     excels = extract_doh_file_list(
-        get_url(
-            session,
-            durl,
-            'text',
-            useragent=generate_user_agent(),
-            referer=url
-        ),
+        text,
         1,
-        r'w(%20)*e(%20|-)(\d+[a-z]*(%20|-)[A-Za-z]+(%20|-)\d+).*\.(?:xlsx|XLSX)$',
+        regex,
         [r'(\d)(st|nd|rd|th)', r'\1'],
         r'%d-%B-%Y',
-        matchgroup=3
+        matchgroup=3,
+        session=session,
+        workers=workers
     )
     # Merge the new data into the previous list and detect changes
     index, changes = check_file_list_against_previous(excels, previous)
@@ -310,51 +333,20 @@ def check_for_nisra_files(s3client, bucket, previous):
     index = upload_changes_to_s3(s3client, bucket, 'NISRA-deaths', index, changes, 'xslx')
     return index, changes
 
-def check_nisra(secret, s3, notweet):
-    indexkey = secret['nisra-deaths-index']
-
-    # Get the previous data file list from S3
-    status = S3_scraper_index(s3, secret['bucketname'], indexkey)
-    previous = status.get_dict()
-    previous = sorted(previous, key=lambda k: k['filedate'], reverse=True)
-
-    # Check the NISRA site for file changes
-    current, changes = check_for_nisra_files(s3, secret['bucketname'], previous)
-
-    # Write any changes back to S3
-    if len(changes) > 0:
-        status.put_dict(current)
-        message = 'Wrote %d items to %s, of which %d were changes' %(len(current), indexkey, len(changes))
-
-        # If the most recent file has changed then tweet
-        totweet = [c['index'] for c in changes if (c['change'] == 'added') or (c['index'] == 0)]
-        if not notweet and (0 in totweet):
-            print('Launching NISRA tweeter')
-            launch_lambda_async(os.getenv('NISRA_TWEETER_LAMBDA'),[current[a] for a in totweet])
-            message += ', and launched NISRA tweet lambda'
-    else:
-        message = 'Did nothing'
-
-    return message
-
-def check_for_ons_files(s3client, bucket, previous):
-    session = requests.Session()
+def check_for_ons_files(s3client, bucket, previous, url, regex, validators=None):
+    session = new_session()
 
     # Attempt to pull the link to this week's publications
-    url = 'https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/conditionsanddiseases/datasets/coronaviruscovid19infectionsurveyheadlineresultsuk'
-    html = BeautifulSoup(
-        get_url(
-            session,
-            url,
-            'text',
-            useragent=generate_user_agent()
-        )
-        ,features="html.parser")
-    durl = None
-    for a in html.find_all('a', href=True):
-        if a.text.strip()[:4] == 'xlsx':
-            durl = a['href']
-            break
+    text = get_url(
+        session,
+        url,
+        'text',
+        useragent=generate_user_agent(),
+        validators=validators
+    )
+    if text is None:
+        return previous, []
+    durl = find_link(text, lambda href, text: text.strip()[:4] == 'xlsx')
     if durl is None:
         raise Exception('Failed to find link to ONS infection survey at %s' %url)
     if durl.startswith('/'):
@@ -362,7 +354,7 @@ def check_for_ons_files(s3client, bucket, previous):
     # Example: https://www.ons.gov.uk/file?uri=/peoplepopulationandcommunity/healthandsocialcare/conditionsanddiseases/datasets/covid19infectionsurveynorthernireland/2022/20220617covid19infectionsurveydatasetsni1.xlsx
     # Example: https://www.ons.gov.uk/file?uri=%2fpeoplepopulationandcommunity%2fhealthandsocialcare%2fconditionsanddiseases%2fdatasets%2fcovid19infectionsurveynorthernireland%2f2022/20220520covid19infectionsurveydatasetsni.xlsx
     # Example: https://www.ons.gov.uk/file?uri=%2fpeoplepopulationandcommunity%2fhealthandsocialcare%2fconditionsanddiseases%2fdatasets%2fcovid19infectionsurveynorthernireland%2f2021/20220107covid19infectionsurveydatasetsni.xlsx
-    regex = re.compile(r'(\d{8})covidinfectionsurveyheadlinedataset\d*\.(?:xlsx|XLSX)$', flags=re.IGNORECASE)
+    regex = re.compile(regex, flags=re.IGNORECASE)
     m = regex.search(durl)
     if m is None:
         raise Exception('Failed to find ONS infection survey date in %s' %durl)
@@ -376,61 +368,33 @@ def check_for_ons_files(s3client, bucket, previous):
     index = upload_changes_to_s3(s3client, bucket, 'ONS-infections', index, changes, 'xslx')
     return index, changes
 
-def check_ons(secret, s3, notweet):
-    indexkey = secret['ons-infection-index']
-
-    # Get the previous data file list from S3
-    status = S3_scraper_index(s3, secret['bucketname'], indexkey)
-    previous = status.get_dict()
-    previous = sorted(previous, key=lambda k: k['filedate'], reverse=True)
-
-    # Check the ONS site for file changes
-    current, changes = check_for_ons_files(s3, secret['bucketname'], previous)
-
-    # Write any changes back to S3
-    if len(changes) > 0:
-        status.put_dict(current)
-        message = 'Wrote %d items to %s, of which %d were changes' %(len(current), indexkey, len(changes))
-
-        # If the most recent file has changed then tweet
-        totweet = [c['index'] for c in changes if (c['change'] == 'added') or (c['index'] == 0)]
-        if not notweet and (0 in totweet):
-            print('Launching ONS tweeter')
-            launch_lambda_async(os.getenv('ONS_TWEETER_LAMBDA'),[current[a] for a in totweet])
-            message += ', and launched ONS tweet lambda'
-    else:
-        message = 'Did nothing'
-
-    return message
-
-def check_for_ukhsa_variants_files(s3client, bucket, previous):
-    session = requests.Session()
+def check_for_ukhsa_variants_files(s3client, bucket, previous, url, regex, validators=None):
+    session = new_session()
     # Attempt to pull the index page for all publications
-    url = 'https://www.gov.uk/government/publications/covid-19-variants-genomically-confirmed-case-numbers'
-    html = BeautifulSoup(
-        get_url(
-            session,
-            url,
-            'text',
-            useragent=generate_user_agent(),
-        )
-        ,features="html.parser")
+    text = get_url(
+        session,
+        url,
+        'text',
+        useragent=generate_user_agent(),
+        validators=validators
+    )
+    if text is None:
+        return previous, []
     pages = []
-    for a in html.find_all('a', href=True):
-        if a.text.strip().startswith('Variants: distribution of case data'):
-            page = {}
-            if a['href'].startswith('/'):
-                page['url'] = 'https://www.gov.uk' + a['href']
-            else:
-                page['url'] = a['href']
-            regex = re.compile(r'(\d+\-[a-z]+\-\d{4})$', flags=re.IGNORECASE)
-            m = regex.search(page['url'])
-            if m is None:
-                raise Exception('Failed to find variant report date in %s' %page['url'])
-            datestr = m.group(1)
-            filedate = datetime.datetime.strptime(datestr,'%d-%B-%Y')
-            page['filedate'] = filedate.date().isoformat()
-            pages.append(page)
+    regex = re.compile(regex, flags=re.IGNORECASE)
+    for href, _ in extract_links(text, match=lambda href, text: text.strip().startswith('Variants: distribution of case data')):
+        page = {}
+        if href.startswith('/'):
+            page['url'] = 'https://www.gov.uk' + href
+        else:
+            page['url'] = href
+        m = regex.search(page['url'])
+        if m is None:
+            raise Exception('Failed to find variant report date in %s' %page['url'])
+        datestr = m.group(1)
+        filedate = datetime.datetime.strptime(datestr,'%d-%B-%Y')
+        page['filedate'] = filedate.date().isoformat()
+        pages.append(page)
     if len(pages) < 1:
         raise Exception('Failed to find links to variant links at %s' %url)
     # e.g. https://www.gov.uk/government/publications/covid-19-variants-genomically-confirmed-case-numbers/variants-distribution-of-case-data-27-may-2022
@@ -440,37 +404,260 @@ def check_for_ukhsa_variants_files(s3client, bucket, previous):
     index = upload_changes_to_s3(s3client, bucket, 'UKHSA-variants', index, changes, 'html')
     return index, changes
 
-def check_ukhsa_variants(secret, s3, notweet):
-    indexkey = secret['ukhsa-variants-index']
-    lambdaname = os.getenv('UKHSA_VARIANTS_TWEETER_LAMBDA')
+# Sources of published files checked by the scraper: 'window' is when each source is
+# expected to publish (weekdays with Monday=0, and [start, end) hours in UTC), used until
+# the scheduler has learnt the publication times from the source's index. Files from sources
+# marked 'convert' go through the workbook converter, which snapshots their sheets before
+# launching the tweeter
+SOURCES = {
+    'dd': {
+        'description': 'DOH daily data',
+        'url': 'https://www.health-ni.gov.uk/articles/covid-19-daily-dashboard-updates',
+        'regex': r'-(\d{6}).*\.xlsx$',
+        'index': 'doh-dd-index',
+        'lambda': 'TWEETER_LAMBDA',
+        'convert': True,
+        'notweet': 'dd-notweet',
+        'window': {'days': [0, 1, 2, 3, 4], 'hours': [12, 16]},
+        'check': check_for_dd_files,
+        'options': lambda secret, notweet: {'files_to_check': int(secret['doh-dd-files-to-check']), 'store': not notweet, 'workers': int(secret.get('doh-dd-head-workers', 8))},
+    },
+    'hospital': {
+        'description': 'DOH hospital data',
+        'url': 'https://www.health-ni.gov.uk/articles/covid-19-dashboard-updates',
+        'regex': r'-(\d{6}).*\.xlsx$',
+        'index': 'doh-hospital-index',
+        'lambda': 'HOSPITAL_TWEETER_LAMBDA',
+        'convert': True,
+        'notweet': 'hospital-notweet',
+        'window': {'days': [4], 'hours': [12, 16]},
+        'check': check_for_hospital_files,
+        'options': lambda secret, notweet: {'store': not notweet, 'workers': int(secret.get('doh-hospital-head-workers', 1))},
+    },
+    'r': {
+        'description': 'DOH R number',
+        'url': 'https://www.health-ni.gov.uk/R-Number',
+        'regex': r'-(\d{6}).*\.pdf$',
+        'index': 'doh-r-index',
+        'lambda': 'R_TWEETER_LAMBDA',
+        'notweet': 'r-notweet',
+        'window': {'days': [3], 'hours': [12, 18]},
+        'check': check_for_r_files,
+        'options': lambda secret, notweet: {'workers': int(secret.get('doh-r-head-workers', 1))},
+    },
+    'nisra': {
+        'description': 'NISRA weekly data',
+        'url': 'https://www.nisra.gov.uk/statistics/death-statistics/weekly-death-registrations-northern-ireland',
+        'regex': r'w(%20)*e(%20|-)(\d+[a-z]*(%20|-)[A-Za-z]+(%20|-)\d+).*\.(?:xlsx|XLSX)$',
+        'index': 'nisra-deaths-index',
+        'lambda': 'NISRA_TWEETER_LAMBDA',
+        'convert': True,
+        'notweet': 'nisra-notweet',
+        'window': {'days': [4], 'hours': [8, 11]},
+        'check': check_for_nisra_files,
+        'options': lambda secret, notweet: {'workers': int(secret.get('nisra-deaths-head-workers', 1))},
+    },
+    'ons': {
+        'description': 'ONS CIS data',
+        'url': 'https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/conditionsanddiseases/datasets/coronaviruscovid19infectionsurveyheadlineresultsuk',
+        'regex': r'(\d{8})covidinfectionsurveyheadlinedataset\d*\.(?:xlsx|XLSX)$',
+        'index': 'ons-infection-index',
+        'lambda': 'ONS_TWEETER_LAMBDA',
+        'convert': True,
+        'notweet': 'ons-notweet',
+        'window': {'days': [4], 'hours': [10, 13]},
+        'check': check_for_ons_files,
+        'options': lambda secret, notweet: {},
+    },
+    'ukhsa-variants': {
+        'description': 'UKHSA variants data',
+        'url': 'https://www.gov.uk/government/publications/covid-19-variants-genomically-confirmed-case-numbers',
+        'regex': r'(\d+\-[a-z]+\-\d{4})$',
+        'index': 'ukhsa-variants-index',
+        'lambda': 'UKHSA_VARIANTS_TWEETER_LAMBDA',
+        'notweet': 'ukhsa-variants-notweet',
+        'window': {'days': [3, 4], 'hours': [12, 17]},
+        'check': check_for_ukhsa_variants_files,
+        'options': lambda secret, notweet: {},
+    },
+}
+
+def check_source(secret, s3, notweet, name, summary=None):
+    source = SOURCES[name]
+    indexkey = secret[source['index']]
 
     # Get the previous data file list from S3
     status = S3_scraper_index(s3, secret['bucketname'], indexkey)
     previous = status.get_dict()
     previous = sorted(previous, key=lambda k: k['filedate'], reverse=True)
+    if summary is not None:
+        summary['slots'] = learn_publication_slots(previous)
 
-    # Check the gov.uk site for file changes
-    current, changes = check_for_ukhsa_variants_files(s3, secret['bucketname'], previous)
+    # Check the source's site for file changes
+    validators = get_validators(secret, s3, indexkey)
+    current, changes = source['check'](s3, secret['bucketname'], previous, source['url'], source['regex'], validators=validators, **source['options'](secret, notweet))
+    if summary is not None:
+        summary['changes'] = len(changes)
 
     # Write any changes back to S3
     if len(changes) > 0:
         status.put_dict(current)
         message = 'Wrote %d items to %s, of which %d were changes' %(len(current), indexkey, len(changes))
 
-        # If the most recent file has changed then tweet
-        totweet = [c['index'] for c in changes if (c['change'] == 'added') or (c['index'] == 0)]
+        # If the most recent file has changed then tweet, ignoring byte-identical re-publications
+        totweet = [c['index'] for c in changes if (c['change'] == 'added') or ((c['index'] == 0) and (c['change'] == 'modified'))]
         if not notweet and (0 in totweet):
-            print('Launching UKHSA variants tweeter')
-            launch_lambda_async(lambdaname,[current[a] for a in totweet])
-            message += ', and launched UKHSA variants tweet lambda'
+            print('Launching %s tweeter' %name)
+            payload = [current[a] for a in totweet]
+            converting = source.get('convert', False) and (os.getenv('WORKBOOK_CONVERTER_LAMBDA') is not None)
+            if converting:
+                try:
+                    launch_lambda_async(os.getenv('WORKBOOK_CONVERTER_LAMBDA'),{'source': name, 'lambda': os.getenv(source['lambda']), 'changes': payload})
+                except botocore.exceptions.ClientError:
+                    # The change is already in the index, so tweet it without the snapshots rather than lose it
+                    logging.exception('Failed to launch the workbook converter for %s' %name)
+                    converting = False
+            if not converting:
+                launch_lambda_async(os.getenv(source['lambda']),payload)
+            message += ', and launched %s tweet lambda' %name
     else:
         message = 'Did nothing'
+    store_validators(validators, summary)
 
     return message
 
-def check_for_cog_files(s3, bucketname, indexkey):
+def learn_publication_slots(index, history=10):
+    # The (weekday, hour) slots in which the most recent files were last modified
+    slots = set()
+    for e in index[:history]:
+        if 'modified' in e:
+            modified = datetime.datetime.fromisoformat(e['modified'])
+            slots.add((modified.weekday(), modified.hour))
+    return sorted(slots)
+
+def window_slots(window):
+    return [(d, h) for d in window['days'] for h in range(window['hours'][0], window['hours'][1])]
+
+def is_hot(slots, now, slack=1):
+    # Whether now is within slack hours of a slot in which the source publishes
+    hour_of_week = (now.weekday() * 24) + now.hour
+    for day, hour in slots:
+        diff = abs(hour_of_week - ((day * 24) + hour)) % 168
+        if min(diff, 168 - diff) <= slack:
+            return True
+    return False
+
+def source_is_due(state, slots, now):
+    if (state is None) or (len(slots) == 0) or is_hot(slots, now):
+        return True
+    return now >= datetime.datetime.fromisoformat(state['last_checked']) + datetime.timedelta(minutes=state['interval'])
+
+def schedule_sources(schedule, names, now, force=False):
+    # Work out which sources need checking on this run
+    due = []
+    for name in names:
+        state = schedule.get(name)
+        slots = [tuple(s) for s in state.get('slots', [])] if state is not None else []
+        if len(slots) == 0:
+            slots = window_slots(SOURCES[name]['window'])
+        if force or source_is_due(state, slots, now):
+            due.append(name)
+    return due
+
+def update_schedule(schedule, name, now, summary, base=10, maximum=360):
+    # Poll tightly after a change or inside the publication window, back off exponentially outside it
+    state = schedule.get(name, {'interval': base})
+    if len(summary.get('slots', [])) > 0:
+        state['slots'] = summary['slots']
+    slots = [tuple(s) for s in state.get('slots', [])]
+    if len(slots) == 0:
+        slots = window_slots(SOURCES[name]['window'])
+    if (summary.get('changes', 0) > 0) or is_hot(slots, now):
+        state['interval'] = base
+    else:
+        state['interval'] = min(state['interval'] * 2, maximum)
+    state['last_checked'] = now.isoformat()
+    schedule[name] = state
+    return schedule
+
+def is_new_cog_file(previous, modified, length):
+    if len(previous) == 0:
+        return True
+    return (modified != previous[0]['modified']) and (int(length) != int(previous[0]['length']))
+
+def probe_cog_files(session, baseurl, today, last, previous, workers=8):
+    # HEAD each day's metadata file from today back to the last file, newest first
+    session = pooled_session(session, workers)
+    dates = [today - datetime.timedelta(days=i) for i in range((today - last).days + 1)]
+    urls = ["{baseurl}/phylogenetics/{date}/cog_metadata.csv.gz".format(baseurl=baseurl, date=d.isoformat()) for d in dates]
+    found = []
+    for date, url, resp in zip(dates, urls, head_urls(session, urls, workers, raise_for_status=False)):
+        if (resp.headers.get('Content-Type') == 'application/gzip'):
+            modified = datetime.datetime.strptime(resp.headers['Last-Modified'],'%a, %d %b %Y %H:%M:%S %Z') # e.g Mon, 08 Mar 2021 06:12:35 GMT
+            if is_new_cog_file(previous, modified.isoformat(), resp.headers['Content-Length']):
+                found.append({
+                    'url': url,
+                    'modified': modified.isoformat(),
+                    'length': int(resp.headers['Content-Length']),
+                    'filedate': date.isoformat(),
+                })
+    return found
+
+def list_s3_bucket(session, baseurl, prefix, delimiter=None, startafter=None):
+    # Page through a public bucket's ListObjectsV2 results, returning (keys, prefixes)
+    ns = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+    params = {'list-type': '2', 'prefix': prefix}
+    if delimiter is not None:
+        params['delimiter'] = delimiter
+    if startafter is not None:
+        params['start-after'] = startafter
+    contents = []
+    prefixes = []
+    while True:
+        resp = session.get(baseurl + '/', params=params)
+        resp.raise_for_status()
+        root = ElementTree.fromstring(resp.content)
+        for c in root.iter(ns + 'Contents'):
+            contents.append({
+                'key': c.findtext(ns + 'Key'),
+                'modified': c.findtext(ns + 'LastModified'),
+                'length': int(c.findtext(ns + 'Size')),
+            })
+        prefixes.extend([p.findtext(ns + 'Prefix') for p in root.iter(ns + 'CommonPrefixes')])
+        if root.findtext(ns + 'IsTruncated') != 'true':
+            break
+        params['continuation-token'] = root.findtext(ns + 'NextContinuationToken')
+    return contents, prefixes
+
+def list_cog_files(session, baseurl, today, last, previous):
+    # Find the dated directories since the last file, then check each one, newest first
+    _, prefixes = list_s3_bucket(session, baseurl, 'phylogenetics/', '/', 'phylogenetics/%s' %last.isoformat())
+    dates = []
+    for prefix in prefixes:
+        m = re.search(r'phylogenetics/(\d{4}-\d{2}-\d{2})/$', prefix)
+        if m is not None:
+            date = datetime.datetime.strptime(m.group(1), '%Y-%m-%d').date()
+            if last <= date <= today:
+                dates.append(date)
+    found = []
+    for date in sorted(dates, reverse=True):
+        key = 'phylogenetics/%s/cog_metadata.csv.gz' %date.isoformat()
+        contents, _ = list_s3_bucket(session, baseurl, key)
+        for c in contents:
+            if c['key'] == key:
+                modified = datetime.datetime.strptime(c['modified'][:19], '%Y-%m-%dT%H:%M:%S') # e.g. 2021-03-08T06:12:35.000Z
+                if is_new_cog_file(previous, modified.isoformat(), c['length']):
+                    found.append({
+                        'url': '%s/%s' %(baseurl, key),
+                        'modified': modified.isoformat(),
+                        'length': c['length'],
+                        'filedate': date.isoformat(),
+                    })
+    return found
+
+def check_for_cog_files(s3, bucketname, indexkey, mode='probe', workers=8, baseurl='https://cog-uk.s3.climb.ac.uk'):
     today = datetime.datetime.today().date()
-    session = requests.Session()
+    session = new_session()
 
     previous, index = get_and_sort_index(bucketname, indexkey, s3, 'filedate')
 
@@ -482,20 +669,10 @@ def check_for_cog_files(s3, bucketname, indexkey):
     if last > today:
         return None
 
-    found = []
-    while today >= last:
-        url = "https://cog-uk.s3.climb.ac.uk/phylogenetics/{today}/cog_metadata.csv.gz".format(today=today.isoformat())
-        resp = session.head(url)
-        if (resp.headers['Content-Type'] == 'application/gzip'):
-            modified = datetime.datetime.strptime(resp.headers['Last-Modified'],'%a, %d %b %Y %H:%M:%S %Z') # e.g Mon, 08 Mar 2021 06:12:35 GMT
-            if (modified.isoformat() != previous[0]['modified']) and (int(resp.headers['Content-Length']) != int(previous[0]['length'])):
-                found.append({
-                    'url': url,
-                    'modified': modified.isoformat(),
-                    'length': int(resp.headers['Content-Length']),
-                    'filedate': today.isoformat(),
-                })
-        today -= datetime.timedelta(days=1)
+    if mode == 'list':
+        found = list_cog_files(session, baseurl, today, last, previous)
+    else:
+        found = probe_cog_files(session, baseurl, today, last, previous, workers)
 
     if len(found) == 0:
         return None
@@ -507,7 +684,7 @@ def check_for_cog_files(s3, bucketname, indexkey):
 
 def check_cog(secret, s3, notweet):
     # Check the COG bucket for file changes
-    latest = check_for_cog_files(s3, secret['bucketname'], secret['cog-variants-index'])
+    latest = check_for_cog_files(s3, secret['bucketname'], secret['cog-variants-index'], secret.get('cog-discovery', 'probe'), int(secret.get('cog-head-workers', 8)))
 
     # Launch tweeter for any changes
     if latest is not None:
@@ -531,7 +708,8 @@ def get_all_doh(secret, s3):
     previous = sorted(previous, key=lambda k: k['filedate'], reverse=True)
 
     # Check the DoH site for file changes
-    current, changes = check_for_dd_files(s3, secret['bucketname'], previous, 0)
+    source = SOURCES['dd']
+    current, changes = check_for_dd_files(s3, secret['bucketname'], previous, source['url'], source['regex'], 0, workers=int(secret.get('doh-dd-head-workers', 8)))
 
     # Write any changes back to S3
     if len(changes) > 0:
@@ -542,40 +720,110 @@ def get_all_doh(secret, s3):
 
     return message
 
+def timed_check(context, description, check, summary):
+    start = time.monotonic()
+    try:
+        with context:
+            message = check(summary)
+    except CheckCancelled as e:
+        logging.error(str(e))
+        return 'timed-out', None, time.monotonic() - start
+    except:
+        logging.exception('Caught exception accessing %s' %description)
+        return 'error', None, time.monotonic() - start
+    return 'ok', message, time.monotonic() - start
+
+def run_checks(checks, budget, grace=HTTP_TIMEOUT + 1):
+    # Run each source check in its own thread, cancelling any that pass their deadline. Cancelled
+    # checks stop before their next request, upload, index write or launch, so keep back enough of
+    # the budget for them to finish the request in flight
+    start = time.monotonic()
+    budget = max(0, budget - grace)
+    futures = []
+    messages = []
+    statuses = {}
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        for name, description, check, timeout in checks:
+            summary = {}
+            context = SourceCheck(name)
+            deadline = start + (budget if timeout is None else min(timeout, budget))
+            futures.append((name, description, deadline, summary, context, executor.submit(timed_check, context, description, check, summary)))
+        for name, description, deadline, summary, context, future in futures:
+            try:
+                status, message, seconds = future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                logging.error('Timed out accessing %s' %description)
+                context.cancelled.set()
+                status, message, seconds = 'timed-out', None, time.monotonic() - start
+            else:
+                summaries[name] = summary
+                if message is not None:
+                    messages.append(message)
+            statuses[name] = {'status': status, 'seconds': round(seconds, 3)}
+        # Leaving the block waits for the cancelled checks to stop, so none carry on into the next invocation
+    return messages, statuses, summaries
+
+def make_source_check(secret, event, name):
+    # The S3 client is created inside the check, from the check's own session
+    return lambda summary: check_source(secret, get_client('s3'), event.get(SOURCES[name]['notweet'], False), name, summary)
+
 def lambda_handler(event, context):
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    metrics.reset()
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
     # Set up S3 client
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     messages = []
+    statuses = {}
+    summary = {'not_modified': 0, 'bytes_avoided': 0}
     if event.get('get-all-doh-dd'):
         messages.append(get_all_doh(secret, s3))
     else:
+        # Leave some of the lambda's remaining time to write the response
+        if context is not None:
+            budget = (context.get_remaining_time_in_millis() / 1000) - 2
+        else:
+            budget = 28
+        timeouts = secret.get('scraper-timeouts', {})
+        # Decide which sources to check on this run, if adaptive polling is enabled
+        names = secret.get('scraper-sources', ['hospital', 'nisra', 'ons'])
+        now = datetime.datetime.utcnow()
+        schedule = None
+        if secret.get('scraper-schedule') is not None:
+            schedulestatus = S3_scraper_index(s3, secret['bucketname'], secret['scraper-schedule'])
+            schedule = schedulestatus.get_dict() or {}
+            due = schedule_sources(schedule, names, now, event.get('force', False))
+            for name in names:
+                if name not in due:
+                    statuses[name] = {'status': 'skipped', 'seconds': 0}
+            names = due
         # Run the scraper
-        try:
-            messages.append(check_doh(secret, s3, event.get('hospital-notweet', False), 'hospital'))
-        except:
-            logging.exception('Caught exception accessing DOH hospital data')
-        try:
-            messages.append(check_nisra(secret, s3, event.get('nisra-notweet', False)))
-        except:
-            logging.exception('Caught exception accessing NISRA weekly data')
-        try:
-            messages.append(check_ons(secret, s3, event.get('ons-notweet', False)))
-        except:
-            logging.exception('Caught exception accessing ONS CIS data')
-        try:
-            messages.append(check_cog(secret, s3, event.get('variants-notweet', False)))
-        except:
-            logging.exception('Caught exception accessing COG variants data')
+        checks = [(name, SOURCES[name]['description'], make_source_check(secret, event, name), timeouts.get(name)) for name in names]
+        checks.append(('cog', 'COG variants data', lambda summary: check_cog(secret, get_client('s3'), event.get('variants-notweet', False)), timeouts.get('cog')))
+        messages, results, summaries = run_checks(checks, budget)
+        statuses.update(results)
+        for checked in summaries.values():
+            for key in summary:
+                summary[key] += checked.get(key, 0)
+        # Back off polling of the sources that were checked successfully
+        if schedule is not None:
+            for name in names:
+                if statuses[name]['status'] == 'ok':
+                    update_schedule(schedule, name, now, summaries[name])
+            schedulestatus.put_dict(schedule)
+
+    metrics.emit('scraper', sources=statuses)
 
     return {
         "statusCode": 200,
         "body": json.dumps({
             "messages": messages,
+            "sources": statuses,
+            "validator_cache": summary,
         }),
     }
@@ -1,33 +1,571 @@
 import json
+import os
+import time
+import base64
+import sqlite3
+import hashlib
+import functools
+import threading
+from copy import deepcopy
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import botocore.config
+import botocore.exceptions
+import requests
+
+class Metrics:
+    # Thread-safe call counts, timings and counters for one lambda run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+            self.start = time.monotonic()
+
+    def add_timing(self, name, seconds):
+        with self.lock:
+            entry = self.timings.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'seconds': round(time.monotonic() - self.start, 3),
+                'timings': {k: {'calls': v['calls'], 'seconds': round(v['seconds'], 3), 'max': round(v['max'], 3)} for k,v in self.timings.items()},
+                'counters': dict(self.counters),
+            }
+
+    def emit(self, name, **fields):
+        # One JSON line per run, so it can be picked out of the CloudWatch logs
+        line = {'metrics': name}
+        line.update(fields)
+        line.update(self.snapshot())
+        print(json.dumps(line))
+        return line
+
+metrics = Metrics()
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.add_timing(name, time.monotonic() - start)
+        return wrapper
+    return decorator
+
+# How long a request waits to connect, or for more data, before giving up, so that a cancelled
+# source check is never left waiting on the network
+HTTP_TIMEOUT = float(os.getenv('SCRAPER_HTTP_TIMEOUT', 10))
+
+class TimeoutAdapter(requests.adapters.HTTPAdapter):
+    # Applies HTTP_TIMEOUT to requests made without a timeout of their own
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=HTTP_TIMEOUT if timeout is None else timeout, **kwargs)
+
+class FixtureAdapter(TimeoutAdapter):
+    # Records real responses into a directory of fixtures, or replays them without touching the network
+    def __init__(self, dirname, mode='replay', **kwargs):
+        super().__init__(**kwargs)
+        self.dirname = dirname
+        self.mode = mode
+        os.makedirs(dirname, exist_ok=True)
+
+    def fixture_path(self, request):
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+        key = hashlib.sha1(b'\n'.join([request.method.encode(), request.url.encode(), body])).hexdigest()
+        return os.path.join(self.dirname, '%s.json' %key)
+
+    def send(self, request, **kwargs):
+        path = self.fixture_path(request)
+        if self.mode == 'record':
+            resp = super().send(request, **kwargs)
+            fixture = {
+                'method': request.method,
+                'url': request.url,
+                'status': resp.status_code,
+                'headers': dict(resp.headers),
+                'body': base64.b64encode(resp.content).decode(),
+            }
+            with open(path, 'w') as f:
+                json.dump(fixture, f)
+            return resp
+        try:
+            with open(path) as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            raise requests.exceptions.ConnectionError('No fixture for %s %s' %(request.method, request.url), request=request) from None
+        resp = requests.Response()
+        resp.status_code = fixture['status']
+        resp.headers = requests.structures.CaseInsensitiveDict(fixture['headers'])
+        # The body is stored decoded
+        resp.headers.pop('Content-Encoding', None)
+        resp._content = base64.b64decode(fixture['body'])
+        resp.url = request.url
+        resp.request = request
+        resp.reason = requests.status_codes._codes.get(resp.status_code, [''])[0].upper()
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        return resp
+
+def new_session(pool=None):
+    # A requests session, which records or replays fixtures if SCRAPER_FIXTURES is set
+    session = requests.Session()
+    dirname = os.getenv('SCRAPER_FIXTURES')
+    kwargs = {} if pool is None else {'pool_connections': pool, 'pool_maxsize': pool}
+    if dirname is not None:
+        adapter = FixtureAdapter(dirname, os.getenv('SCRAPER_FIXTURE_MODE', 'replay'), **kwargs)
+    else:
+        adapter = TimeoutAdapter(**kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Replaced by local stand-ins when running handlers offline
+client_factory = boto3.client
+
+class CheckCancelled(Exception):
+    pass
+
+# The source check running in each thread, if any
+_checks = threading.local()
+
+class SourceCheck:
+    # A scraper source check run in its own thread. It has its own boto3 session, as sessions are
+    # not thread-safe, and is cancelled once past its deadline, after which it makes no more requests,
+    # uploads, index writes or launches
+    def __init__(self, name):
+        self.name = name
+        self.session = boto3.session.Session()
+        self.config = botocore.config.Config(connect_timeout=HTTP_TIMEOUT, read_timeout=HTTP_TIMEOUT)
+        self.cancelled = threading.Event()
+
+    def __enter__(self):
+        self.outer = getattr(_checks, 'current', None)
+        _checks.current = self
+        return self
+
+    def __exit__(self, *exc):
+        _checks.current = self.outer
+
+    def propagate(self, func):
+        # func, run as part of this check from a worker thread
+        def run(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return run
+
+def current_check():
+    return getattr(_checks, 'current', None)
+
+def propagate_check(func):
+    # Worker threads don't inherit the check of the thread handing them work
+    check = current_check()
+    return func if check is None else check.propagate(func)
+
+def ensure_not_cancelled(action):
+    check = current_check()
+    if (check is not None) and check.cancelled.is_set():
+        raise CheckCancelled('Check of %s cancelled before %s' %(check.name, action))
+
+def get_client(name):
+    check = current_check()
+    if (check is not None) and (client_factory is boto3.client):
+        return check.session.client(name, config=check.config)
+    return client_factory(name)
+
+# Parsed indexes from earlier invocations of a warm lambda container, by (bucket, key)
+_index_cache = {}
+_missing = object()
+
+def _error_code(err):
+    return err.response.get('Error', {}).get('Code')
+
+# Without s3:ListBucket a missing key is refused with a 403, rather than reported as not found
+MISSING_KEY_CODES = ('NoSuchKey', '404', 'AccessDenied', '403')
+
+def is_missing_key(err):
+    return isinstance(err, botocore.exceptions.ClientError) and (_error_code(err) in MISSING_KEY_CODES)
+
+def _merge_record(base, ours, theirs):
+    # Three-way merge of one index entry, None meaning the entry is absent
+    if ours == base:
+        return theirs
+    if (theirs == base) or (theirs == ours):
+        return ours
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = base or {}
+        merged = dict(theirs)
+        for field in set(ours) | set(base):
+            if ours.get(field, _missing) != base.get(field, _missing):
+                if field in ours:
+                    merged[field] = ours[field]
+                else:
+                    merged.pop(field, None)
+        return merged
+    # Both sides changed the same value, so ours wins
+    return ours
+
+def merge_index(base, ours, theirs, key='filedate'):
+    # Re-apply the changes we made to base on top of theirs, the index as it now is in S3
+    if isinstance(ours, dict):
+        base = base or {}
+        theirs = theirs or {}
+        keys = list(theirs) + [k for k in ours if k not in theirs]
+        merged = {k: _merge_record(base.get(k), ours.get(k), theirs.get(k)) for k in keys}
+        return {k: v for k, v in merged.items() if v is not None}
+    def keys_of(entries):
+        # Entries sharing a value, such as republished files of one date, are told apart by their order
+        seen = {}
+        keys = []
+        for e in entries:
+            keys.append((e[key], seen.get(e[key], 0)))
+            seen[e[key]] = keys[-1][1] + 1
+        return keys
+    def by_key(entries):
+        return dict(zip(keys_of(entries), entries))
+    bases, ourss, theirss = by_key(base), by_key(ours), by_key(theirs)
+    keys = keys_of(theirs) + [k for k in keys_of(ours) if k not in theirss]
+    merged = [_merge_record(bases.get(k), ourss.get(k), theirss.get(k)) for k in keys]
+    merged = [e for e in merged if e is not None]
+    if [e[key] for e in ours] == sorted([e[key] for e in ours], reverse=True):
+        merged = sorted(merged, key=lambda e: e[key], reverse=True)
+    return merged
 
 class S3_scraper_index:
-    def __init__(self, client, bucketname, keyname):
+    # The index is cached between warm invocations and revalidated by ETag, and writes only
+    # succeed if nobody else has written since we read, otherwise our changes are re-merged
+    def __init__(self, client, bucketname, keyname, key='filedate', retries=3):
         self.client = client
         self.bucketname = bucketname
         self.keyname = keyname
+        self.key = key
+        self.retries = retries
+        self.etag = None
+        self.base = []
+
+    def fetch(self):
+        cached = _index_cache.get((self.bucketname, self.keyname))
+        kwargs = {}
+        if cached is not None:
+            kwargs['IfNoneMatch'] = cached[0]
+        try:
+            dataobj = self.client.get_object(Bucket=self.bucketname,Key=self.keyname,**kwargs)
+        except botocore.exceptions.ClientError as err:
+            if is_missing_key(err):
+                print("The object %s does not exist in bucket %s." %(self.keyname, self.bucketname))
+                _index_cache.pop((self.bucketname, self.keyname), None)
+                return None, []
+            if (cached is None) or (_error_code(err) not in ('304', 'NotModified')):
+                raise
+            metrics.count('index.not_modified')
+            return cached[0], deepcopy(cached[1])
+        metrics.count('s3.bytes_read', dataobj.get('ContentLength', 0))
+        data = json.load(dataobj['Body'])
+        _index_cache[(self.bucketname, self.keyname)] = (dataobj['ETag'], deepcopy(data))
+        return dataobj['ETag'], data
 
+    @timed('S3_scraper_index.get_dict')
     def get_dict(self):
+        self.etag, data = self.fetch()
+        self.base = deepcopy(data)
+        return data
+
+    def conditional_put(self, body):
+        if self.etag is None:
+            condition = {'IfNoneMatch': '*'}
+        else:
+            condition = {'IfMatch': self.etag}
         try:
-            dataobj = self.client.get_object(Bucket=self.bucketname,Key=self.keyname)
-        except self.client.exceptions.NoSuchKey:
-            print("The object %s does not exist in bucket %s." %(self.keyname, self.bucketname))
-            return []
-        return json.load(dataobj['Body'])
+            return self.client.put_object(Bucket=self.bucketname, Key=self.keyname, Body=body, **condition)
+        except botocore.exceptions.ParamValidationError:
+            # Older botocore has no conditional writes
+            return self.client.put_object(Bucket=self.bucketname, Key=self.keyname, Body=body)
 
+    @timed('S3_scraper_index.put_dict')
     def put_dict(self, data):
-        self.client.put_object(Bucket=self.bucketname, Key=self.keyname, Body=json.dumps(data))
+        ensure_not_cancelled('writing %s' %self.keyname)
+        for attempt in range(self.retries + 1):
+            body = json.dumps(data)
+            metrics.count('s3.bytes_written', len(body))
+            try:
+                resp = self.conditional_put(body)
+            except botocore.exceptions.ClientError as err:
+                if (attempt == self.retries) or (_error_code(err) not in ('PreconditionFailed', 'ConditionalRequestConflict')):
+                    raise
+                # Someone else wrote the index since we read it, so apply our changes to theirs
+                metrics.count('index.conflicts')
+                etag, theirs = self.fetch()
+                data = merge_index(self.base, data, theirs, self.key)
+                self.etag = etag
+                self.base = deepcopy(theirs)
+                continue
+            self.etag = resp.get('ETag')
+            self.base = deepcopy(data)
+            if self.etag is not None:
+                _index_cache[(self.bucketname, self.keyname)] = (self.etag, deepcopy(data))
+            return data
+
+class S3_validator_cache:
+    def __init__(self, client, bucketname, keyname):
+        self.client = client
+        self.bucketname = bucketname
+        self.keyname = keyname
+        self.validators = None
+        self.changed = False
+        self.not_modified = 0
+        self.bytes_avoided = 0
+
+    def get_dict(self):
+        if self.validators is None:
+            try:
+                dataobj = self.client.get_object(Bucket=self.bucketname,Key=self.keyname)
+            except botocore.exceptions.ClientError as err:
+                if not is_missing_key(err):
+                    raise
+                print("The object %s does not exist in bucket %s." %(self.keyname, self.bucketname))
+                self.validators = {}
+            else:
+                self.validators = json.load(dataobj['Body'])
+        return self.validators
+
+    def headers(self, url):
+        # Conditional request headers for a URL we have seen before
+        entry = self.get_dict().get(url, {})
+        headers = {}
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last-modified' in entry:
+            headers['If-Modified-Since'] = entry['last-modified']
+        return headers
+
+    def record(self, url, resp):
+        if resp.status_code == 304:
+            self.not_modified += 1
+            self.bytes_avoided += self.get_dict().get(url, {}).get('length', 0)
+            return
+        entry = {}
+        if 'ETag' in resp.headers:
+            entry['etag'] = resp.headers['ETag']
+        if 'Last-Modified' in resp.headers:
+            entry['last-modified'] = resp.headers['Last-Modified']
+        if len(entry) > 0:
+            entry['length'] = len(resp.content)
+        if self.get_dict().get(url) != entry:
+            if len(entry) > 0:
+                self.validators[url] = entry
+            else:
+                self.validators.pop(url, None)
+            self.changed = True
+
+    def put_dict(self):
+        # Only store the validators once the source has been fully processed
+        if self.changed is True:
+            ensure_not_cancelled('writing %s' %self.keyname)
+            self.client.put_object(Bucket=self.bucketname, Key=self.keyname, Body=json.dumps(self.validators))
+            self.changed = False
+
+    def summarise(self, summary):
+        summary['not_modified'] = summary.get('not_modified', 0) + self.not_modified
+        summary['bytes_avoided'] = summary.get('bytes_avoided', 0) + self.bytes_avoided
+        return summary
+
+def validator_keyname(indexkey):
+    # Validators are kept next to the scraper index they relate to
+    return '%s-validators.json' %os.path.splitext(indexkey)[0]
+
+class S3_report_history:
+    # Totals reported for each file date, in a SQLite database kept in S3 with filedate as its
+    # primary key. A copy is kept in /tmp between warm invocations and revalidated by ETag, and
+    # saves only succeed if nobody else has saved since we loaded, otherwise our changes are re-applied
+    def __init__(self, client, bucketname, keyname, columns, retries=3):
+        self.client = client
+        self.bucketname = bucketname
+        self.keyname = keyname
+        self.columns = columns
+        self.retries = retries
+        self.path = os.path.join(os.getenv('REPORT_HISTORY_DIR', '/tmp'), '%s.sqlite' %hashlib.sha1(('%s/%s' %(bucketname, keyname)).encode()).hexdigest())
+        self.etag = None
+        self.db = None
+        self.pending = []
+
+    def load(self):
+        # Returns False if there is no history in S3 yet
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        kwargs = {}
+        if os.path.exists(self.path) and os.path.exists(self.path + '.etag'):
+            with open(self.path + '.etag') as f:
+                kwargs['IfNoneMatch'] = f.read()
+        try:
+            dataobj = self.client.get_object(Bucket=self.bucketname,Key=self.keyname,**kwargs)
+        except botocore.exceptions.ClientError as err:
+            if is_missing_key(err):
+                print("The object %s does not exist in bucket %s." %(self.keyname, self.bucketname))
+                for path in (self.path, self.path + '.etag'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.etag = None
+                self.connect()
+                return False
+            if ('IfNoneMatch' not in kwargs) or (_error_code(err) not in ('304', 'NotModified')):
+                raise
+            metrics.count('history.not_modified')
+            self.etag = kwargs['IfNoneMatch']
+        else:
+            with open(self.path, 'wb') as f:
+                for chunk in iter(lambda: dataobj['Body'].read(1024*1024), b''):
+                    f.write(chunk)
+            with open(self.path + '.etag', 'w') as f:
+                f.write(dataobj['ETag'])
+            self.etag = dataobj['ETag']
+        self.connect()
+        return True
+
+    def connect(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('CREATE TABLE IF NOT EXISTS reports (filedate TEXT PRIMARY KEY, tweet INTEGER, %s)' %', '.join('"%s" INTEGER' %c for c in self.columns))
+        existing = [row['name'] for row in self.db.execute('PRAGMA table_info(reports)')]
+        for column in self.columns:
+            if column not in existing:
+                self.db.execute('ALTER TABLE reports ADD COLUMN "%s" INTEGER' %column)
+        self.db.commit()
+
+    def row(self, row):
+        if row is None:
+            return None
+        return {k: row[k] for k in row.keys()}
+
+    def get(self, filedate):
+        return self.row(self.db.execute('SELECT * FROM reports WHERE filedate = ?', (filedate,)).fetchone())
+
+    def recent(self, n, before=None):
+        # The n latest reports, optionally those before a file date, newest first
+        if before is None:
+            rows = self.db.execute('SELECT * FROM reports ORDER BY filedate DESC LIMIT ?', (n,))
+        else:
+            rows = self.db.execute('SELECT * FROM reports WHERE filedate < ? ORDER BY filedate DESC LIMIT ?', (before, n))
+        return [self.row(r) for r in rows]
+
+    def between(self, start, end):
+        rows = self.db.execute('SELECT * FROM reports WHERE filedate >= ? AND filedate <= ? ORDER BY filedate', (start, end))
+        return [self.row(r) for r in rows]
 
+    def apply(self, filedate, totals, tweet):
+        # An update then insert, as the sqlite on Lambda predates upsert
+        columns = [c for c in self.columns if c in totals]
+        values = [totals[c] for c in columns]
+        if tweet is not None:
+            columns.append('tweet')
+            values.append(tweet)
+        updated = 0
+        if len(columns) > 0:
+            updated = self.db.execute(
+                'UPDATE reports SET %s WHERE filedate = ?' %', '.join('"%s" = ?' %c for c in columns),
+                values + [filedate]
+            ).rowcount
+        if updated == 0:
+            self.db.execute(
+                'INSERT OR IGNORE INTO reports (filedate%s) VALUES (?%s)' %(''.join(', "%s"' %c for c in columns), ', ?' * len(columns)),
+                [filedate] + values
+            )
+        self.db.commit()
+
+    def put(self, filedate, totals, tweet=None):
+        self.apply(filedate, totals, tweet)
+        self.pending.append((filedate, totals, tweet))
+
+    def seed(self, index):
+        # Take the totals from an index which still carries them
+        for e in index:
+            if 'totals' in e:
+                self.put(e['filedate'], e['totals'], e.get('tweet'))
+
+    def conditional_put(self, body):
+        if self.etag is None:
+            condition = {'IfNoneMatch': '*'}
+        else:
+            condition = {'IfMatch': self.etag}
+        try:
+            return self.client.put_object(Bucket=self.bucketname, Key=self.keyname, Body=body, **condition)
+        except botocore.exceptions.ParamValidationError:
+            return self.client.put_object(Bucket=self.bucketname, Key=self.keyname, Body=body)
+
+    @timed('S3_report_history.save')
+    def save(self):
+        for attempt in range(self.retries + 1):
+            self.db.close()
+            with open(self.path, 'rb') as f:
+                body = f.read()
+            try:
+                resp = self.conditional_put(body)
+            except botocore.exceptions.ClientError as err:
+                if (attempt == self.retries) or (_error_code(err) not in ('PreconditionFailed', 'ConditionalRequestConflict')):
+                    self.connect()
+                    raise
+                # Someone else saved since we loaded, so re-apply our changes to theirs
+                metrics.count('history.conflicts')
+                if os.path.exists(self.path + '.etag'):
+                    os.remove(self.path + '.etag')
+                self.load()
+                for filedate, totals, tweet in self.pending:
+                    self.apply(filedate, totals, tweet)
+                continue
+            self.etag = resp.get('ETag')
+            if self.etag is not None:
+                with open(self.path + '.etag', 'w') as f:
+                    f.write(self.etag)
+            self.pending = []
+            self.connect()
+            return
+
+def history_keyname(indexkey):
+    # The report history is kept next to the scraper index it relates to
+    return '%s-history.sqlite' %os.path.splitext(indexkey)[0]
+
+def open_report_history(status, columns):
+    # The report history for a scraper index, created from the totals in the index the
+    # first time, after which the index is left holding only file metadata
+    history = S3_report_history(status.client, status.bucketname, history_keyname(status.keyname), columns)
+    if history.load() is False:
+        index = status.get_dict()
+        history.seed(index)
+        history.save()
+        for e in index:
+            e.pop('totals', None)
+            e.pop('tweet', None)
+        status.put_dict(index)
+    return history
+
+@timed('launch_lambda_async')
 def launch_lambda_async(functionname, payload):
-    lambda_client = boto3.client('lambda')
+    ensure_not_cancelled('launching %s' %functionname)
+    lambda_client = get_client('lambda')
     lambda_client.invoke(
         FunctionName=functionname,
         InvocationType='Event',
         Payload=json.dumps(payload)
     )
 
-def get_url(session, url, format, useragent=None, referer=None, upgradeinsecure=False):
+@timed('get_url')
+def get_url(session, url, format, useragent=None, referer=None, upgradeinsecure=False, validators=None):
     headers = {
         'Cache-Control': 'no-cache',
         'Pragma': 'no-cache',
@@ -40,11 +578,23 @@ def get_url(session, url, format, useragent=None, referer=None, upgradeinsecure=
         headers['Upgrade-Insecure-Requests'] = '1'
         headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'
         headers['Accept-Language'] = 'en-GB,en;q=0.5'
+    if validators is not None:
+        headers.update(validators.headers(url))
+    ensure_not_cancelled('fetching %s' %url)
     resp = session.get(
         url,
-        headers=headers
+        headers=headers,
+        stream=(format=='stream')
     )
     resp.raise_for_status()
+    metrics.count('http.requests')
+    if format=='stream':
+        return(resp)
+    metrics.count('http.bytes', len(resp.content))
+    if validators is not None:
+        validators.record(url, resp)
+        if resp.status_code == 304:
+            return None
     if format=='text':
         return(resp.text)
     elif format=='content':
@@ -52,8 +602,161 @@ def get_url(session, url, format, useragent=None, referer=None, upgradeinsecure=
     else:
         return(resp.json())
 
+def fixed_size_chunks(iterable, chunksize):
+    # Re-block an iterable of byte strings into chunks of exactly chunksize (bar the last)
+    buffer = bytearray()
+    for data in iterable:
+        buffer.extend(data)
+        while len(buffer) >= chunksize:
+            # Copy the chunk out once, releasing the view before the buffer is resized
+            with memoryview(buffer) as view:
+                chunk = bytes(view[:chunksize])
+            del buffer[:chunksize]
+            yield chunk
+            del chunk
+    if len(buffer) > 0:
+        yield bytes(buffer)
+
+@timed('upload_url_to_s3')
+def upload_url_to_s3(session, url, s3client, bucketname, keyname, chunksize=8*1024*1024, skip_sha256=None):
+    # Stream a download into S3 without holding the whole file in memory,
+    # small files are sent with a single put, larger ones as a multipart upload.
+    # Returns the SHA-256 of the content, which is not stored if it matches skip_sha256
+    resp = get_url(session, url, 'stream')
+    sha256 = hashlib.sha256()
+    with resp:
+        chunks = fixed_size_chunks(resp.iter_content(chunk_size=64*1024), chunksize)
+        first = next(chunks, b'')
+        second = next(chunks, None)
+        if second is None:
+            sha256.update(first)
+            if sha256.hexdigest() != skip_sha256:
+                ensure_not_cancelled('uploading %s' %keyname)
+                metrics.count('s3.bytes_written', len(first))
+                s3client.put_object(Bucket=bucketname, Key=keyname, Body=first)
+            return sha256.hexdigest()
+        ensure_not_cancelled('uploading %s' %keyname)
+        upload = s3client.create_multipart_upload(Bucket=bucketname, Key=keyname)
+        try:
+            parts = []
+            # Hand the two chunks already read over to the loop, rather than holding them until the end
+            pending = [first, second]
+            del first, second
+            def remaining():
+                while len(pending) > 0:
+                    yield pending.pop(0)
+                yield from chunks
+            for number, chunk in enumerate(remaining(), start=1):
+                sha256.update(chunk)
+                ensure_not_cancelled('uploading %s' %keyname)
+                metrics.count('s3.bytes_written', len(chunk))
+                part = s3client.upload_part(Bucket=bucketname, Key=keyname, PartNumber=number, UploadId=upload['UploadId'], Body=chunk)
+                parts.append({'ETag': part['ETag'], 'PartNumber': number})
+            if sha256.hexdigest() == skip_sha256:
+                # Nothing new, so throw the parts away rather than store a second copy
+                s3client.abort_multipart_upload(Bucket=bucketname, Key=keyname, UploadId=upload['UploadId'])
+            else:
+                ensure_not_cancelled('uploading %s' %keyname)
+                s3client.complete_multipart_upload(Bucket=bucketname, Key=keyname, UploadId=upload['UploadId'], MultipartUpload={'Parts': parts})
+        except:
+            s3client.abort_multipart_upload(Bucket=bucketname, Key=keyname, UploadId=upload['UploadId'])
+            raise
+    return sha256.hexdigest()
+
+def pooled_session(session, workers):
+    # Make sure the session keeps enough connections alive for the worker threads
+    if session is None:
+        session = new_session()
+    if workers > 1:
+        pooled = new_session(workers)
+        session.adapters = pooled.adapters
+    return session
+
+def head_urls(session, urls, workers=1, raise_for_status=True):
+    # HEAD each URL with at most `workers` requests in flight, results are in the same order as `urls`
+    @timed('head_url')
+    def head(url):
+        ensure_not_cancelled('fetching %s' %url)
+        resp = session.head(url)
+        if raise_for_status is True:
+            resp.raise_for_status()
+        return resp
+    if (workers <= 1) or (len(urls) <= 1):
+        return [head(url) for url in urls]
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        return list(executor.map(propagate_check(head), urls))
+
+class LinkExtractor(HTMLParser):
+    # Collects (href, text) of <a> tags, optionally only inside <element class="htmlclass"> containers,
+    # ignoring everything else on the page rather than building a tree of it
+    def __init__(self, element=None, htmlclass=None, match=None, number=0, first_per_container=False):
+        super().__init__()
+        self.element = element
+        self.htmlclass = htmlclass
+        self.match = match
+        self.number = number
+        self.first_per_container = first_per_container
+        self.depth = 0 if element is None else None
+        self.taken = False
+        self.anchor = None
+        self.links = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if self.element is not None and tag == self.element:
+            if self.depth is not None:
+                self.depth += 1
+            elif self.htmlclass in (dict(attrs).get('class') or '').split():
+                self.depth = 0
+                self.taken = False
+        elif tag == 'a' and self.depth is not None:
+            href = dict(attrs).get('href')
+            if href is not None:
+                self.anchor = (href, [])
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == 'a' and self.anchor is not None:
+            href, text = self.anchor
+            self.anchor = None
+            if (self.first_per_container and self.taken) or (self.depth is None):
+                return
+            text = ''.join(text)
+            if (self.match is None) or self.match(href, text):
+                self.links.append((href, text))
+                self.taken = True
+                self.done = (self.number > 0) and (len(self.links) >= self.number)
+        elif self.element is not None and tag == self.element and self.depth is not None:
+            self.depth = None if self.depth == 0 else self.depth - 1
+
+    def handle_data(self, data):
+        if self.anchor is not None:
+            self.anchor[1].append(data)
+
+@timed('extract_links')
+def extract_links(text, element=None, htmlclass=None, match=None, number=0, first_per_container=False, blocksize=64*1024):
+    # Feed the page in blocks, so we can stop reading once enough links have been found
+    parser = LinkExtractor(element, htmlclass, match, number, first_per_container)
+    for start in range(0, len(text), blocksize):
+        parser.feed(text[start:start+blocksize])
+        if parser.done:
+            break
+    else:
+        parser.close()
+    return parser.links
+
+def find_link(text, match, last=False):
+    # The href of the first (or last) link on the page for which match(href, text) holds
+    links = extract_links(text, match=match, number=0 if last else 1)
+    if len(links) == 0:
+        return None
+    return links[-1][0] if last else links[0][0]
+
 def get_and_sort_index(bucketname, indexkey, s3, sortby='Last Updated'):
-    status = S3_scraper_index(s3, bucketname, indexkey)
+    status = S3_scraper_index(s3, bucketname, indexkey, sortby)
     previous = status.get_dict()
     if len(previous) > 0:
         previous = sorted(previous, key=lambda k: k[sortby], reverse=True)
@@ -1,59 +1,109 @@
 import json
-import io
 import logging
 
-import boto3
 import pandas
 
-from shared import S3_scraper_index
+from shared import S3_scraper_index, get_client
+from data_shared import migrate_csv_datastore, convert_workbook, Workbook, SNAPSHOT_SHEETS, parse_reports, push_partitions_to_s3, push_csv_to_s3, get_partitioned_datastore, VintagePanel
+
+TESTS_COLUMNS = ['Total Lab Tests','Individ with Lab Test','Individ with Positive Lab Test']
+
+def load_tests_report(bucketname, item):
+    # Runs in a worker process, so gets its own client
+    try:
+        workbook = Workbook.from_s3(get_client('s3'), bucketname, item['keyname'])
+        # Load test data
+        daily = workbook.sheet('Tests')
+        workbook.close()
+        # Take only the required columns
+        daily = daily.groupby(['Date of Specimen']).sum()[TESTS_COLUMNS].reset_index()
+        # Add reported date
+        daily['Reported_Date'] = pandas.to_datetime(item['filedate'], format='%Y-%m-%d')
+    except:
+        logging.exception('Error loading %s' %item)
+        raise
+    return daily[['Date of Specimen','Reported_Date'] + TESTS_COLUMNS]
 
 def lambda_handler(event, context):
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     if event.get('mode') == 'aggregate':
-        # Get the index of all reports
+        # Get the index of all reports, and of those already folded into the dataset
         status = S3_scraper_index(s3, secret['bucketname'], secret['doh-dd-index'])
         index = status.get_dict()
+        prefix = event.get('prefix', secret.get('doh-dd-all-tests', 'DoH-DD/all_tests'))
+        folded = S3_scraper_index(s3, secret['bucketname'], '%s/reports.json' %prefix, key='keyname')
+        done = folded.get_dict()
+        if event.get('rebuild', False):
+            done = []
+
+        # Each report date is a partition, so all the reports of a date are read again if any of them is new
+        known = set(item['keyname'] for item in done)
+        dates = set(item['filedate'] for item in index if item['keyname'] not in known)
+        items = [item for item in index if item['filedate'] in dates]
+        workers = event.get('workers', secret.get('tests-cleaner-workers'))
+        frames = parse_reports(items, lambda item: load_tests_report(secret['bucketname'], item), None if workers is None else int(workers))
 
-        allreports = pandas.DataFrame(columns=['Date of Specimen','Reported_Date','Total Lab Tests','Individ with Lab Test','Individ with Positive Lab Test'])
-        # Download the most recently updated Excel file
-        for item in index:
+        if len(frames) > 0:
+            allreports = pandas.concat(frames, ignore_index=True)
+            push_partitions_to_s3(allreports, s3, secret['bucketname'], prefix, 'Reported_Date')
+        folded.put_dict([item for item in done if item['filedate'] not in dates] + [{'keyname': item['keyname'], 'filedate': item['filedate']} for item in items])
+
+        message = 'Folded %d reports into %d partitions of %s' %(len(items), len(dates), prefix)
+    elif event.get('mode') == 'convert-workbooks':
+        # Snapshot the sheets of files scraped before the converter existed
+        source = event.get('source', 'dd')
+        status = S3_scraper_index(s3, secret['bucketname'], secret[event.get('index', 'doh-dd-index')])
+        converted = 0
+        for item in status.get_dict():
             try:
-                obj = s3.get_object(Bucket=secret['bucketname'],Key=item['keyname'])['Body']
-                stream = io.BytesIO(obj.read())
-                # Load test data
-                daily = pandas.read_excel(stream,engine='openpyxl',sheet_name='Tests')
-                # Take only the required columns
-                daily = daily.groupby(['Date of Specimen']).sum()[['Total Lab Tests','Individ with Lab Test','Individ with Positive Lab Test']].reset_index()
-                # Add reported date
-                daily['Reported_Date'] = pandas.to_datetime(item['filedate'], format='%Y-%m-%d')
+                converted += len(convert_workbook(s3, secret['bucketname'], item['keyname'], SNAPSHOT_SHEETS[source]))
             except:
-                logging.exception('Error loading %s' %item)
-                raise
-
-            # Combine with the other data reports
-            allreports = pandas.concat([allreports, daily])
+                logging.exception('Error converting %s' %item)
 
-        # Write the output to CSV
-        keyname = 'DoH-DD/all_tests.csv'
-        csvbuffer = io.StringIO()
-        allreports.to_csv(csvbuffer, index=False)
-        s3.put_object(Bucket=secret['bucketname'], Key='DoH-DD/all_tests.csv', Body=csvbuffer.getvalue())
+        message = 'Wrote %d sheet snapshots for %s' %(converted, source)
+    elif event.get('mode') == 'migrate-datastore':
+        # Split a CSV datastore into date partitions, the secret then needs to point at the new prefix
+        keyname = event['keyname']
+        prefix = event.get('prefix', keyname.rsplit('.', maxsplit=1)[0])
+        partitions = migrate_csv_datastore(s3, secret['bucketname'], keyname, prefix, event.get('datecol', 'Date'))
 
-        message = 'Wrote %d rows to %s' %(len(allreports), keyname)
+        message = 'Wrote %d partitions from %s to %s' %(partitions, keyname, prefix)
     else:
-        obj = s3.get_object(Bucket=secret['bucketname'],Key='DoH-DD/all_tests.csv')['Body']
-        stream = io.BytesIO(obj.read())
-        # Load test data
-        df = pandas.read_csv(stream)
+        # Load test data into a panel of specimen dates by report
+        df = get_partitioned_datastore(s3, secret['bucketname'], event.get('prefix', secret.get('doh-dd-all-tests', 'DoH-DD/all_tests')), 'Reported_Date')
+        panel = VintagePanel(df, TESTS_COLUMNS)
 
-        print(df.columns)
+        query = event.get('query')
+        if query is None:
+            print('%d reports from %s to %s, of specimen dates from %s to %s' %(len(panel.reports), panel.reports[0], panel.reports[-1], panel.dates[0], panel.dates[-1]))
+            result = None
+        elif query == 'as-reported':
+            result = panel.as_reported(event.get('report'))
+        elif query == 'newly-reported':
+            result = panel.newly_reported(event['start'], event['end'])
+        elif query == 'new-per-report':
+            result = panel.new_per_report()
+        elif query == 'last-24-hours':
+            result = panel.last_24_hours()
+        elif query == 'revisions':
+            result = panel.revisions(event.get('value', 'Individ with Lab Test'), event.get('relative', True), event.get('max_days'))
+            result.columns = result.columns.astype(str)
+        else:
+            raise ValueError('Unknown query %s' %query)
 
-        message = 'Done'
+        if result is None:
+            message = 'Done'
+        elif event.get('keyname') is not None:
+            push_csv_to_s3(result.reset_index(), s3, secret['bucketname'], event['keyname'])
+            message = 'Wrote %d rows of %s to %s' %(len(result), query, event['keyname'])
+        else:
+            print(result.tail(10))
+            message = 'Found %d rows of %s' %(len(result), query)
 
     return {
         "statusCode": 200,
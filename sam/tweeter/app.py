@@ -1,18 +1,16 @@
 import json
-import io
 import datetime
 import os
 import logging
 
-import boto3
 import pandas
 import numpy
 import altair
 
-from shared import S3_scraper_index
+from shared import S3_scraper_index, open_report_history, get_client
 from twitter_shared import TwitterAPI
 from plot_shared import get_chrome_driver, plot_key_ni_stats_date_range, plot_points_average_and_trend, output_plot, plot_heatmap
-from data_shared import get_ni_pop_pyramid, update_datastore
+from data_shared import population_store, S3_datastore, frame_cache, Workbook
 
 good_symb = '\u2193'
 bad_symb = '\u2191'
@@ -59,8 +57,8 @@ def create_model(df, to_model, datekey):
     df['%s model_weekly_change' %to_model] = (fit_exp(df['%s model0'%to_model], df['%s model1'%to_model], 8) - fit_exp(df['%s model0'%to_model], df['%s model1'%to_model], 1)) / fit_exp(df['%s model0'%to_model], df['%s model1'%to_model], 1)
     return(df)
 
-def load_ni_time_series(url, sheet_name, date_col, series_col, model=False, filter_col=None, filter=None):
-    df = pandas.read_excel(url, engine='openpyxl', sheet_name=sheet_name)
+def load_ni_time_series(workbook, sheet_name, date_col, series_col, model=False, filter_col=None, filter=None):
+    df = workbook.sheet(sheet_name, usecols=[date_col, series_col] + ([] if filter_col is None else [filter_col]))
     if filter_col is not None:
         df = df[df[filter_col] == filter]
     df = df.groupby(date_col)[series_col].sum().reset_index()
@@ -171,40 +169,42 @@ def plot_hospital_stats(adm_dis_7d, inpatients, icu, start_date, scale='linear')
 
 def lambda_handler(event, context):
     messages = ['Failure']
+    frame_cache.reset()
 
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
     try:
-        # Get the index
-        s3 = boto3.client('s3')
+        # Get the report history, which holds the totals from earlier reports
+        s3 = get_client('s3')
+        population_store.configure(s3, secret['bucketname'])
         status = S3_scraper_index(s3, secret['bucketname'], secret['doh-dd-index'])
-        index = status.get_dict()
+        history = open_report_history(status, ['ind_tested', 'ind_positive', 'deaths', 'admissions', 'discharges'])
+
+        # Each datastore is read once for all the changes and written once after the last of them
+        tests_store = S3_datastore(s3, secret['bucketname'], secret['doh-dd-store-tests'], 'Reported_Date', 'doh-dd-tests')
+        agebands_store = S3_datastore(s3, secret['bucketname'], secret['doh-dd-store-agebands'], 'Date', 'doh-dd-agebands')
 
         tweets = []
-        # Download the most recently updated Excel file
+        # Read the most recently updated Excel file, from its sheet snapshots where there are any
         for change in event:
-            obj = s3.get_object(Bucket=secret['bucketname'],Key=change['keyname'])['Body']
-            stream = io.BytesIO(obj.read())
+            workbook = Workbook.from_s3(s3, secret['bucketname'], change['keyname'])
 
             # Load the tests sheet and add it to the store
-            daily = pandas.read_excel(stream,engine='openpyxl',sheet_name='Tests')
+            daily = workbook.sheet('Tests', usecols=['Sample_Date', 'Total Tests', 'Total Cases'])
             daily = daily.groupby(['Sample_Date']).sum()[['Total Tests','Total Cases']].reset_index()
             daily['Reported_Date'] = pandas.to_datetime(change['filedate'], format='%Y-%m-%d')
-            datastore = update_datastore(
-                s3,
-                secret['bucketname'],
-                secret['doh-dd-store-tests'],
+            datastore = tests_store.update(
                 daily['Reported_Date'].max(),
                 daily,
                 (change.get('notweet', False) is False) and (change.get('tweet', True) is True),
-                'Reported_Date'
+                history=0
             )
 
             # Load test data and add extra fields
-            df = pandas.read_excel(stream,engine='openpyxl',sheet_name='Summary Tests')
+            df = workbook.sheet('Summary Tests')
             df['pos_rate'] = df['Total Cases']/df['Total Tests']
             df['rolling_pos_rate'] = df['Rolling 7 Day Cases']/df['Rolling 7 Day Tests (PCR & LFT)']
             df['printdate']=df['Sample_Date'].dt.strftime('%-d %B %Y')
@@ -225,12 +225,12 @@ def lambda_handler(event, context):
             last_but1_model = df.iloc[df[(df['Rolling cases per 100k model_daily_change'].notna()) & (df['Sample_Date'] != latest_model['Sample_Date'])]['Sample_Date'].idxmax()]
 
             # Summary stats to allow 'X registered in last 24 hours' info
-            deaths = load_ni_time_series(stream,'Deaths','Date of Death','Number of Deaths')
-            admissions = load_ni_time_series(stream,'Admissions','Admission Date','Number of Admissions',True)
-            discharges = load_ni_time_series(stream,'Discharges','Discharge Date','Number of Discharges')
-            inpatients = load_ni_time_series(stream,'Inpatients','Inpatients at Midnight','Number of Confirmed COVID Inpatients',False,'Sex','All')
+            deaths = load_ni_time_series(workbook,'Deaths','Date of Death','Number of Deaths')
+            admissions = load_ni_time_series(workbook,'Admissions','Admission Date','Number of Admissions',True)
+            discharges = load_ni_time_series(workbook,'Discharges','Discharge Date','Number of Discharges')
+            inpatients = load_ni_time_series(workbook,'Inpatients','Inpatients at Midnight','Number of Confirmed COVID Inpatients',False,'Sex','All')
             inpatients.rename(columns={'Inpatients at Midnight': 'Date'}, inplace=True)
-            icu = load_ni_time_series(stream,'ICU','Date','Confirmed COVID Occupied')
+            icu = load_ni_time_series(workbook,'ICU','Date','Confirmed COVID Occupied')
             totals = {
                 'ind_tested': int(df['Total Tests'].sum()),
                 'ind_positive': int(df['Total Cases'].sum()),
@@ -248,7 +248,8 @@ def lambda_handler(event, context):
             adm_dis_7d = adm_dis_7d.melt(id_vars='Date')
 
             # Age band data
-            age_bands = pandas.read_excel(stream,engine='openpyxl',sheet_name='Individuals 7 Days - 5yr Age')
+            age_bands = workbook.sheet('Individuals 7 Days - 5yr Age', usecols=['Age_Band_5yr', 'Total_Cases', 'Total_Tests'])
+            workbook.close()
             age_bands = age_bands.groupby('Age_Band_5yr').sum()[['Total_Cases','Total_Tests']].reset_index()
             age_bands['Positivity_Rate'] = age_bands['Total_Cases'] / age_bands['Total_Tests']
             age_bands['Band Start'] = age_bands['Age_Band_5yr'].str.extract('Aged (\d+)').astype(float)
@@ -256,14 +257,11 @@ def lambda_handler(event, context):
             age_bands['Date'] = df['Sample_Date'].max()
             age_bands['Positive_Tests'] = age_bands['Total_Cases']
             # Get the age bands datastore contents from S3
-            datastore = update_datastore(
-                s3,
-                secret['bucketname'],
-                secret['doh-dd-store-agebands'],
+            datastore = agebands_store.update(
                 df['Sample_Date'].max(),
                 age_bands,
                 (change.get('notweet', False) is False) and (change.get('tweet', True) is True),
-                'Date'
+                history=42
             )
             # Plot the case reports and 7-day average
             driver = get_chrome_driver()
@@ -277,25 +275,22 @@ def lambda_handler(event, context):
                     plots = output_plot(p, plots, driver, 'ni-hospitals-%s.png' % today_str)
                     if len(plots) > 1:
                         toplot = datastore[datastore['Date'] >= (datastore['Date'].max() + pandas.DateOffset(days=-42))]
-                        toplot['Date'] = pandas.to_datetime(toplot['Date'])
                         newind = pandas.date_range(start=toplot['Date'].max() + pandas.DateOffset(days=-42), end=toplot['Date'].max())
                         alldates = pandas.Series(newind)
                         alldates.name = 'Date'
                         toplot = toplot.merge(alldates, how='outer', left_on='Date', right_on='Date')
                         toplot['X'] = toplot['Date'].dt.strftime('%e %b')
                         toplot['Most Recent Positive Tests'] = toplot['Positive_Tests'].where(toplot['Date'] == toplot['Date'].max()).apply(lambda x: f"{x:n}" if not pandas.isna(x) else "")
-                        toplot['Age_Band_5yr'].fillna('Not Known', inplace=True)
+                        toplot['Age_Band_5yr'] = toplot['Age_Band_5yr'].astype(object).fillna('Not Known')
                         bands = toplot.groupby(['Age_Band_5yr','Band Start','Band End'], dropna=False).size().reset_index()[['Age_Band_5yr','Band Start','Band End']]
                         bands = bands[bands['Age_Band_5yr']!='Not Known']
                         bands.fillna(90, inplace=True)
                         bands['Band End'] = bands['Band End'].astype(int)
                         bands['Band Start'] = bands['Band Start'].astype(int)
-                        bands['Year'] = bands.apply(lambda x: range(x['Band Start'], x['Band End']+1), axis='columns')
-                        bands = bands.explode('Year').reset_index()
-                        pops = get_ni_pop_pyramid()
-                        pops = pops[pops['Year']==2020].groupby(['Age Band']).sum()['Population']
-                        bands = bands.merge(pops, how='inner', validate='1:1', right_index=True, left_on='Year')
-                        bands = bands.groupby('Age_Band_5yr').sum()['Population']
+                        bands = population_store.by_band('ni', 2020, {
+                            b['Age_Band_5yr']: range(b['Band Start'], b['Band End']+1) for _, b in bands.iterrows()
+                        })
+                        bands.index.name = 'Age_Band_5yr'
                         toplot = toplot.merge(bands, how='left', on='Age_Band_5yr')
                         toplot['Positive per 100k'] = (100000 * toplot['Positive_Tests']) / toplot['Population']
                         toplot['Most Recent Positive per 100k'] = toplot['Positive per 100k'].where(toplot['Date'] == toplot['Date'].max()).apply(lambda x: f"{int(x):n}" if not pandas.isna(x) else "")
@@ -363,36 +358,29 @@ def lambda_handler(event, context):
             # If we have the data for it, build the second tweet
             last_week = datetime.datetime.strptime(change['filedate'],'%Y-%m-%d').date() - datetime.timedelta(days=7)
             day_before = datetime.datetime.strptime(change['filedate'],'%Y-%m-%d').date() - datetime.timedelta(days=1)
-            yesterday = None
-            lastweek = None
-            for report in index:
-                if (report['filedate'] == last_week.strftime('%Y-%m-%d')) and ('totals' in report):
-                    lastweek = report
-                elif (report['filedate'] == day_before.strftime('%Y-%m-%d')) and ('totals' in report):
-                    yesterday = report
-                if (yesterday is not None) and (lastweek is not None):
-                    break
+            lastweek = history.get(last_week.strftime('%Y-%m-%d'))
+            yesterday = history.get(day_before.strftime('%Y-%m-%d'))
             tweet2 = '''{inpatients} inpatient{ips} reported'''.format(
                     inpatients=totals['admissions'] - totals['discharges'],
                     ips='s' if ((totals['admissions'] - totals['discharges']) != 1) else ''
             )
             if lastweek is not None:
-                ip_change = (totals['admissions'] - totals['discharges']) - (lastweek['totals']['admissions'] - lastweek['totals']['discharges'])
+                ip_change = (totals['admissions'] - totals['discharges']) - (lastweek['admissions'] - lastweek['discharges'])
                 tweet2 += ''':
 {ip_bullet} {ip_change} {ip_text} than 7 days ago ({admissions} admitted, {discharges} discharged)'''.format(
                     ip_change=abs(ip_change),
                     ip_bullet=good_symb if ip_change < 0 else bad_symb,
                     ip_text='fewer' if ip_change < 0 else 'more',
-                    admissions=totals['admissions'] - lastweek['totals']['admissions'],
-                    discharges=totals['discharges'] - lastweek['totals']['discharges']
+                    admissions=totals['admissions'] - lastweek['admissions'],
+                    discharges=totals['discharges'] - lastweek['discharges']
                 )
                 if yesterday is not None:
                     tweet2 += '''
 
 {deaths} death{ds} reported, {deaths_7d} in last 7 days'''.format(
-                        deaths=totals['deaths'] - yesterday['totals']['deaths'],
-                        ds='s' if ((totals['deaths'] - yesterday['totals']['deaths']) != 1) else '',
-                        deaths_7d=totals['deaths'] - lastweek['totals']['deaths']
+                        deaths=totals['deaths'] - yesterday['deaths'],
+                        ds='s' if ((totals['deaths'] - yesterday['deaths']) != 1) else '',
+                        deaths_7d=totals['deaths'] - lastweek['deaths']
                     )
 
             tweet2 += '''
@@ -417,6 +405,10 @@ def lambda_handler(event, context):
                 'plots': plots
             })
 
+        # Push the datastores once every change has been processed
+        tests_store.commit()
+        agebands_store.commit()
+
         donottweet = []
         if len(tweets) > 1:
             for i in range(1,len(tweets)):
@@ -446,15 +438,11 @@ def lambda_handler(event, context):
                             resp = api.tweet(t['text2'], resp.id)
                             messages[-1] += ('ID %s, ' %resp.id)
 
-                        # Update the file index
-                        for i in range(len(index)):
-                            if index[i]['filedate'] == t['filedate']:
-                                index[i]['tweet'] = resp.id
-                                index[i]['totals'] = t['totals']
-                                break
-                        status.put_dict(index)
+                        # Update the report history
+                        history.put(t['filedate'], t['totals'], resp.id)
+                        history.save()
 
-                        messages[-1] += ('updated %s' %secret['doh-dd-index'])
+                        messages[-1] += ('updated %s' %history.keyname)
                     else:
                         if len(upload_ids) > 0:
                             resp = api.dm(secret['twitter_dmaccount'], t['text'] + t['url'], upload_ids[0])
@@ -484,5 +472,6 @@ def lambda_handler(event, context):
         "statusCode": 200,
         "body": json.dumps({
             "message:": messages,
+            "datastore_cache": frame_cache.stats(),
         }),
     }
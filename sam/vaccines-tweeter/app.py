@@ -5,7 +5,6 @@ import time
 import random
 import io
 
-import boto3
 import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
@@ -17,10 +16,10 @@ import pandas
 import numpy
 import altair
 
-from shared import get_url, get_and_sort_index
+from shared import get_url, get_and_sort_index, get_client
 from twitter_shared import TwitterAPI
 from plot_shared import get_chrome_driver
-from data_shared import get_eng_pop_pyramid, get_ni_pop_pyramid, update_datastore
+from data_shared import population_store, update_datastore, datastore_keyname, frame_cache, Workbook
 
 good_symb = '\u2193'
 bad_symb = '\u2191'
@@ -30,6 +29,10 @@ green_block = '\u2705'
 white_block = '\u2b1c'
 black_block = '\u2b1b'
 
+# Days of each datastore read back on update. Only the latest report and the one before it are
+# compared, so partitioned stores need only read their hot window
+datastore_history = 42
+
 # List of NI age bands, with ordering for plotting
 ni_age_bands_lookup = pandas.DataFrame([
     {'Order': 0, 'NI band': 'Under 5', 'Ages': [i for i in range(5)]},
@@ -64,8 +67,7 @@ def get_ni_comparable_population_age_bands():
     age_bands_ons = all_age_bands_lookup.explode('Ages').reset_index()
 
     # Load the 2020 population data for NI and convert to the NI vaccine reporting bands
-    ni_pop = get_ni_pop_pyramid()
-    ni_pop = ni_pop[ni_pop['Year']==2020].groupby('Age Band').sum()['Population'].astype(int).reset_index()
+    ni_pop = population_store.by_age('ni', 2020).astype(int).reset_index()
     ni_pop = ni_pop.merge(age_bands_ons, how='inner', left_on='Age Band', right_on='Ages', validate='1:1')
     ni_pop = ni_pop.groupby(['Order','Band']).sum()['Population'].reset_index()
     ni_pop['% of total population'] = ni_pop['Population'] / ni_pop['Population'].sum()
@@ -76,8 +78,7 @@ def get_ni_reported_population_age_bands():
     age_bands_ons = ni_age_bands_lookup.explode('Ages').reset_index()
 
     # Load the 2020 population data for NI and convert to the NI vaccine reporting bands
-    ni_pop = get_ni_pop_pyramid()
-    ni_pop = ni_pop[ni_pop['Year']==2020].groupby('Age Band').sum()['Population'].astype(int).reset_index()
+    ni_pop = population_store.by_age('ni', 2020).astype(int).reset_index()
     ni_pop = ni_pop.merge(age_bands_ons, how='inner', left_on='Age Band', right_on='Ages', validate='1:1')
     ni_pop = ni_pop.groupby(['Order','NI band']).sum()['Population'].reset_index()
     ni_pop.rename(columns={'NI band': 'Band'}, inplace=True)
@@ -89,8 +90,7 @@ def get_eng_population_age_bands():
     age_bands_ons = all_age_bands_lookup.explode('Ages').reset_index()
 
     # Load the 2020 population data for England and convert to the NI vaccine reporting bands
-    eng_pop = get_eng_pop_pyramid()
-    eng_pop = eng_pop[eng_pop['Year']==2020].groupby('Age Band').sum()['Population'].astype(int).reset_index()
+    eng_pop = population_store.by_age('eng', 2020).astype(int).reset_index()
     eng_pop = eng_pop.merge(age_bands_ons, how='inner', left_on='Age Band', right_on='Ages', validate='1:1')
     eng_pop = eng_pop.groupby(['Order','Band']).sum()['Population'].reset_index()
     eng_pop['% of total population'] = eng_pop['Population'] / eng_pop['Population'].sum()
@@ -114,19 +114,13 @@ def get_eng_age_band_data():
             break
     if url is None:
         raise Exception('Unable to find England data')
-    # Get the age band data, transform and aggregate
-    try:
-        eng = pandas.read_excel(url, sheet_name='Total Vaccinations by Age', header=12)
-        eng.dropna(axis='columns', how='all', inplace=True)
-        eng.dropna(axis='index', how='all', inplace=True)
-        newcols = [clean_eng_age_band_cols(i) for i in eng.columns.values]
-    except AttributeError:
-        logging.exception('Falling back to earlier header row')
-        eng = pandas.read_excel(url, sheet_name='Total Vaccinations by Age', header=11)
-        eng.dropna(axis='columns', how='all', inplace=True)
-        eng.dropna(axis='index', how='all', inplace=True)
-        newcols = [clean_eng_age_band_cols(i) for i in eng.columns.values]
-    eng.columns = newcols
+    # Get the age band data, transform and aggregate, the header row being the one naming the age group and doses
+    workbook = Workbook(get_url(session, url, 'content'))
+    eng = workbook.sheet('Total Vaccinations by Age', header=['Age Group', '1st dose'])
+    workbook.close()
+    eng.dropna(axis='columns', how='all', inplace=True)
+    eng.dropna(axis='index', how='all', inplace=True)
+    eng.columns = [clean_eng_age_band_cols(i) for i in eng.columns.values]
     eng.dropna(axis='index', subset=['1st dose'], inplace=True)
     eng = eng.drop(columns=['Cumulative Total Doses to Date'])
     eng = eng[~eng['Age Group'].str.startswith('England')]
@@ -144,7 +138,7 @@ def pbi_goto_page(driver, pagenum):
         time.sleep(3.0 + 3*(random.random()))
         driver.find_element_by_css_selector(".pbi-glyph-chevronrightmedium").click()
 
-def get_ni_headline_data(driver, s3, bucketname, last_updated, s3_dir, store):
+def get_ni_headline_data(driver, s3, bucketname, last_updated, s3_dir, store, partitioned=False):
     headers = [
         my_elem.text for my_elem in WebDriverWait(
             driver, 20).until(
@@ -166,11 +160,11 @@ def get_ni_headline_data(driver, s3, bucketname, last_updated, s3_dir, store):
     df = pandas.DataFrame({'Dose': headers[1:], 'Total': items[1:len(headers)]})
     df['Total'] = df['Total'].str.replace(',','').str.extract(r'\s(\d+)').astype(int)
     df['Dose'] = df['Dose'].str.replace('\n',' ').str.extract(r'(Dose 1|Dose 2|Dose 3|Spring 2023 Booster|Booster)')
-    keyname = '%s/doses.csv' % s3_dir
-    datastore = update_datastore(s3, bucketname, keyname, last_updated, df, store)
+    keyname = datastore_keyname(s3_dir, 'doses', partitioned)
+    datastore = update_datastore(s3, bucketname, keyname, last_updated, df, store, history=datastore_history, schema='vaccine-doses')
     return datastore
 
-def get_ni_age_band_data(driver, s3, bucketname, last_updated, s3_dir, store):
+def get_ni_age_band_data(driver, s3, bucketname, last_updated, s3_dir, store, partitioned=False):
     pop = get_ni_comparable_population_age_bands()
     pop_reported = get_ni_reported_population_age_bands()
     age_bands = all_age_bands_lookup.explode('NI bands').reset_index()
@@ -210,8 +204,8 @@ def get_ni_age_band_data(driver, s3, bucketname, last_updated, s3_dir, store):
     ni_as_reported = ni_as_reported.merge(pop_reported, how='right', left_on='Age Band', right_on='Band', validate='1:1')
     ni_as_reported = ni_as_reported[['Band', 'Order', 'First Doses', 'Second Doses', 'Third Doses', 'Booster Doses', 'Population', '% of total population']]
     # Update the s3 store
-    keyname = '%s/agebands.csv' % s3_dir
-    datastore = update_datastore(s3, bucketname, keyname, last_updated, ni_as_reported, store)
+    keyname = datastore_keyname(s3_dir, 'agebands', partitioned)
+    datastore = update_datastore(s3, bucketname, keyname, last_updated, ni_as_reported, store, history=datastore_history, schema='vaccine-agebands')
     previous_date = datastore[datastore['Date'] < datastore['Date'].max()]['Date'].max()
     previous = datastore[datastore['Date'] == previous_date][['Band', 'First Doses','Second Doses','Third Doses','Booster Doses']].rename(columns={'First Doses':'Previous First', 'Second Doses':'Previous Second', 'Third Doses':'Previous Third', 'Booster Doses': 'Previous Booster'})
     if len(previous) > 0:
@@ -385,7 +379,7 @@ ni_postcode_pops = pandas.DataFrame({
     ],
 })
 
-def get_ni_postcode_data(driver, s3, bucketname, last_updated, s3_dir, store):
+def get_ni_postcode_data(driver, s3, bucketname, last_updated, s3_dir, store, partitioned=False):
     # Navigate to page 9 of the report
     pbi_goto_page(driver, 9)
     # Right click on the bubble chart
@@ -446,8 +440,8 @@ def get_ni_postcode_data(driver, s3, bucketname, last_updated, s3_dir, store):
     df['Vaccinations per Person over 20'] = df['Vaccinations'] / df['Population over 20']
     df['Potential vaccinations'] = (df['Population over 20'] * 2) - df['Vaccinations']
     # Update the s3 store
-    keyname = '%s/postcodes.csv' % s3_dir
-    datastore = update_datastore(s3, bucketname, keyname, last_updated, df, store)
+    keyname = datastore_keyname(s3_dir, 'postcodes', partitioned)
+    datastore = update_datastore(s3, bucketname, keyname, last_updated, df, store, history=datastore_history, schema='vaccine-postcodes')
     return datastore
 
 def make_postcode_plots(driver, datastore, plots, today, last_updated):
@@ -609,14 +603,16 @@ def make_headline_tweets(df, source, last_updated):
 
 def lambda_handler(event, context):
     message = 'Failure'
+    frame_cache.reset()
     try:
         # Get the secret
-        sm = boto3.client('secretsmanager')
+        sm = get_client('secretsmanager')
         secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
         secret = json.loads(secretobj['SecretString'])
 
         # Get the previous data file list from S3
-        s3 = boto3.client('s3')
+        s3 = get_client('s3')
+        population_store.configure(s3, secret['bucketname'])
         keyname = secret['shared-vacc-index']
         index, indexobj = get_and_sort_index(secret['bucketname'], keyname, s3)
 
@@ -640,12 +636,13 @@ def lambda_handler(event, context):
                 driver.get(url)
                 store_data = (event.get('notweet') is not True) and (event.get('testtweet') is not True)
                 s3dir = keyname.rsplit('/',maxsplit=1)[0]
-                headlines = get_ni_headline_data(driver, s3, secret['bucketname'], last_updated, s3dir, store_data)
+                partitioned = secret.get('shared-vacc-store-partitioned', False)
+                headlines = get_ni_headline_data(driver, s3, secret['bucketname'], last_updated, s3dir, store_data, partitioned)
                 latest = headlines[headlines['Date']==headlines['Date'].max()]
                 tweets = make_headline_tweets(headlines, 'HSCNI', last_updated)
                 if tweets is None:
                     raise Exception('No change in data')
-                ni_age_bands, ni_age_bands_reported = get_ni_age_band_data(driver, s3, secret['bucketname'], last_updated, s3dir, store_data)
+                ni_age_bands, ni_age_bands_reported = get_ni_age_band_data(driver, s3, secret['bucketname'], last_updated, s3dir, store_data, partitioned)
                 tweets = [tweets[0]]
             except:
                 logging.exception('Caught exception in scraping/plotting')
@@ -715,5 +712,6 @@ def lambda_handler(event, context):
         "statusCode": 200,
         "body": json.dumps({
             "message:": message,
+            "datastore_cache": frame_cache.stats(),
         }),
     }
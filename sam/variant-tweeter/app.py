@@ -9,7 +9,7 @@ import requests
 import altair
 from selenium import webdriver
 
-from shared import S3_scraper_index
+from shared import S3_scraper_index, get_client
 from twitter_shared import TwitterAPI
 from plot_shared import get_chrome_driver
 
@@ -24,13 +24,13 @@ def lambda_handler(event, context):
     messages = []
 
     # Get the secret
-    sm = boto3.client('secretsmanager')
+    sm = get_client('secretsmanager')
     secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
     secret = json.loads(secretobj['SecretString'])
 
     try:
         # Get the index
-        s3 = boto3.client('s3')
+        s3 = get_client('s3')
         status = S3_scraper_index(s3, secret['bucketname'], secret['cog-variants-index'])
         index = status.get_dict()
 
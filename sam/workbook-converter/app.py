@@ -0,0 +1,32 @@
+import json
+import logging
+
+from shared import get_client, launch_lambda_async
+from data_shared import convert_workbook, SNAPSHOT_SHEETS
+
+def lambda_handler(event, context):
+    # Get the secret
+    sm = get_client('secretsmanager')
+    secretobj = sm.get_secret_value(SecretId='ni-covid-tweets')
+    secret = json.loads(secretobj['SecretString'])
+
+    s3 = get_client('s3')
+    # The scraper passes the source the changes came from, and the tweeter it would have launched with them
+    sheets = SNAPSHOT_SHEETS.get(event.get('source'), [])
+    converted = []
+    for change in event.get('changes', []):
+        try:
+            converted.extend(convert_workbook(s3, secret['bucketname'], change['keyname'], sheets))
+        except:
+            logging.exception('Error converting %s' %change.get('keyname'))
+
+    # The tweeter reads from the workbook whatever could not be converted
+    if event.get('lambda') is not None:
+        launch_lambda_async(event['lambda'], event.get('changes', []))
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "converted": converted,
+        }),
+    }